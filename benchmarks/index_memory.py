@@ -0,0 +1,98 @@
+"""
+Memory benchmark for `DirectoryIndex`.
+
+Builds the same synthetic tree (a million files by default, with the filenames
+repeating across directories the way camera dumps do) with the compact
+`DirectoryIndex` and with the representation it replaced, and reports the
+memory each one takes per entry.
+
+Run from the repository root:
+
+    python benchmarks/index_memory.py [--files N] [--files-per-dir N]
+"""
+from typing import Any, Callable, Set
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chadow_core import DirectoryIndex
+
+class LegacyDirectoryIndex(object):
+    """
+    The representation `DirectoryIndex` had before it was made compact: a
+    per-instance `__dict__`, a set per directory and no name interning.
+    """
+
+    def __init__(self, subdir_path=None, is_top_level=True, version="0.1.0"):
+        self.version = version if is_top_level else None
+        self.index: Set[Any] = set()
+        self.is_top_level = is_top_level
+        self.subdir_path = None if is_top_level else subdir_path
+
+    def add_to_index(self, item):
+        self.index.add(item)
+
+    def freeze(self):
+        return self
+
+def build_tree(index_cls: Callable, files: int, files_per_dir: int, dirs_per_dir: int):
+    """
+    A tree of `files` files spread over directories of `files_per_dir` files
+    each, `dirs_per_dir` subdirectories per level. Every directory uses the same
+    run of filenames. Names are formatted afresh each time, like the strings
+    coming out of `os.scandir` or `json.load` would be.
+    """
+    root = index_cls("/media/bench", is_top_level=True)
+    leaves = max(1, files // files_per_dir)
+    parents = [root]
+    created = 0
+    level = 0
+    while created < leaves:
+        children = []
+        for parent in parents:
+            for d in range(dirs_per_dir):
+                if created >= leaves:
+                    break
+                child = index_cls("dir%d_%d" % (level, d), is_top_level=False)
+                for f in range(files_per_dir):
+                    child.add_to_index("IMG_%04d.JPG" % f)
+                children.append((parent, child))
+                created += 1
+        # Attach bottom-up, finishing (freezing) each directory first.
+        for parent, child in children:
+            parent.add_to_index(child.freeze())
+        parents = [child for _, child in children]
+        level += 1
+    return root.freeze()
+
+def measure(index_cls: Callable, files: int, files_per_dir: int, dirs_per_dir: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    tree = build_tree(index_cls, files, files_per_dir, dirs_per_dir)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tree
+    gc.collect()
+    return current
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=1000000)
+    parser.add_argument("--files-per-dir", type=int, default=1000)
+    parser.add_argument("--dirs-per-dir", type=int, default=32)
+    args = parser.parse_args()
+
+    results = {}
+    for label, index_cls in (
+        ("legacy", LegacyDirectoryIndex), ("compact", DirectoryIndex)
+    ):
+        used = measure(index_cls, args.files, args.files_per_dir, args.dirs_per_dir)
+        results[label] = used
+        print("%-8s %12d bytes  %7.1f bytes/entry" % (label, used, used / args.files))
+
+    print("reduction %.1f%%" % (100.0 * (1 - results["compact"] / results["legacy"])))
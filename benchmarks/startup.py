@@ -0,0 +1,107 @@
+"""
+Cold-start benchmark for the chadow CLI.
+
+Times fresh `python chadow.py ...` processes, the way cron or a shell script
+would run them: `--help` for every subcommand (import plus dispatch, no work)
+and the listing commands against a small throwaway config. The time Python
+itself takes to start is measured too, so that chadow's share can be told
+apart.
+
+Run from the repository root:
+
+    python benchmarks/startup.py [--runs N] [--command NAME]
+"""
+from typing import Dict, List, Sequence, Tuple
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHADOW = os.path.join(REPO_ROOT, "chadow.py")
+
+sys.path.insert(0, REPO_ROOT)
+
+from chadow_core import cli
+
+def make_home() -> str:
+    """
+    A home directory holding a config with one library of two sectors, so that
+    the listing commands have something to list.
+    """
+    home = tempfile.mkdtemp(prefix="chadow-startup-")
+    app_root = os.path.join(home, ".chadow")
+    os.mkdir(app_root)
+    config = {
+        "version": "bench",
+        "libraryMapping": {
+            "photos": {
+                "sectors": {
+                    "originals": [os.path.join(home, "ehd1")],
+                    "backup": [os.path.join(home, "ehd2")]
+                },
+                "comparator": "filename"
+            }
+        }
+    }
+    with open(os.path.join(app_root, "config.json"), "w") as config_file:
+        json.dump(config, config_file)
+    return home
+
+def time_command(argv: Sequence[str], home: str, runs: int) -> Tuple[float, float]:
+    """
+    The fastest and the median wall time, in milliseconds, of `runs` fresh
+    processes running `argv`.
+    """
+    env = dict(os.environ, HOME=home, PYTHONPATH=REPO_ROOT)
+    samples: List[float] = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(
+            argv, env=env, cwd=REPO_ROOT, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, check=False
+        )
+        samples.append((time.perf_counter() - started) * 1000)
+    return min(samples), statistics.median(samples)
+
+def commands() -> Dict[str, List[str]]:
+    runs = {"--help": ["--help"]}
+    for name in sorted(cli.commands):
+        runs["%s --help" % name] = [name, "--help"]
+    runs["lslib"] = ["lslib"]
+    runs["lssector"] = ["lssector", "photos"]
+    runs["lsmedia"] = ["lsmedia", "photos", "originals"]
+    return runs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--command", action="append", default=[],
+        help="Only time these (e.g. 'lslib' or 'index --help'); may be repeated."
+    )
+    args = parser.parse_args()
+    chadow = [sys.executable, CHADOW]
+
+    home = make_home()
+    try:
+        best, median = time_command([sys.executable, "-c", "pass"], home, args.runs)
+        print("%-24s %8.1f ms min  %8.1f ms median" % ("(python -c pass)", best, median))
+        interpreter = best
+
+        for label, argv in commands().items():
+            if args.command and label not in args.command:
+                continue
+            best, median = time_command(chadow + argv, home, args.runs)
+            print(
+                "%-24s %8.1f ms min  %8.1f ms median  %8.1f ms over python" %
+                (label, best, median, best - interpreter)
+            )
+    finally:
+        shutil.rmtree(home)
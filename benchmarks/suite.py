@@ -0,0 +1,185 @@
+"""
+Benchmarks of chadow's hot paths on synthetic media trees.
+
+For every tree shape of `treegen.py`, a tree is generated (on `/dev/shm` when it
+is there) and the following are measured:
+
+- `index`: walking the tree into a `DirectoryIndex` with `MediaWalker`.
+- `to_json`: serializing that index.
+- `construct_from_dict`: rebuilding the index from its parsed JSON.
+- `make_filename_diffbins`: comparing three sectors holding the tree's files,
+  with a few percent of them missing from each.
+
+Each case reports its best wall time over `--repeat` runs and, from one more run
+under `tracemalloc`, the peak memory it allocated. Results can be saved as a
+baseline with `--save-baseline`; `--check` compares against it and exits
+nonzero if any case got slower or bigger than the tolerances allow.
+
+Run from the repository root:
+
+    python benchmarks/suite.py [--files N] [--shape SHAPE] [--case CASE]
+        [--save-baseline | --check] [--baseline FILE]
+"""
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chadow_core import DirectoryIndex, MediaWalker, make_filename_diffbins
+from treegen import SHAPES, iter_tree, materialize
+
+CASES = ("index", "to_json", "construct_from_dict", "make_filename_diffbins")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+Result = Dict[str, float]
+
+def measure(fn: Callable[[], Any], repeat: int) -> Result:
+    """
+    Best wall time of `repeat` calls to `fn`, then the peak of the memory
+    allocated during one more call, traced.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+        del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {"seconds": best, "peak_bytes": peak}
+
+def sector_sets(shape: str, files: int, seed: int) -> Dict[str, Set[str]]:
+    """
+    The tree's files as three sectors, each missing a different few percent.
+    """
+    paths = [
+        "/".join(directory + (name,))
+        for directory, name, _, _ in iter_tree(shape, files, seed=seed)
+    ]
+    return {
+        "originals": {path for i, path in enumerate(paths) if i % 29},
+        "backup": {path for i, path in enumerate(paths) if i % 31},
+        "offsite": {path for i, path in enumerate(paths) if i % 37 and i % 41}
+    }
+
+def run_shape(shape: str, args: argparse.Namespace, scratch: str) -> Dict[str, Result]:
+    results: Dict[str, Result] = {}
+    wanted = args.case or CASES
+    root = os.path.join(scratch, shape)
+    materialize(root, iter_tree(shape, args.files, seed=args.seed))
+    try:
+        walk = lambda: MediaWalker(root, workers=args.workers).walk()
+        if "index" in wanted:
+            results["index"] = measure(walk, args.repeat)
+
+        index = walk() if {"to_json", "construct_from_dict"} & set(wanted) else None
+        if "to_json" in wanted:
+            results["to_json"] = measure(index.to_json, args.repeat)
+        if "construct_from_dict" in wanted:
+            dict_rep = json.loads(index.to_json())
+            results["construct_from_dict"] = measure(
+                lambda: DirectoryIndex.construct_from_dict(dict_rep), args.repeat
+            )
+            del dict_rep
+        del index
+    finally:
+        shutil.rmtree(root)
+
+    if "make_filename_diffbins" in wanted:
+        sets = sector_sets(shape, args.files, args.seed)
+        results["make_filename_diffbins"] = measure(
+            lambda: make_filename_diffbins(sets), args.repeat
+        )
+    return results
+
+def regressions(
+    results: Dict[str, Result], baseline: Dict[str, Result], time_tolerance: float,
+    memory_tolerance: float
+) -> List[str]:
+    found = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for key, tolerance in (("seconds", time_tolerance), ("peak_bytes", memory_tolerance)):
+            limit = baseline[name][key] * (1 + tolerance)
+            if result[key] > limit:
+                found.append(
+                    "%s: %s %.4g is over the baseline %.4g by more than %d%%" %
+                    (name, key, result[key], baseline[name][key], tolerance * 100)
+                )
+    return found
+
+def default_scratch() -> str:
+    return "/dev/shm" if os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shape", action="append", choices=SHAPES, default=[])
+    parser.add_argument("--case", action="append", choices=CASES, default=[])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--scratch", default=default_scratch(), help="Where to generate trees.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--save-baseline", action="store_true")
+    mode.add_argument("--check", action="store_true", help="Exit with 1 on a regression.")
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--memory-tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="chadow-bench-", dir=args.scratch)
+    results: Dict[str, Result] = {}
+    try:
+        for shape in args.shape or SHAPES:
+            for case, result in run_shape(shape, args, scratch).items():
+                name = "%s/%s" % (shape, case)
+                results[name] = result
+                print(
+                    "%-36s %9.3f s  %12d bytes peak" %
+                    (name, result["seconds"], result["peak_bytes"])
+                )
+    finally:
+        shutil.rmtree(scratch)
+
+    if args.save_baseline:
+        stored: Dict[str, Any] = {"files": args.files, "seed": args.seed, "results": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                stored = json.load(baseline_file)
+            if (stored["files"], stored["seed"]) != (args.files, args.seed):
+                stored = {"files": args.files, "seed": args.seed, "results": {}}
+        stored["results"].update(results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(stored, baseline_file, indent=2, sort_keys=True)
+        print("Baseline saved to %s." % args.baseline)
+    elif args.check:
+        with open(args.baseline) as baseline_file:
+            stored = json.load(baseline_file)
+        if (stored["files"], stored["seed"]) != (args.files, args.seed):
+            sys.exit(
+                "The baseline is for --files %d --seed %d." % (stored["files"], stored["seed"])
+            )
+        found = regressions(
+            results, stored["results"], args.time_tolerance, args.memory_tolerance
+        )
+        for regression in found:
+            print("REGRESSION %s" % regression)
+        sys.exit(1 if found else 0)
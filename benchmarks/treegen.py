@@ -0,0 +1,144 @@
+"""
+Deterministic generator of synthetic media trees.
+
+The same shape, file count and seed always give the same tree: the same
+directories, file names, sizes and modification times. Three shapes are
+available:
+
+- `realistic` looks like a drive of camera dumps: a directory per year, one per
+  event under it (some of them split further into `RAW` and `JPG`), and runs of
+  `IMG_nnnn` names that repeat across events, with the odd sidecar and video.
+- `wide` is a flat run of very large directories directly under the root.
+- `deep` is chains of directories nested `--depth` levels down, with a few
+  files at every level.
+
+Files are created sparse, so even large trees take next to no space; put them
+on a tmpfs (`/dev/shm`, say) to keep the disk out of the numbers.
+
+Run from the repository root:
+
+    python benchmarks/treegen.py ROOT [--shape realistic] [--files N] [--seed N]
+"""
+from typing import Dict, Iterator, List, Tuple
+
+import argparse
+import os
+import random
+
+SHAPES = ("realistic", "wide", "deep")
+# All generated files and directories are dated within this year, well outside
+# of the window in which `index` refuses to trust directory fingerprints.
+EPOCH = 1546300800  # 2019-01-01T00:00:00Z
+YEAR_SECONDS = 365 * 24 * 3600
+
+# A directory (as a tuple of names under the root), a file name, its size in
+# bytes and its modification time in seconds.
+Entry = Tuple[Tuple[str, ...], str, int, int]
+
+def _realistic(files: int, rng: random.Random) -> Iterator[Entry]:
+    produced = 0
+    counter = 0
+    year = 2010
+    while produced < files:
+        event_count = rng.randint(20, 60)
+        for event in range(event_count):
+            if produced >= files:
+                break
+            month = event * 12 // event_count + 1
+            day = rng.randint(1, 28)
+            event_dir = ("%d" % year, "%d-%02d-%02d event%03d" % (year, month, day, event))
+            split = rng.random() < 0.25
+            shots = min(files - produced, max(1, int(rng.lognormvariate(4.5, 1.0))))
+            taken = EPOCH + rng.randrange(YEAR_SECONDS)
+            for _ in range(shots):
+                if produced >= files:
+                    break
+                # Cameras roll their counters over at 9999, hence the repeats.
+                counter = counter % 9999 + 1
+                taken += rng.randint(1, 120)
+                kind = rng.random()
+                if kind < 0.03:
+                    yield event_dir, "MVI_%04d.MP4" % counter, rng.randint(50, 2000) << 20, taken
+                else:
+                    directory = event_dir + ("JPG",) if split else event_dir
+                    yield directory, "IMG_%04d.JPG" % counter, rng.randint(2, 12) << 20, taken
+                    if split and produced + 1 < files:
+                        yield event_dir + ("RAW",), "IMG_%04d.CR2" % counter, rng.randint(20, 40) << 20, taken
+                        produced += 1
+                    elif kind > 0.98 and produced + 1 < files:
+                        yield event_dir, "IMG_%04d.JPG.xmp" % counter, rng.randint(2, 8) << 10, taken
+                        produced += 1
+                produced += 1
+        year += 1
+
+def _wide(files: int, rng: random.Random, files_per_dir: int=5000) -> Iterator[Entry]:
+    for produced in range(files):
+        directory = ("bulk%05d" % (produced // files_per_dir),)
+        yield (
+            directory, "file%07d.dat" % produced, rng.randint(0, 1 << 20),
+            EPOCH + rng.randrange(YEAR_SECONDS)
+        )
+
+def _deep(files: int, rng: random.Random, depth: int=256, files_per_level: int=4) -> Iterator[Entry]:
+    for produced in range(files):
+        level = (produced // files_per_level) % depth
+        chain = produced // (files_per_level * depth)
+        directory = ("chain%04d" % chain,) + tuple("d%03d" % d for d in range(level + 1))
+        yield (
+            directory, "f%d.txt" % (produced % files_per_level), rng.randint(0, 4096),
+            EPOCH + rng.randrange(YEAR_SECONDS)
+        )
+
+def iter_tree(shape: str, files: int, seed: int=0, depth: int=256) -> Iterator[Entry]:
+    """
+    The entries of a tree of `files` files, in a stable order.
+    """
+    rng = random.Random("%s/%d" % (shape, seed))
+    if shape == "realistic":
+        return _realistic(files, rng)
+    elif shape == "wide":
+        return _wide(files, rng)
+    elif shape == "deep":
+        return _deep(files, rng, depth=depth)
+    raise ValueError("Unknown shape %r, expected one of %s." % (shape, ", ".join(SHAPES)))
+
+def materialize(root: str, entries: Iterator[Entry]) -> Tuple[int, int]:
+    """
+    Create the files of `entries` under `root`, which must not exist yet. Returns
+    the number of directories and files created.
+    """
+    os.makedirs(root)
+    dir_mtimes: Dict[Tuple[str, ...], int] = {(): EPOCH}
+    file_count = 0
+    for directory, name, size, mtime in entries:
+        if directory not in dir_mtimes:
+            for level in range(1, len(directory) + 1):
+                if directory[:level] not in dir_mtimes:
+                    os.mkdir(os.path.join(root, *directory[:level]))
+                    dir_mtimes[directory[:level]] = EPOCH
+        path = os.path.join(root, *directory, name)
+        with open(path, "wb") as f:
+            f.truncate(size)
+        os.utime(path, (mtime, mtime))
+        dir_mtimes[directory] = max(dir_mtimes[directory], mtime)
+        file_count += 1
+
+    # Date the directories last, since creating their entries touched them.
+    ordered: List[Tuple[str, ...]] = sorted(dir_mtimes, key=len, reverse=True)
+    for directory in ordered:
+        os.utime(os.path.join(root, *directory), (dir_mtimes[directory], dir_mtimes[directory]))
+    return len(dir_mtimes), file_count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("root")
+    parser.add_argument("--shape", choices=SHAPES, default="realistic")
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--depth", type=int, default=256)
+    args = parser.parse_args()
+
+    directories, files = materialize(
+        args.root, iter_tree(args.shape, args.files, seed=args.seed, depth=args.depth)
+    )
+    print("%s: %d directories, %d files" % (args.root, directories, files))
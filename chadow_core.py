@@ -0,0 +1,5950 @@
+from __future__ import annotations
+from typing import Any, BinaryIO, Callable, Collection, ContextManager, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import click
+import contextlib
+import enum
+import errno
+import functools
+import importlib.util
+import io
+import os
+import json
+import re
+import logging
+import stat
+import struct
+import sys
+import time
+
+if sys.version_info >= (3, 8):
+    from typing import TypedDict
+else:
+    from typing_extensions import TypedDict
+
+def _lazy_import(name: str) -> Any:
+    """
+    Returns module `name`, deferring its actual import until one of its
+    attributes is first used.
+
+    Most invocations of chadow are short (`lslib` from a cron job, say) and never
+    touch the likes of `sqlite3` or `concurrent.futures`, so the modules that only
+    some commands need are bound through this instead of imported outright.
+
+    The parent package of a submodule is imported outright, as finding the
+    submodule needs it anyway, and gets the submodule set on it the way `import`
+    would. So the parent should not itself be bound through this: setting an
+    attribute on a lazy module loads it on the spot.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ImportError("No module named %r" % name, name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+array = _lazy_import("array")
+bisect = _lazy_import("bisect")
+concurrent_futures = _lazy_import("concurrent.futures")
+ctypes = _lazy_import("ctypes")
+datetime = _lazy_import("datetime")
+hashlib = _lazy_import("hashlib")
+heapq = _lazy_import("heapq")
+itertools = _lazy_import("itertools")
+mmap = _lazy_import("mmap")
+select = _lazy_import("select")
+shlex = _lazy_import("shlex")
+shutil = _lazy_import("shutil")
+sqlite3 = _lazy_import("sqlite3")
+urllib_parse = _lazy_import("urllib.parse")
+
+@functools.lru_cache(maxsize=None)
+def get_version() -> str:
+    """
+    The version of chadow, as given by the VERSION file next to this module or,
+    failing that, in the working directory. Read on first use and cached.
+    """
+    candidates = (os.path.join(os.path.dirname(os.path.abspath(__file__)), "VERSION"), "VERSION")
+    version_filename = next(
+        (candidate for candidate in candidates if os.path.isfile(candidate)), "VERSION"
+    )
+    with open(version_filename) as v:
+        vlist = list(v)
+        if len(vlist) > 1:
+            logging.warning("The version file has more than one line.")
+
+        for line in vlist:
+            return line.strip()
+
+    # The only time execution will get to this is when there is not a single
+    # line to read from the version file.
+    raise Exception("Version file is empty!")
+
+def __getattr__(name: str) -> Any:
+    # `VERSION` used to be read at import time. It is still available as a
+    # module attribute, only resolved when asked for.
+    if name == "VERSION":
+        return get_version()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+# Default of `version` parameters that stand for the running chadow's version,
+# so that signatures needing it do not read the VERSION file at import time.
+_CURRENT_VERSION: Any = object()
+
+APP_ROOT: str = os.path.expanduser("~/.chadow")
+CONFIG_NAME: str = "config.json"
+# We add a metadata dotfile to the media path to ensure that a media path can't
+# be part of more than one sector.
+CHADOW_METADATA: str = ".chadow-metadata"
+INDEX_NAME: str = "index.json"
+# Line-delimited variant of the index, written by `index --stream`.
+STREAMED_INDEX_NAME: str = "index.jsonl"
+# Memory-mappable variant of the index, written by `index --binary`.
+BINARY_INDEX_NAME: str = "index.bin"
+# Subtrees completed so far by an `index` run, for `index --resume`.
+CHECKPOINT_NAME: str = "index.checkpoint.jsonl"
+# Where the snapshots of a medium's index are kept, in its index directory.
+HISTORY_DIR_NAME: str = "history"
+PATH_SEPARATOR_REPLACEMENT: str = "+"
+# How often, in seconds, the checkpoint of an `index` run is synced to disk.
+CHECKPOINT_INTERVAL: float = 30.0
+# A snapshot of an index is stored in full, and not only as a delta, once this
+# many deltas have piled up since the last full one (or once they add up to
+# half as many entries as it has). Full snapshots are dropped once this many
+# newer ones are stored, except for the first.
+HISTORY_BASE_INTERVAL: int = 16
+HISTORY_KEEP_BASES: int = 4
+# Snapshots are compared sorted by path. Indexes are sorted in runs of this many
+# files, spilled to disk, so that recording one takes bounded memory.
+HISTORY_SORT_RUN: int = 1 << 17
+# `watch` writes the index once the medium has been quiet for this many
+# seconds, but no later than `WATCH_MAX_DELAY` seconds after the first change.
+WATCH_DEBOUNCE: float = 2.0
+WATCH_MAX_DELAY: float = 30.0
+# How often, in seconds, `watch` walks the medium where it can't use inotify.
+WATCH_POLL_INTERVAL: float = 60.0
+# How often, in seconds, `index --progress` reports how far it has got on a
+# terminal, and on anything else (e.g. a log file).
+PROGRESS_INTERVAL: float = 1.0
+PROGRESS_LINE_INTERVAL: float = 10.0
+# Left out of every index, ahead of the rules of the library; see `ExcludeRules`.
+# These are all names at the root of a medium, so that a walk without rules of
+# its own only has to check the entries of the root.
+DEFAULT_EXCLUDES: Tuple[str, ...] = ("/" + CHADOW_METADATA,)
+# Directory scans are I/O-bound and os.scandir releases the GIL while waiting
+# on the device, so a thread pool is enough to keep the medium busy.
+DEFAULT_INDEX_WORKERS: int = 8
+# Directories modified this recently (relative to the start of an index run)
+# are not fingerprinted, since a change landing in the same timestamp tick as
+# our scan would be invisible to the next run. Two seconds also covers the mtime
+# resolution of FAT-formatted media.
+FINGERPRINT_RACY_WINDOW_NS: int = 2 * 10 ** 9
+# Size in bytes of the content digests of directories.
+DIGEST_SIZE: int = 16
+# For the content comparator.
+CONTENT_HASH_ALGORITHM: str = "blake2b"
+HASH_CHUNK_SIZE: int = 1 << 20
+DEFAULT_HASH_WORKERS: int = 4
+HASH_CACHE_NAME: str = "hashes.json"
+# `sync` copies files in chunks of this many bytes, and at most this many files
+# at a time onto each disk.
+SYNC_CHUNK_SIZE: int = 16 << 20
+SYNC_WORKERS_PER_DEVICE: int = 2
+# `dupes` hashes this much of the start and of the end of files of the same
+# size, to tell most of them apart before hashing any of them whole.
+DUPES_BLOCK_SIZE: int = 64 * 1024
+# FAT only keeps modification times to two seconds, so copies onto it can't be
+# told apart any more finely than that by the size-mtime comparator.
+SIZE_MTIME_GRANULARITY_NS: int = 2 * 10 ** 9
+# Optional SQLite catalog of the config and of every index, in APP_ROOT.
+CATALOG_NAME: str = "catalog.db"
+
+@enum.unique
+class ExitCodes(enum.Enum):
+    """
+    Invalid config means there is something structurally wrong with the config.
+    For example, it is an invalid JSON document. Or when an expected field is
+    not present.
+    """
+    INVALID_CONFIG = 100
+    CONFIG_NOT_FOUND = 101
+    METADATA_NOT_FOUND = 102
+    """
+    State conflict means that although the config passed validation, there is
+    something _semantically_ wrong with it. For example, we are told to create
+    a key that already exists, or a user-defined key maps to an unexpected data
+    structure (list vs. dict).
+    """
+    STATE_CONFLICT = 103
+    INVALID_ARG = 104
+    PERMISSIONS_PROBLEM = 105
+    OS_ERROR = 106
+
+# Lists things that are NOT in this sector but are in other sectors.
+SectorDiffBin = List[
+    # 0 - the sector where this item can be found
+    # 1 - the actual item identifier
+    Tuple[str, str]
+]
+SectorDiffMapping = Dict[str, SectorDiffBin]
+# A file that a sector has as another item than another sector does, i.e., that
+# was moved or renamed on one of them.
+SectorMove = Tuple[
+    # 0 - the sector lacking the item
+    # 1 - the sector where the item can be found
+    # 2 - the item identifier
+    # 3 - the identifier of the same file in the sector lacking the item
+    str, str, str, str
+]
+# What tells a moved file apart: a key such as its size and mtime, and its
+# content hash if one is known.
+FileSignature = Tuple[Any, Optional[str]]
+
+class SectorComparisonReport(object):
+
+    def __init__(
+        self,
+        largest_sector: Optional[Tuple[str, int]],
+        smallest_sector: Optional[Tuple[str, int]],
+        # dict key is the name of the sector the diff bin is describing
+        diff_bins: Optional[SectorDiffMapping]
+    ):
+        self.largest_sector = largest_sector
+        self.smallest_sector = smallest_sector
+        self.diff_bins = diff_bins
+
+IndexItem = Union[str, "DirectoryIndex"]
+# (inode, mtime_ns) of a directory at the time it was scanned.
+DirectoryFingerprint = Tuple[int, int]
+# (size, mtime_ns, inode, kind) of a file as seen while indexing, where kind is
+# one of FILE_KINDS. Symlinks are not followed.
+FileStat = Tuple[int, int, int, str]
+FILE_KINDS: Dict[str, str] = {"f": "regular file", "l": "symlink", "o": "other"}
+# Stand-in kind for files that could not be stat'd, in packed stats.
+_NO_STAT_KIND: int = ord("-")
+
+def make_file_stat(file_stat: os.stat_result) -> FileStat:
+    if stat.S_ISREG(file_stat.st_mode):
+        kind = "f"
+    elif stat.S_ISLNK(file_stat.st_mode):
+        kind = "l"
+    else:
+        kind = "o"
+    return (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, kind)
+
+def _index_key(item: IndexItem) -> Tuple[int, str]:
+    """
+    Sort key giving the items of a directory a canonical order: files first,
+    then subdirectories, each by name.
+    """
+    if isinstance(item, DirectoryIndex):
+        if item.is_top_level:
+            raise Exception("Can't sort a top-level index.")
+        return (1, item.subdir_path or "")
+
+    return (0, item)
+
+def _load_file_stat(stored: Optional[List[Any]]) -> Optional[FileStat]:
+    if stored is None:
+        return None
+    size, mtime_ns, inode, kind = stored
+    return (size, mtime_ns, inode, kind)
+
+class DirectoryIndex(object):
+    """
+    The contents of a directory: the names of its files and a `DirectoryIndex`
+    for each of its subdirectories.
+
+    Media can hold millions of entries so this is kept compact. Instances have
+    no `__dict__` and all names are interned, so a filename that shows up in a
+    lot of directories (`IMG_0001.JPG`) is only stored once. While a directory
+    is being filled its items are kept in a set; `freeze` swaps that for a
+    sorted tuple once the directory is complete. Adding to a frozen index is
+    still allowed, it just thaws it first.
+
+    Every index also has a Merkle digest of its contents (see
+    `content_digest`), which is what equality and hashing go by. Frozen indices
+    compute it once and keep it, so comparing two trees only has to look inside
+    subtrees whose digests differ.
+
+    Files can carry a `FileStat`. These are kept in a dict while the index is
+    being filled and are packed into arrays lined up with the (sorted) files
+    once it is frozen. They are not part of the digest or of equality.
+    """
+
+    __slots__ = (
+        "version", "is_top_level", "subdir_path", "fingerprint", "_items", "_digest",
+        "_stats"
+    )
+
+    def __init__(
+        self,
+        subdir_path: Optional[str]=None,
+        is_top_level: bool=True,
+        version: Optional[str]=_CURRENT_VERSION
+    ) -> None:
+        if not is_top_level:
+            version = None
+        elif version is _CURRENT_VERSION:
+            version = get_version()
+        self.version: Optional[str] = version
+        # FIXME: Prevent acyclic structures
+        self._items: Union[Set[IndexItem], Tuple[IndexItem, ...]] = set()
+        self.is_top_level = is_top_level
+        self.subdir_path: Optional[str] = None
+        if not is_top_level and subdir_path is not None:
+            self.subdir_path = sys.intern(subdir_path)
+        # Not part of equality: two indices with the same contents are the same
+        # regardless of when (or whether) their directories were stat'd.
+        self.fingerprint: Optional[DirectoryFingerprint] = None
+        self._digest: Optional[str] = None
+        # Dict of name to stat while thawed. When frozen, a tuple of an array
+        # of (size, mtime_ns) pairs, an array of inodes and a bytes of kinds.
+        self._stats: Any = None
+
+    @property
+    def index(self) -> Iterable[IndexItem]:
+        """
+        The items in this directory. This is a set until the index is frozen and
+        a tuple afterwards, so treat it as read-only and use `add_to_index`.
+        """
+        return self._items
+
+    @property
+    def is_frozen(self) -> bool:
+        return isinstance(self._items, tuple)
+
+    def freeze(self) -> "DirectoryIndex":
+        if not isinstance(self._items, tuple):
+            self._items = tuple(sorted(self._items, key=_index_key))
+            if self._stats:
+                self._stats = self.__pack_stats(self._stats)
+            else:
+                self._stats = None
+        if self._digest is None:
+            self._digest = self.content_digest()
+        return self
+
+    def content_digest(self) -> str:
+        """
+        Hex digest over the names of this directory's files and the names and
+        digests of its subdirectories, in canonical order. It does not cover
+        the name of the directory itself (its parent's digest does) nor its
+        fingerprint, so two directories with the same contents anywhere on any
+        media have the same digest.
+        """
+        if self._digest is not None:
+            return self._digest
+
+        digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        for item in self.__sorted_items():
+            if isinstance(item, str):
+                digest.update(b"f")
+                digest.update(item.encode("utf-8", "surrogateescape"))
+                digest.update(b"\0")
+            else:
+                digest.update(b"d")
+                digest.update((item.subdir_path or "").encode("utf-8", "surrogateescape"))
+                digest.update(b"\0")
+                digest.update(bytes.fromhex(item.content_digest()))
+
+        hexdigest = digest.hexdigest()
+        # Unfrozen indices may still change, so only cache for frozen ones.
+        if self.is_frozen:
+            self._digest = hexdigest
+        return hexdigest
+
+    def __pack_stats(self, stats: Dict[str, FileStat]) -> Tuple[array.array, array.array, bytes]:
+        sizes_mtimes = array.array("q")
+        inodes = array.array("Q")
+        kinds = bytearray()
+        for item in self._items:
+            if not isinstance(item, str):
+                # Files sort first; everything from here on is a directory.
+                break
+
+            file_stat = stats.get(item)
+            if file_stat is None:
+                sizes_mtimes.extend((0, 0))
+                inodes.append(0)
+                kinds.append(_NO_STAT_KIND)
+            else:
+                size, mtime_ns, inode, kind = file_stat
+                sizes_mtimes.extend((size, mtime_ns))
+                inodes.append(inode)
+                kinds.append(ord(kind))
+        return sizes_mtimes, inodes, bytes(kinds)
+
+    def __unpack_stats(self) -> Dict[str, FileStat]:
+        if self._stats is None:
+            return {}
+        if isinstance(self._stats, dict):
+            return self._stats
+
+        stats: Dict[str, FileStat] = {}
+        sizes_mtimes, inodes, kinds = self._stats
+        for position, kind in enumerate(kinds):
+            if kind != _NO_STAT_KIND:
+                stats[self._items[position]] = (
+                    sizes_mtimes[2 * position], sizes_mtimes[2 * position + 1],
+                    inodes[position], chr(kind)
+                )
+        return stats
+
+    def file_stat(self, name: str) -> Optional[FileStat]:
+        """
+        The stat recorded for the file `name` in this directory, if any.
+        """
+        if self._stats is None:
+            return None
+        if isinstance(self._stats, dict):
+            return self._stats.get(name)
+
+        sizes_mtimes, inodes, kinds = self._stats
+        # The first len(kinds) items are the files, in sorted order.
+        position = bisect.bisect_left(self._items, name, 0, len(kinds))
+        if (
+            position < len(kinds) and self._items[position] == name and
+            kinds[position] != _NO_STAT_KIND
+        ):
+            return (
+                sizes_mtimes[2 * position], sizes_mtimes[2 * position + 1],
+                inodes[position], chr(kinds[position])
+            )
+        return None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __sorted_items(self) -> Tuple[IndexItem, ...]:
+        if isinstance(self._items, tuple):
+            return self._items
+        return tuple(sorted(self._items, key=_index_key))
+
+    def __eq__(self, other):
+        if not isinstance(other, DirectoryIndex):
+            return NotImplemented
+
+        return (
+            self.is_top_level == other.is_top_level and
+            self.subdir_path == other.subdir_path and
+            len(self._items) == len(other._items) and
+            self.content_digest() == other.content_digest()
+        )
+
+    def __hash__(self):
+        return hash((self.is_top_level, self.content_digest(), self.subdir_path))
+
+    def add_to_index(self, item: IndexItem, file_stat: Optional[FileStat]=None):
+        if item is not None:
+            items = self._items
+            if isinstance(items, tuple):
+                self._stats = self.__unpack_stats() or None
+                items = set(items)
+                self._items = items
+            self._digest = None
+            if isinstance(item, str):
+                item = sys.intern(item)
+                if file_stat is not None:
+                    if self._stats is None:
+                        self._stats = {}
+                    self._stats[item] = file_stat
+            items.add(item)
+        else:
+            logging.warning("Asked to index a None object!")
+
+    def remove_from_index(self, item: IndexItem) -> None:
+        items = self._items
+        if isinstance(items, tuple):
+            self._stats = self.__unpack_stats() or None
+            items = set(items)
+            self._items = items
+        self._digest = None
+        items.discard(item)
+        if isinstance(item, str) and self._stats is not None:
+            self._stats.pop(item, None)
+
+    def diff(
+        self, other: "DirectoryIndex"
+    ) -> Tuple[List[Tuple[str, ...]], List[Tuple[str, ...]]]:
+        """
+        Compare the contents of this index with `other`. Returns the paths (as
+        tuples of components) of the items only found here and of the items
+        only found in `other`. A subdirectory missing from one side is reported
+        once, by its own path.
+
+        Subtrees with matching digests are skipped without being looked into.
+        """
+        only_here: List[Tuple[str, ...]] = []
+        only_there: List[Tuple[str, ...]] = []
+        pending: List[Tuple[Tuple[str, ...], DirectoryIndex, DirectoryIndex]] = [
+            ((), self, other)
+        ]
+        while pending:
+            parts, here, there = pending.pop()
+            if here.content_digest() == there.content_digest():
+                continue
+
+            here_files, here_dirs = here.__split_items()
+            there_files, there_dirs = there.__split_items()
+            only_here.extend(parts + (name,) for name in here_files - there_files)
+            only_there.extend(parts + (name,) for name in there_files - here_files)
+            for name, subdir in here_dirs.items():
+                if name in there_dirs:
+                    pending.append((parts + (name,), subdir, there_dirs[name]))
+                else:
+                    only_here.append(parts + (name,))
+            only_there.extend(
+                parts + (name,) for name in there_dirs if name not in here_dirs
+            )
+
+        return only_here, only_there
+
+    def __iter_file_entries(self) -> Iterator[Tuple[Tuple[str, ...], "DirectoryIndex", str]]:
+        pending: List[Tuple[Tuple[str, ...], DirectoryIndex]] = [((), self)]
+        while pending:
+            parts, dir_index = pending.pop()
+            for item in dir_index._items:
+                if isinstance(item, DirectoryIndex):
+                    pending.append((parts + (item.subdir_path or "",), item))
+                else:
+                    yield parts, dir_index, item
+
+    def iter_files(self) -> Iterator[Tuple[Tuple[str, ...], str]]:
+        """
+        Every file under this index as a pair of the path components of its
+        directory (relative to this index) and its name.
+        """
+        for parts, _, name in self.__iter_file_entries():
+            yield parts, name
+
+    def iter_file_stats(self) -> Iterator[Tuple[Tuple[str, ...], str, Optional[FileStat]]]:
+        """
+        Like `iter_files`, along with the stat of each file if one was recorded.
+        """
+        for parts, dir_index, name in self.__iter_file_entries():
+            yield parts, name, dir_index.file_stat(name)
+
+    def __split_items(self) -> Tuple[Set[str], Dict[str, "DirectoryIndex"]]:
+        files: Set[str] = set()
+        dirs: Dict[str, DirectoryIndex] = {}
+        for item in self._items:
+            if isinstance(item, DirectoryIndex):
+                dirs[item.subdir_path or ""] = item
+            else:
+                files.add(item)
+        return files, dirs
+
+    def __header_dict(self) -> Dict[str, Any]:
+        """
+        Everything in the dict representation of this index except for its
+        contents.
+        """
+        dict_rep: Dict[str, Any] = {}
+        if self.is_top_level:
+            dict_rep["version"] = self.version
+        elif self.subdir_path is not None:
+            dict_rep["subdir_path"] = self.subdir_path
+        else:
+            # This should never happen but we are tolerant about it
+            logging.warning("None passed as subdirectory name. Coercing to blank (which is still unacceptable)!")
+            dict_rep["subdir_path"] = ""
+        
+        if self.fingerprint is not None:
+            dict_rep["fingerprint"] = list(self.fingerprint)
+        if self._digest is not None:
+            dict_rep["digest"] = self._digest
+        stats = self.__unpack_stats()
+        if stats:
+            dict_rep["stats"] = {name: list(file_stat) for name, file_stat in stats.items()}
+
+        return dict_rep
+
+    def to_json(self) -> str:
+        json_rep = io.StringIO()
+        self.write_json(json_rep)
+        return json_rep.getvalue()
+
+    def write_json(self, fp: IO[str]) -> None:
+        """
+        Write the same document as `to_json` to `fp` an item at a time, without
+        building the dict representation or the whole string in memory first.
+        """
+        stack: List[Iterator[IndexItem]] = [iter((self,))]
+        separators: List[str] = [""]
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                separators.pop()
+                if stack:
+                    fp.write("]}")
+                continue
+
+            fp.write(separators[-1])
+            separators[-1] = ", "
+            if isinstance(item, str):
+                fp.write(json.dumps(item))
+            else:
+                # Reopen the header object to splice the index list into it.
+                fp.write(json.dumps(item.__header_dict())[:-1])
+                fp.write(', "index": [')
+                stack.append(iter(item.index))
+                separators.append("")
+    
+    @staticmethod
+    def construct_from_dict(d: Dict, dirpath: Optional[str]=None) -> "DirectoryIndex":
+        # Iterative, so that deep trees don't run into the recursion limit.
+        # Each frame is a dict to build, its name and the index of its parent.
+        frames: List[Tuple[Dict, Optional[str], Optional[DirectoryIndex]]] = [(d, dirpath, None)]
+        built: List[Tuple[DirectoryIndex, Optional[DirectoryIndex], Optional[str]]] = []
+        root = None
+        while frames:
+            dict_rep, name, parent = frames.pop()
+            index = DirectoryIndex(
+                version=dict_rep.get("version"),
+                subdir_path=dict_rep.get("subdir_path") or name,
+                is_top_level=dict_rep.get("version") is not None
+            )
+            if root is None:
+                root = index
+            if dict_rep.get("fingerprint") is not None:
+                inode, mtime_ns = dict_rep["fingerprint"]
+                index.fingerprint = (inode, mtime_ns)
+            stats = dict_rep.get("stats") or {}
+
+            for item in dict_rep["index"]:
+                if isinstance(item, str):
+                    index.add_to_index(item, _load_file_stat(stats.get(item)))
+                else:
+                    frames.append((item, None, index))
+
+            built.append((index, parent, dict_rep.get("digest")))
+
+        # Every index was built after its parent, so going backwards freezes
+        # children before they are put in their parent's set.
+        for index, parent, digest in reversed(built):
+            # Trust the stored digest rather than rehashing the whole subtree.
+            index._digest = digest
+            index.freeze()
+            if parent is not None:
+                parent.add_to_index(index)
+
+        return root
+
+    @staticmethod
+    def construct_from_records(records: Iterable[str]) -> "DirectoryIndex":
+        """
+        Build an index from the line-delimited records written by
+        `StreamingIndexWriter`.
+        """
+        lines = iter(records)
+        header = json.loads(next(lines))
+        root = DirectoryIndex(version=header.get("version"), is_top_level=True)
+        nodes: Dict[Tuple[str, ...], DirectoryIndex] = {(): root}
+
+        for line in lines:
+            if not line.strip():
+                continue
+
+            record = json.loads(line)
+            parts = tuple(record["path"])
+            nodes[parts] = _load_directory_record(record, root if not parts else None)
+
+        _link_directories(nodes)
+        return root
+
+class StreamingIndexWriter(object):
+    """
+    Writes an index as line-delimited JSON while the medium is being walked.
+
+    The first line holds the version. Every line after that describes one
+    directory: its `path` (as a list of components from the root of the
+    medium), its `fingerprint` if it has one, the files in its `index` and
+    their `stats`.
+    Subdirectories are not listed since they get lines of their own. Use it as
+    the `sink` of a `MediaWalker`.
+    """
+
+    def __init__(
+        self, fp: IO[str], version: Optional[str]=_CURRENT_VERSION, echo: bool=False
+    ) -> None:
+        self.fp = fp
+        self.echo = echo
+        self.__emit({"version": get_version() if version is _CURRENT_VERSION else version})
+
+    def __emit(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record)
+        self.fp.write(line)
+        self.fp.write("\n")
+        if self.echo:
+            click.echo(line)
+
+    def __call__(self, parts: Tuple[str, ...], dir_index: DirectoryIndex) -> None:
+        self.__emit(_directory_record(parts, dir_index))
+
+def _directory_record(parts: Tuple[str, ...], dir_index: DirectoryIndex) -> Dict[str, Any]:
+    """
+    The line-delimited record of a directory, without its subdirectories.
+    """
+    record: Dict[str, Any] = {"path": list(parts)}
+    if dir_index.fingerprint is not None:
+        record["fingerprint"] = list(dir_index.fingerprint)
+    record["index"] = [item for item in dir_index.index if isinstance(item, str)]
+    stats = {
+        name: list(file_stat) for name, file_stat in (
+            (name, dir_index.file_stat(name)) for name in record["index"]
+        ) if file_stat is not None
+    }
+    if stats:
+        record["stats"] = stats
+    return record
+
+def _load_directory_record(
+    record: Dict[str, Any], node: Optional[DirectoryIndex]=None
+) -> DirectoryIndex:
+    """
+    Fill in `node` (by default, a new subdirectory named after the last
+    component of the record's path) from a record made by `_directory_record`.
+    """
+    if node is None:
+        node = DirectoryIndex(record["path"][-1], is_top_level=False)
+    if record.get("fingerprint") is not None:
+        inode, mtime_ns = record["fingerprint"]
+        node.fingerprint = (inode, mtime_ns)
+    stats = record.get("stats") or {}
+    for _file in record["index"]:
+        node.add_to_index(_file, _load_file_stat(stats.get(_file)))
+    return node
+
+def _link_directories(nodes: Dict[Tuple[str, ...], DirectoryIndex]) -> None:
+    """
+    Freeze every directory and put it in its parent's index, where its parent
+    is among `nodes`. Deepest first, so that every directory is complete by the
+    time it is put in its parent's set.
+    """
+    for parts in sorted(nodes, key=len, reverse=True):
+        nodes[parts].freeze()
+        if parts and parts[:-1] in nodes:
+            nodes[parts[:-1]].add_to_index(nodes[parts])
+
+def iter_record_file_stats(
+    records: Iterable[str]
+) -> Iterator[Tuple[Tuple[str, ...], str, Optional[FileStat]]]:
+    """
+    Like `DirectoryIndex.iter_file_stats`, from the records written by
+    `StreamingIndexWriter` and without building the index.
+    """
+    lines = iter(records)
+    next(lines)
+    for line in lines:
+        if not line.strip():
+            continue
+
+        record = json.loads(line)
+        parts = tuple(record["path"])
+        stats = record.get("stats") or {}
+        for name in record["index"]:
+            yield parts, name, _load_file_stat(stats.get(name))
+
+def update_files(
+    root: DirectoryIndex,
+    added: Iterable[Tuple[Tuple[str, ...], str, Optional[FileStat]]],
+    removed: Iterable[Tuple[Tuple[str, ...], str]]=()
+) -> None:
+    """
+    Add files to an index and remove others from it, in place. The directories
+    of the files added are created where missing. The directories whose
+    entries change lose their fingerprints, since their mtimes changed after
+    they were stat'd.
+    """
+    nodes: Dict[Tuple[str, ...], DirectoryIndex] = {(): root}
+    subdirs: Dict[Tuple[str, ...], Dict[str, DirectoryIndex]] = {}
+
+    def node_at(parts: Tuple[str, ...], create: bool) -> Optional[DirectoryIndex]:
+        for depth in range(1, len(parts) + 1):
+            path = parts[:depth]
+            if path in nodes:
+                continue
+            parent = nodes[path[:-1]]
+            if path[:-1] not in subdirs:
+                subdirs[path[:-1]] = {
+                    item.subdir_path or "": item
+                    for item in parent.index if isinstance(item, DirectoryIndex)
+                }
+            node = subdirs[path[:-1]].get(path[-1])
+            if node is None:
+                if not create:
+                    return None
+                node = DirectoryIndex(path[-1], is_top_level=False)
+                parent.fingerprint = None
+            else:
+                # Taken out while it changes, since its parent goes by its digest.
+                parent.remove_from_index(node)
+            nodes[path] = node
+        return nodes[parts]
+
+    for parts, name in removed:
+        node = node_at(parts, False)
+        if node is not None:
+            node.remove_from_index(name)
+            node.fingerprint = None
+    for parts, name, file_stat in added:
+        node = node_at(parts, True)
+        assert node is not None
+        node.add_to_index(name, file_stat)
+        node.fingerprint = None
+
+    _link_directories(nodes)
+
+class _BinaryIndexFormat(object):
+    """
+    Layout of `index.bin`. All integers are little-endian.
+
+    - A header (`HEADER`) with the magic, the format version and the number
+      and offsets of everything below.
+    - One fixed-width record (`NODE`) per directory, root first, in
+      breadth-first order. The subdirectories of a directory are therefore a
+      contiguous run of records, given by the index of the first one and their
+      count. A record also holds the directory's name (the root holds the
+      chadow version instead), its fingerprint, its digest and the run of file
+      records that belong to it.
+    - One fixed-width record (`FILE`) per file: its name and its stat (kind
+      `-` if it has none).
+    - The string table: `string_count + 1` offsets into a blob of UTF-8
+      strings, each string being the bytes between consecutive offsets. Every
+      name is stored only once.
+
+    Files and subdirectories are sorted within each directory so that a name
+    can be found with a binary search.
+    """
+    MAGIC = b"CHDWIDX\x00"
+    VERSION = 1
+    # magic, format version, reserved, node count, file count, string count,
+    # nodes offset, files offset, string offsets offset
+    HEADER = struct.Struct("<8sIIQQQQQQ")
+    # name, flags, fingerprint inode, fingerprint mtime_ns, digest, first file,
+    # file count, first child, child count
+    NODE = struct.Struct("<IIQq16sIIII")
+    # name, kind, size, mtime_ns, inode
+    FILE = struct.Struct("<IB3xQqQ")
+    STRING_OFFSET = struct.Struct("<Q")
+    HAS_FINGERPRINT = 1
+
+def _encode_name(name: str) -> bytes:
+    return name.encode("utf-8", "surrogateescape")
+
+def write_binary_index(root: DirectoryIndex, fp: BinaryIO) -> None:
+    """
+    Write `root` to `fp` in the `index.bin` format (see `_BinaryIndexFormat`).
+    """
+    fmt = _BinaryIndexFormat
+    string_ids: Dict[str, int] = {}
+    strings: List[str] = []
+
+    def string_id(string: str) -> int:
+        if string not in string_ids:
+            string_ids[string] = len(strings)
+            strings.append(string)
+        return string_ids[string]
+
+    nodes: List[DirectoryIndex] = [root.freeze()]
+    node_records: List[bytes] = []
+    file_count = 0
+    position = 0
+    while position < len(nodes):
+        node = nodes[position]
+        position += 1
+        files = [item for item in node.index if isinstance(item, str)]
+        subdirs = [item.freeze() for item in node.index if isinstance(item, DirectoryIndex)]
+        for _file in files:
+            string_id(_file)
+
+        inode, mtime_ns = node.fingerprint or (0, 0)
+        node_records.append(fmt.NODE.pack(
+            string_id(
+                (node.version or "") if node is root else (node.subdir_path or "")
+            ),
+            fmt.HAS_FINGERPRINT if node.fingerprint is not None else 0,
+            inode, mtime_ns,
+            bytes.fromhex(node.content_digest()),
+            file_count, len(files),
+            len(nodes), len(subdirs)
+        ))
+        file_count += len(files)
+        nodes.extend(subdirs)
+
+    encoded = [_encode_name(string) for string in strings]
+    nodes_offset = fmt.HEADER.size
+    files_offset = nodes_offset + len(node_records) * fmt.NODE.size
+    strings_offset = files_offset + file_count * fmt.FILE.size
+    fp.write(fmt.HEADER.pack(
+        fmt.MAGIC, fmt.VERSION, 0, len(node_records), file_count, len(strings),
+        nodes_offset, files_offset, strings_offset
+    ))
+    for record in node_records:
+        fp.write(record)
+    del node_records
+
+    for node in nodes:
+        for item in node.index:
+            if not isinstance(item, str):
+                # Files sort first.
+                break
+            file_stat = node.file_stat(item)
+            if file_stat is None:
+                fp.write(fmt.FILE.pack(string_ids[item], _NO_STAT_KIND, 0, 0, 0))
+            else:
+                size, mtime_ns, inode, kind = file_stat
+                fp.write(fmt.FILE.pack(string_ids[item], ord(kind), size, mtime_ns, inode))
+
+    offset = 0
+    for string in encoded:
+        fp.write(fmt.STRING_OFFSET.pack(offset))
+        offset += len(string)
+    fp.write(fmt.STRING_OFFSET.pack(offset))
+    for string in encoded:
+        fp.write(string)
+
+class MappedDirectory(object):
+    """
+    A directory in a `MappedIndex`. Nothing is read from the index until it is
+    asked for.
+    """
+
+    __slots__ = ("mapped_index", "node", "parts")
+
+    def __init__(self, mapped_index: "MappedIndex", node: int, parts: Tuple[str, ...]) -> None:
+        self.mapped_index = mapped_index
+        self.node = node
+        self.parts = parts
+
+    def __record(self) -> Tuple[Any, ...]:
+        return self.mapped_index._node_record(self.node)
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.parts[-1] if self.parts else None
+
+    @property
+    def fingerprint(self) -> Optional[DirectoryFingerprint]:
+        _, flags, inode, mtime_ns = self.__record()[:4]
+        if flags & _BinaryIndexFormat.HAS_FINGERPRINT:
+            return (inode, mtime_ns)
+        return None
+
+    def content_digest(self) -> str:
+        return self.__record()[4].hex()
+
+    def files(self) -> Iterator[str]:
+        _, _, _, _, _, first_file, file_count, _, _ = self.__record()
+        for position in range(first_file, first_file + file_count):
+            yield self.mapped_index._file_name(position)
+
+    def subdirs(self) -> Iterator["MappedDirectory"]:
+        _, _, _, _, _, _, _, first_child, child_count = self.__record()
+        for node in range(first_child, first_child + child_count):
+            yield MappedDirectory(
+                self.mapped_index, node, self.parts + (self.mapped_index._node_name(node),)
+            )
+
+    def file_stat(self, name: str) -> Optional[FileStat]:
+        _, _, _, _, _, first_file, file_count, _, _ = self.__record()
+        position = self.mapped_index._search(
+            first_file, file_count, name, self.mapped_index._file_name
+        )
+        if position is None:
+            return None
+        return self.mapped_index._file_stat(position)
+
+    def subdir(self, name: str) -> Optional["MappedDirectory"]:
+        _, _, _, _, _, _, _, first_child, child_count = self.__record()
+        node = self.mapped_index._search(
+            first_child, child_count, name, self.mapped_index._node_name
+        )
+        if node is None:
+            return None
+        return MappedDirectory(self.mapped_index, node, self.parts + (name,))
+
+class MappedIndex(object):
+    """
+    Read-only view of an `index.bin` file through `mmap`, so that looking
+    something up or walking a subtree only pages in the parts of the file it
+    needs. Has the same `iter_files` and `iter_file_stats` as `DirectoryIndex`
+    so that comparators can use either.
+    """
+
+    def __init__(self, filename: str) -> None:
+        fmt = _BinaryIndexFormat
+        with open(filename, "rb") as index_file:
+            self.__map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.__map) < fmt.HEADER.size:
+            self.close()
+            raise ValueError("%s is too short to be a binary index." % filename)
+        (
+            magic, version, _, self.node_count, self.file_count, self.string_count,
+            self.__nodes_offset, self.__files_offset, self.__strings_offset
+        ) = fmt.HEADER.unpack_from(self.__map, 0)
+        if magic != fmt.MAGIC or version != fmt.VERSION:
+            self.close()
+            raise ValueError("%s is not a version %d binary index." % (filename, fmt.VERSION))
+        self.__blob_offset = (
+            self.__strings_offset + (self.string_count + 1) * fmt.STRING_OFFSET.size
+        )
+
+    def close(self) -> None:
+        self.__map.close()
+
+    def __enter__(self) -> "MappedIndex":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _string(self, string_id: int) -> str:
+        start, end = struct.unpack_from(
+            "<QQ", self.__map,
+            self.__strings_offset + string_id * _BinaryIndexFormat.STRING_OFFSET.size
+        )
+        return self.__map[
+            self.__blob_offset + start:self.__blob_offset + end
+        ].decode("utf-8", "surrogateescape")
+
+    def _node_record(self, node: int) -> Tuple[Any, ...]:
+        return _BinaryIndexFormat.NODE.unpack_from(
+            self.__map, self.__nodes_offset + node * _BinaryIndexFormat.NODE.size
+        )
+
+    def _node_name(self, node: int) -> str:
+        return self._string(self._node_record(node)[0])
+
+    def __file_record(self, position: int) -> Tuple[Any, ...]:
+        return _BinaryIndexFormat.FILE.unpack_from(
+            self.__map, self.__files_offset + position * _BinaryIndexFormat.FILE.size
+        )
+
+    def _file_name(self, position: int) -> str:
+        return self._string(self.__file_record(position)[0])
+
+    def _file_stat(self, position: int) -> Optional[FileStat]:
+        _, kind, size, mtime_ns, inode = self.__file_record(position)
+        if kind == _NO_STAT_KIND:
+            return None
+        return (size, mtime_ns, inode, chr(kind))
+
+    @staticmethod
+    def _search(
+        first: int, count: int, name: str, name_at: Callable[[int], str]
+    ) -> Optional[int]:
+        low, high = first, first + count
+        while low < high:
+            middle = (low + high) // 2
+            if name_at(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < first + count and name_at(low) == name:
+            return low
+        return None
+
+    @property
+    def version(self) -> str:
+        return self._node_name(0)
+
+    def root(self) -> MappedDirectory:
+        return MappedDirectory(self, 0, ())
+
+    def lookup(self, parts: Iterable[str]) -> Optional[MappedDirectory]:
+        """
+        The directory at the given path components, relative to the root.
+        """
+        directory: Optional[MappedDirectory] = self.root()
+        for part in parts:
+            if directory is None:
+                break
+            directory = directory.subdir(part)
+        return directory
+
+    def iter_files(self, under: Optional[MappedDirectory]=None) -> Iterator[Tuple[Tuple[str, ...], str]]:
+        for parts, name, _ in self.iter_file_stats(under):
+            yield parts, name
+
+    def iter_file_stats(
+        self, under: Optional[MappedDirectory]=None
+    ) -> Iterator[Tuple[Tuple[str, ...], str, Optional[FileStat]]]:
+        pending = [under or self.root()]
+        while pending:
+            directory = pending.pop()
+            _, _, _, _, _, first_file, file_count, _, _ = self._node_record(directory.node)
+            for position in range(first_file, first_file + file_count):
+                yield directory.parts, self._file_name(position), self._file_stat(position)
+            pending.extend(directory.subdirs())
+
+    def to_directory_index(self) -> DirectoryIndex:
+        """
+        Load the whole index into a `DirectoryIndex`.
+        """
+        built: Dict[int, DirectoryIndex] = {}
+        # Breadth-first order puts every child after its parent, so going
+        # backwards builds every directory before it is needed.
+        for node in range(self.node_count - 1, -1, -1):
+            name_id, flags, inode, mtime_ns, digest, first_file, file_count, first_child, child_count = self._node_record(node)
+            dir_index = (
+                DirectoryIndex(version=self._string(name_id), is_top_level=True)
+                if node == 0 else
+                DirectoryIndex(self._string(name_id), is_top_level=False)
+            )
+            if flags & _BinaryIndexFormat.HAS_FINGERPRINT:
+                dir_index.fingerprint = (inode, mtime_ns)
+            for position in range(first_file, first_file + file_count):
+                dir_index.add_to_index(self._file_name(position), self._file_stat(position))
+            for child in range(first_child, first_child + child_count):
+                dir_index.add_to_index(built.pop(child))
+            dir_index._digest = digest.hex()
+            built[node] = dir_index.freeze()
+
+        return built[0]
+
+# Tokens of the JSON written by `DirectoryIndex.write_json`, for `LazyIndex`.
+_JSON_SEPARATORS = re.compile(rb"[\s,:]*")
+_JSON_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_JSON_SCALAR = re.compile(rb"[^\s,:\]}]+")
+# A run of anything that does not open or close a string, object or array.
+_JSON_FLAT = re.compile(rb'[^"{}\[\]]*')
+
+def _json_token(pattern: "re.Pattern[bytes]", buf: Any, pos: int) -> int:
+    """
+    The end of the token matching `pattern` at `pos` in `buf`.
+    """
+    match = pattern.match(buf, pos)
+    if match is None or match.end() == pos:
+        raise ValueError("Malformed index at byte %d." % pos)
+    return match.end()
+
+def _read_json_string(buf: Any, pos: int) -> Tuple[str, int]:
+    end = _json_token(_JSON_STRING, buf, pos)
+    token = buf[pos:end]
+    if b"\\" not in token:
+        # Nothing to unescape.
+        return token[1:-1].decode("utf-8"), end
+    return json.loads(token), end
+
+def _skip_json_value(buf: Any, pos: int) -> int:
+    """
+    The end of the JSON value starting at `pos` in `buf`, found by counting
+    brackets rather than parsing, so that nested values of any depth are
+    skipped at the cost of a regex match per string in them.
+    """
+    opener = buf[pos:pos + 1]
+    if opener == b'"':
+        return _json_token(_JSON_STRING, buf, pos)
+    if opener not in (b"{", b"["):
+        return _json_token(_JSON_SCALAR, buf, pos)
+
+    depth = 0
+    while True:
+        pos = _JSON_FLAT.match(buf, pos).end()
+        token = buf[pos:pos + 1]
+        if token == b'"':
+            pos = _json_token(_JSON_STRING, buf, pos)
+        elif token in (b"{", b"["):
+            depth += 1
+            pos += 1
+        elif token in (b"}", b"]"):
+            depth -= 1
+            pos += 1
+            if depth == 0:
+                return pos
+        else:
+            raise ValueError("Unterminated value in index at byte %d." % pos)
+
+_JSON_DECODER = json.JSONDecoder()
+# How much of the index is decoded at first to read a value in it.
+_JSON_WINDOW = 1 << 16
+
+def _read_json_value(buf: Any, pos: int) -> Tuple[Any, int]:
+    """
+    Decode the JSON value starting at `pos` in `buf`, and return it with its
+    end. Indexes are written in ASCII, so this decodes a window of the buffer
+    at a time with the C decoder, growing it until the value fits.
+    """
+    size = _JSON_WINDOW
+    while True:
+        window = buf[pos:pos + size]
+        if not window.isascii():
+            break
+        complete = pos + size >= len(buf)
+        try:
+            value, length = _JSON_DECODER.raw_decode(window.decode("ascii"))
+            # A number cut off by the window would still decode.
+            if length < len(window) or complete:
+                return value, pos + length
+        except json.JSONDecodeError:
+            if complete:
+                raise ValueError("Malformed index at byte %d." % pos)
+        size *= 4
+
+    end = _skip_json_value(buf, pos)
+    return json.loads(buf[pos:end]), end
+
+class LazyDirectory(object):
+    """
+    A directory in a `LazyIndex`. Its own entry is parsed the first time it
+    is asked about, and its subdirectories only once they are asked about in
+    turn.
+    """
+
+    __slots__ = ("lazy_index", "start", "parts", "__header", "__files", "__subdirs")
+
+    def __init__(self, lazy_index: "LazyIndex", start: int, parts: Tuple[str, ...]) -> None:
+        self.lazy_index = lazy_index
+        self.start = start
+        self.parts = parts
+        self.__header: Optional[Dict[str, Any]] = None
+        self.__files: List[str] = []
+        self.__subdirs: Dict[str, LazyDirectory] = {}
+
+    def __load(self) -> Dict[str, Any]:
+        if self.__header is not None:
+            return self.__header
+
+        buf = self.lazy_index._buffer
+        header: Dict[str, Any] = {}
+        pos = self.lazy_index._read_keys(self.start + 1, header)
+        while buf[pos:pos + 1] != b"}":
+            # At the index: skip over its key to the first item.
+            _, pos = _read_json_string(buf, pos)
+            pos = _JSON_SEPARATORS.match(buf, pos).end()
+            pos = _JSON_SEPARATORS.match(buf, pos + 1).end()
+            while buf[pos:pos + 1] != b"]":
+                if buf[pos:pos + 1] == b"{":
+                    name = self.lazy_index._subdir_name(pos)
+                    self.__subdirs[name] = LazyDirectory(
+                        self.lazy_index, pos, self.parts + (name,)
+                    )
+                    pos = _skip_json_value(buf, pos)
+                else:
+                    name, pos = _read_json_string(buf, pos)
+                    self.__files.append(name)
+                pos = _JSON_SEPARATORS.match(buf, pos).end()
+            pos = self.lazy_index._read_keys(pos + 1, header)
+
+        self.__header = header
+        return header
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.parts[-1] if self.parts else None
+
+    @property
+    def fingerprint(self) -> Optional[DirectoryFingerprint]:
+        fingerprint = self.__load().get("fingerprint")
+        if fingerprint is None:
+            return None
+        inode, mtime_ns = fingerprint
+        return (inode, mtime_ns)
+
+    def content_digest(self) -> str:
+        digest = self.__load().get("digest")
+        if digest is None:
+            # Indexes written before digests were stored.
+            digest = self.lazy_index.to_directory_index(self).content_digest()
+        return digest
+
+    def files(self) -> Iterator[str]:
+        self.__load()
+        return iter(self.__files)
+
+    def subdirs(self) -> Iterator["LazyDirectory"]:
+        self.__load()
+        return iter(self.__subdirs.values())
+
+    def file_stat(self, name: str) -> Optional[FileStat]:
+        return _load_file_stat((self.__load().get("stats") or {}).get(name))
+
+    def subdir(self, name: str) -> Optional["LazyDirectory"]:
+        self.__load()
+        return self.__subdirs.get(name)
+
+class LazyIndex(object):
+    """
+    Read-only view of an `index.json` that parses only what is asked of it,
+    so that looking something up costs memory in proportion to the
+    directories along the way rather than to the whole index. Walking all of
+    it (`iter_files`, `iter_file_stats`, `to_directory_index`) is done in a
+    single pass that holds on to just the directories along the current path.
+
+    Nothing here recurses, so unlike `json.load` it copes with trees of any
+    depth. Has the same interface as `MappedIndex`.
+    """
+
+    def __init__(self, filename: str) -> None:
+        with open(filename, "rb") as index_file:
+            self._buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.__root_start = _JSON_SEPARATORS.match(self._buffer, 0).end()
+        if self._buffer[self.__root_start:self.__root_start + 1] != b"{":
+            self.close()
+            raise ValueError("%s is not a JSON index." % filename)
+        self.__root = LazyDirectory(self, self.__root_start, ())
+
+    def close(self) -> None:
+        self._buffer.close()
+
+    def __enter__(self) -> "LazyIndex":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _subdir_name(self, start: int) -> str:
+        """
+        The name of the directory whose entry starts at `start`, read from its
+        header without parsing the rest of it.
+        """
+        buf = self._buffer
+        pos = _JSON_SEPARATORS.match(buf, start + 1).end()
+        while buf[pos:pos + 1] != b"}":
+            key, pos = _read_json_string(buf, pos)
+            pos = _JSON_SEPARATORS.match(buf, pos).end()
+            if key == "subdir_path":
+                name, _ = _read_json_string(buf, pos)
+                return name
+            pos = _JSON_SEPARATORS.match(buf, _skip_json_value(buf, pos)).end()
+        return ""
+
+    def _read_keys(self, pos: int, header: Dict[str, Any]) -> int:
+        """
+        Read the keys of a directory entry from `pos` into `header`, up to its
+        index or its end. Returns where the index key (or the end) is.
+        """
+        buf = self._buffer
+        pos = _JSON_SEPARATORS.match(buf, pos).end()
+        while buf[pos:pos + 1] != b"}":
+            key, key_end = _read_json_string(buf, pos)
+            if key == "index":
+                break
+            value_start = _JSON_SEPARATORS.match(buf, key_end).end()
+            header[key], end = _read_json_value(buf, value_start)
+            pos = _JSON_SEPARATORS.match(buf, end).end()
+        return pos
+
+    @property
+    def version(self) -> Optional[str]:
+        header: Dict[str, Any] = {}
+        self._read_keys(self.__root_start + 1, header)
+        return header.get("version")
+
+    def root(self) -> LazyDirectory:
+        return self.__root
+
+    def lookup(self, parts: Iterable[str]) -> Optional[LazyDirectory]:
+        """
+        The directory at the given path components, relative to the root.
+        """
+        directory: Optional[LazyDirectory] = self.root()
+        for part in parts:
+            if directory is None:
+                break
+            directory = directory.subdir(part)
+        return directory
+
+    def __iter_directories(
+        self, under: Optional[LazyDirectory]=None
+    ) -> Iterator[Tuple[Tuple[str, ...], Dict[str, Any], List[str]]]:
+        """
+        Every directory under `under` (by default, the root) as its path
+        components, its header and its files, children before their parents.
+        """
+        buf = self._buffer
+        top = under or self.root()
+        # Each frame is a directory being read: its path components, header
+        # and files so far, and whether we are in its index.
+        stack: List[Tuple[Tuple[str, ...], Dict[str, Any], List[str], List[bool]]] = [
+            (top.parts, {}, [], [False])
+        ]
+        pos = _JSON_SEPARATORS.match(buf, top.start + 1).end()
+        while stack:
+            parts, header, files, in_index = stack[-1]
+            token = buf[pos:pos + 1]
+            if in_index[0]:
+                if token == b"]":
+                    in_index[0] = False
+                    pos += 1
+                elif token == b"{":
+                    stack.append(((), {}, [], [False]))
+                    pos += 1
+                else:
+                    name, pos = _read_json_string(buf, pos)
+                    files.append(name)
+            elif token == b"}":
+                stack.pop()
+                pos += 1
+                yield parts, header, files
+            else:
+                key, pos = _read_json_string(buf, pos)
+                pos = _JSON_SEPARATORS.match(buf, pos).end()
+                if key == "index":
+                    if buf[pos:pos + 1] != b"[":
+                        raise ValueError("Malformed index at byte %d." % pos)
+                    in_index[0] = True
+                    pos += 1
+                    if len(stack) > 1 and not parts:
+                        # Entries name themselves ahead of their index.
+                        parent_parts = stack[-2][0]
+                        stack[-1] = (
+                            parent_parts + (header.get("subdir_path") or "",),
+                            header, files, in_index
+                        )
+                else:
+                    header[key], pos = _read_json_value(buf, pos)
+            pos = _JSON_SEPARATORS.match(buf, pos).end()
+
+    def iter_files(self, under: Optional[LazyDirectory]=None) -> Iterator[Tuple[Tuple[str, ...], str]]:
+        for parts, _, files in self.__iter_directories(under):
+            for name in files:
+                yield parts, name
+
+    def iter_file_stats(
+        self, under: Optional[LazyDirectory]=None
+    ) -> Iterator[Tuple[Tuple[str, ...], str, Optional[FileStat]]]:
+        for parts, header, files in self.__iter_directories(under):
+            stats = header.get("stats") or {}
+            for name in files:
+                yield parts, name, _load_file_stat(stats.get(name))
+
+    def to_directory_index(self, under: Optional[LazyDirectory]=None) -> DirectoryIndex:
+        """
+        Load the index (or the subtree `under`) into a `DirectoryIndex`.
+        """
+        top_parts = (under or self.root()).parts
+        # Children come out before their parents, and wait here for them.
+        children: Dict[Tuple[str, ...], List[DirectoryIndex]] = {}
+        dir_index = None
+        for parts, header, files in self.__iter_directories(under):
+            dir_index = DirectoryIndex(
+                version=header.get("version"),
+                subdir_path=header.get("subdir_path") or (parts[-1] if parts else None),
+                is_top_level=header.get("version") is not None
+            )
+            if header.get("fingerprint") is not None:
+                inode, mtime_ns = header["fingerprint"]
+                dir_index.fingerprint = (inode, mtime_ns)
+            stats = header.get("stats") or {}
+            for name in files:
+                dir_index.add_to_index(name, _load_file_stat(stats.get(name)))
+            for child in children.pop(parts, ()):
+                dir_index.add_to_index(child)
+            # Trust the stored digest rather than rehashing the whole subtree.
+            dir_index._digest = header.get("digest")
+            dir_index.freeze()
+            if parts != top_parts:
+                children.setdefault(parts[:-1], []).append(dir_index)
+
+        if dir_index is None:
+            raise ValueError("Empty index.")
+        return dir_index
+
+def _translate_exclude(pattern: str) -> str:
+    """
+    The regular expression for a gitignore-style glob: `*` and `?` stay within
+    a path component, `[...]` is a character class (negated with `!` or `^`),
+    `**` spans any number of components and a backslash escapes what follows.
+    """
+    parts: List[str] = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+            continue
+        elif char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            members = pattern[i + 1:end]
+            if members[0] in "!^":
+                members = "^" + members[1:]
+            parts.append("[%s]" % members.replace("\\", "\\\\"))
+            i = end
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return "".join(parts)
+
+class _ExcludeGroup(object):
+    """
+    A run of consecutive rules of the same kind (excluding or re-including),
+    compiled together. Rules without a slash are matched against names, the
+    rest against paths from the root of the medium. Names without wildcards are
+    looked up in sets, and everything else goes into one regular expression per
+    kind of rule, so a group costs at most a few lookups and matches however
+    many rules it has.
+    """
+
+    def __init__(self, negated: bool) -> None:
+        self.negated = negated
+        self.names: Set[str] = set()
+        self.dir_names: Set[str] = set()
+        # Expressions for names, names of directories only, paths and paths of
+        # directories only.
+        self.sources: Tuple[List[str], ...] = ([], [], [], [])
+        self.expressions: List[Optional["re.Pattern[str]"]] = [None] * 4
+
+    def add(self, pattern: str, dir_only: bool) -> None:
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        if not anchored and not any(char in pattern for char in "*?[\\"):
+            (self.dir_names if dir_only else self.names).add(pattern)
+        else:
+            self.sources[2 * anchored + dir_only].append(_translate_exclude(pattern))
+
+    def compile(self) -> None:
+        self.expressions = [
+            re.compile("|".join(sources)) if sources else None
+            for sources in self.sources
+        ]
+
+    def matches(self, path: str, name: str, is_dir: bool) -> bool:
+        names, dir_names, paths, dir_paths = self.expressions
+        return bool(
+            name in self.names or
+            (is_dir and name in self.dir_names) or
+            (names is not None and names.fullmatch(name)) or
+            (is_dir and dir_names is not None and dir_names.fullmatch(name)) or
+            (paths is not None and paths.fullmatch(path)) or
+            (is_dir and dir_paths is not None and dir_paths.fullmatch(path))
+        )
+
+class ExcludeRules(object):
+    """
+    What to leave out of the indexes of a library's media, as the lines of a
+    .gitignore: a glob without a slash matches names at any depth, one with a
+    slash matches paths from the root of the medium, a trailing slash matches
+    directories only and a leading `!` includes again what an earlier rule
+    excluded. The last rule that matches decides. Blank lines and lines
+    starting with `#` are skipped.
+
+    `DEFAULT_EXCLUDES` come before the given rules. The rules are compiled once,
+    and a directory that is excluded is never scanned, so nothing under it can
+    be included again.
+    """
+
+    def __init__(self, patterns: Iterable[str]=()) -> None:
+        self.patterns = list(DEFAULT_EXCLUDES) + list(patterns)
+        # Whether any rule besides the defaults applies.
+        self.custom = False
+        self.groups: List[_ExcludeGroup] = []
+        for i, pattern in enumerate(self.patterns):
+            pattern = pattern.rstrip("\n")
+            if not pattern.strip() or pattern.startswith("#"):
+                continue
+            negated = pattern.startswith("!")
+            if negated:
+                pattern = pattern[1:]
+            elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+                pattern = pattern[1:]
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            self.custom = self.custom or i >= len(DEFAULT_EXCLUDES)
+            if not self.groups or self.groups[-1].negated != negated:
+                self.groups.append(_ExcludeGroup(negated))
+            self.groups[-1].add(pattern, dir_only)
+        for group in self.groups:
+            group.compile()
+        # Only rules that exclude can change what a walk finds.
+        self.groups = self.groups[next(
+            (i for i, group in enumerate(self.groups) if not group.negated), len(self.groups)
+        ):]
+
+    def excludes(self, path: str, is_dir: bool) -> bool:
+        """
+        Whether to leave out the entry at `path`, relative to the root of the
+        medium and separated with slashes.
+        """
+        name = path.rpartition("/")[2]
+        for group in reversed(self.groups):
+            if group.matches(path, name, is_dir):
+                return not group.negated
+        return False
+
+    def for_directory(self, relative_dir: str) -> Optional[Callable[[str, bool], bool]]:
+        """
+        `excludes` for the entries of one directory, by their names, or None if
+        nothing in it can be excluded.
+        """
+        if not self.custom:
+            if relative_dir:
+                return None
+            return lambda name, is_dir: "/" + name in DEFAULT_EXCLUDES
+        prefix = relative_dir.replace(os.sep, "/") + "/" if relative_dir else ""
+        return lambda name, is_dir: self.excludes(prefix + name, is_dir)
+
+# The subdirectories of a directory, its files, and the stats of those files.
+DirectoryListing = Tuple[List[str], List[str], List[Optional[FileStat]]]
+
+def _stat_file(path: str) -> Optional[FileStat]:
+    try:
+        return make_file_stat(os.lstat(path))
+    except OSError:
+        return None
+
+def _scan_directory(
+    path: str, excluded: Optional[Callable[[str, bool], bool]]=None
+) -> DirectoryListing:
+    """
+    List the immediate contents of `path`, split into directories and files the
+    same way `os.walk` does it. Symlinks to directories are dropped since
+    `os.walk` lists them as directories but never descends into them, so they
+    never make it into an index. Files are lstat'd through their directory
+    entries; a file that vanishes before that gets no stat. Entries that
+    `excluded` is true for, by name and whether they are directories, are left
+    out before they are stat'd.
+    """
+    dirs: List[str] = []
+    files: List[str] = []
+    stats: List[Optional[FileStat]] = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if excluded is not None and excluded(entry.name, is_dir):
+                continue
+            if not is_dir:
+                files.append(entry.name)
+                try:
+                    stats.append(make_file_stat(entry.stat(follow_symlinks=False)))
+                except OSError:
+                    stats.append(None)
+            elif not entry.is_symlink():
+                dirs.append(entry.name)
+
+    return dirs, files, stats
+
+class _PendingDirectory(object):
+    """
+    Bookkeeping for a directory whose subtree is still being walked. A
+    directory is only attached to its parent once all of its children are done
+    so that it is never mutated (and its hash never changes) while it sits in
+    its parent's index set.
+    """
+
+    def __init__(
+        self,
+        dir_index: "DirectoryIndex",
+        parent: Optional["_PendingDirectory"],
+        previous: Optional["DirectoryIndex"]=None,
+        parts: Tuple[str, ...]=()
+    ) -> None:
+        self.dir_index = dir_index
+        self.parent = parent
+        self.outstanding = 0
+        # The index of this same directory from an earlier run, if any.
+        self.previous = previous
+        # Path components from the root of the medium to this directory.
+        self.parts = parts
+        # Whether some directory in this subtree could not be scanned.
+        self.partial = False
+
+class MediaWalker(object):
+    """
+    Walks a medium and builds its `DirectoryIndex`.
+
+    Every directory is scanned with `os.scandir` as its own task in a bounded
+    thread pool of `workers` threads. When `sequential` is set (or only one
+    worker is asked for) the directories are scanned one after another in the
+    calling thread instead.
+
+    The tree produced is the same as the one built from `os.walk`: symlinked
+    directories and directories that can't be read are left out of the index.
+
+    Every directory is fingerprinted with its `(inode, mtime_ns)`. If a
+    `previous` index of the same medium is given, directories whose fingerprint
+    did not change reuse their listing from it instead of being scanned again.
+    A directory's mtime only covers its own entries, so its subdirectories are
+    still checked one by one.
+
+    If a `sink` is given, each directory is handed to it as soon as it has been
+    scanned and is then dropped instead of being kept in a tree; `walk` then
+    returns an empty root. Directories are walked depth-first with a bounded
+    number of scans in flight, so the walker itself only ever holds on to the
+    directories along the current path and their unvisited siblings.
+
+    If a `progress` callback is given, it is called with the directories and
+    files walked so far every time a directory has been scanned.
+
+    Entries that `rules` exclude are left out as directories are scanned, so
+    an excluded directory is never scanned at all.
+
+    If a `checkpoint` is given, it is handed every directory whose subtree has
+    been completely walked, as its path components and its (frozen) index.
+    Subtrees in which a directory could not be scanned are not handed over.
+    Subtrees completed by an earlier, interrupted walk can be given back as
+    `resumed`, by their path components, and are then taken as they are
+    instead of being walked again.
+    """
+
+    def __init__(
+        self,
+        sector_path: str,
+        workers: int=DEFAULT_INDEX_WORKERS,
+        sequential: bool=False,
+        previous: Optional["DirectoryIndex"]=None,
+        sink: Optional[Callable[[Tuple[str, ...], "DirectoryIndex"], None]]=None,
+        progress: Optional[Callable[[int, int], None]]=None,
+        checkpoint: Optional[Callable[[Tuple[str, ...], "DirectoryIndex"], None]]=None,
+        resumed: Optional[Dict[Tuple[str, ...], "DirectoryIndex"]]=None,
+        rules: Optional[ExcludeRules]=None
+    ) -> None:
+        self.sector_path = sector_path
+        self.workers = workers
+        self.sequential = sequential or workers <= 1
+        self.previous = previous
+        self.sink = sink
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.resumed = resumed or {}
+        self.rules = rules
+        self.started_ns = time.time_ns()
+        # Tallies of what has been walked, for reporting.
+        self.directories = 0
+        self.files = 0
+        self.bytes_stat = 0
+
+    def _fingerprint(self, path: str) -> Optional[DirectoryFingerprint]:
+        dir_stat = os.stat(path, follow_symlinks=False)
+        if dir_stat.st_mtime_ns >= self.started_ns - FINGERPRINT_RACY_WINDOW_NS:
+            return None
+        return (dir_stat.st_ino, dir_stat.st_mtime_ns)
+
+    def _scan(
+        self, path: str, previous: Optional["DirectoryIndex"]
+    ) -> Tuple[Optional[DirectoryFingerprint], DirectoryListing]:
+        # Stat before listing so that a change made while we list is caught by
+        # the next run.
+        fingerprint = self._fingerprint(path)
+        excluded = None
+        if self.rules is not None:
+            excluded = self.rules.for_directory(
+                path[len(self.sector_path):].strip(os.sep)
+            )
+        if (
+            previous is not None and fingerprint is not None and
+            previous.fingerprint == fingerprint
+        ):
+            dirs: List[str] = []
+            files: List[str] = []
+            # Rules may have been added since the previous run.
+            for item in previous.index:
+                if isinstance(item, DirectoryIndex):
+                    if excluded is None or not excluded(item.subdir_path or "", True):
+                        dirs.append(item.subdir_path or "")
+                elif excluded is None or not excluded(item, False):
+                    files.append(item)
+            # Writing to a file does not touch its directory's mtime, so the
+            # files themselves still have to be stat'd again.
+            stats = [_stat_file(os.path.join(path, _file)) for _file in files]
+            return fingerprint, (dirs, files, stats)
+
+        if excluded is None:
+            return fingerprint, _scan_directory(path)
+        return fingerprint, _scan_directory(path, excluded)
+
+    def _finish(self, pending: _PendingDirectory) -> None:
+        """
+        Called once the subtree under `pending` has been completely walked.
+        Propagates upwards for every ancestor that this completes as well.
+        """
+        current: Optional[_PendingDirectory] = pending
+        while current is not None and current.outstanding == 0:
+            current.dir_index.freeze()
+            if self.checkpoint is not None and not current.partial:
+                self.checkpoint(current.parts, current.dir_index)
+            parent = current.parent
+            if parent is not None:
+                parent.dir_index.add_to_index(current.dir_index)
+                parent.outstanding -= 1
+                parent.partial = parent.partial or current.partial
+            current = parent
+
+    def _resume(self, dir_index: "DirectoryIndex") -> None:
+        """
+        Count a subtree taken from an earlier walk as walked.
+        """
+        pending_dirs = [dir_index]
+        while pending_dirs:
+            current = pending_dirs.pop()
+            self.directories += 1
+            for item in current.index:
+                if isinstance(item, DirectoryIndex):
+                    pending_dirs.append(item)
+                else:
+                    self.files += 1
+
+    def _visit(
+        self,
+        path: str,
+        pending: _PendingDirectory,
+        scanned: Optional[Tuple[Optional[DirectoryFingerprint], DirectoryListing]]
+    ) -> List[Tuple[str, _PendingDirectory]]:
+        """
+        Fill in a scanned directory and return the child directories that still
+        need to be scanned.
+        """
+        if scanned is None:
+            # Unreadable: os.walk silently skips these, and so do we.
+            if pending.parent is not None:
+                pending.parent.partial = True
+                pending.parent.outstanding -= 1
+                self._finish(pending.parent)
+            return []
+
+        fingerprint, (dirs, files, stats) = scanned
+        self.directories += 1
+        self.files += len(files)
+        pending.dir_index.fingerprint = fingerprint
+        for _file, file_stat in zip(files, stats):
+            pending.dir_index.add_to_index(_file, file_stat)
+            if file_stat is not None:
+                self.bytes_stat += file_stat[0]
+        if self.progress is not None:
+            self.progress(self.directories, self.files)
+
+        # With a sink there is no tree to attach to; children are orphaned so
+        # that each directory can be freed as soon as it has been handed over.
+        parent: Optional[_PendingDirectory] = pending
+        if self.sink is not None:
+            self.sink(pending.parts, pending.dir_index)
+            parent = None
+
+        previous_subdirs: Dict[str, DirectoryIndex] = {}
+        if pending.previous is not None:
+            previous_subdirs = {
+                item.subdir_path or "": item
+                for item in pending.previous.index
+                if isinstance(item, DirectoryIndex)
+            }
+        # The previous run's tree is only needed until this level is expanded.
+        pending.previous = None
+
+        children = []
+        for _dir in dirs:
+            parts = pending.parts + (_dir,)
+            if parent is not None and parts in self.resumed:
+                self._resume(self.resumed[parts])
+                parent.dir_index.add_to_index(self.resumed[parts])
+                continue
+            children.append((
+                os.path.join(path, _dir),
+                _PendingDirectory(
+                    DirectoryIndex(_dir, is_top_level=False),
+                    parent,
+                    previous_subdirs.get(_dir),
+                    parts
+                )
+            ))
+        if parent is not None:
+            parent.outstanding = len(children)
+            if not children:
+                self._finish(parent)
+        return children
+
+    def _safe_scan(
+        self, path: str, previous: Optional["DirectoryIndex"]=None
+    ) -> Optional[Tuple[Optional[DirectoryFingerprint], DirectoryListing]]:
+        try:
+            return self._scan(path, previous)
+        except OSError as e:
+            logging.warning("Unable to scan %s: %s" % (path, e))
+            return None
+
+    def walk(self) -> "DirectoryIndex":
+        if () in self.resumed and self.sink is None:
+            # The earlier walk got to the end; only writing its index did not.
+            self._resume(self.resumed[()])
+            return self.resumed[()]
+
+        root_index = DirectoryIndex(self.sector_path, is_top_level=True)
+        root = _PendingDirectory(root_index, None, self.previous)
+
+        stack: List[Tuple[str, _PendingDirectory]] = [(self.sector_path, root)]
+        if self.sequential:
+            while stack:
+                path, pending = stack.pop()
+                stack.extend(
+                    self._visit(path, pending, self._safe_scan(path, pending.previous))
+                )
+
+            return root_index
+
+        # Keep a few more scans queued than there are workers so that no worker
+        # idles while we process results, but otherwise leave discovered
+        # directories on the stack.
+        max_in_flight = self.workers * 2
+        with concurrent_futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight: Dict[concurrent_futures.Future, Tuple[str, _PendingDirectory]] = {}
+
+            while stack or in_flight:
+                while stack and len(in_flight) < max_in_flight:
+                    path, pending = stack.pop()
+                    in_flight[
+                        pool.submit(self._safe_scan, path, pending.previous)
+                    ] = (path, pending)
+
+                done, _ = concurrent_futures.wait(
+                    in_flight, return_when=concurrent_futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    path, pending = in_flight.pop(future)
+                    stack.extend(self._visit(path, pending, future.result()))
+
+        return root_index
+
+class IndexCheckpoint(object):
+    """
+    Keeps a line-delimited file of the directories whose subtrees a walk has
+    completed, to be given to a `MediaWalker` as its `checkpoint`. Should the
+    walk be interrupted, `load_checkpoint` gives back the completed subtrees so
+    that the next walk can pick up where this one left off.
+
+    The file is a header line followed by one record per directory, in the
+    format of `StreamingIndexWriter`. Completed directories are only written
+    out and synced to disk every `interval` seconds, and when the walk is
+    interrupted by an exception (e.g., KeyboardInterrupt), so a walk that
+    finishes sooner does not pay for serializing them. Resuming appends to the
+    file of the interrupted walk.
+    """
+
+    def __init__(
+        self, filename: str, sector_path: str, append: bool=False,
+        interval: float=CHECKPOINT_INTERVAL
+    ) -> None:
+        self.fp = open(filename, "a" if append else "w")
+        self.interval = interval
+        self.next_sync = time.monotonic() + interval
+        self.pending: List[Tuple[Tuple[str, ...], DirectoryIndex]] = []
+        if not append:
+            self.fp.write(json.dumps({"version": get_version(), "sector_path": sector_path}))
+            self.fp.write("\n")
+
+    def __call__(self, parts: Tuple[str, ...], dir_index: "DirectoryIndex") -> None:
+        self.pending.append((parts, dir_index))
+        now = time.monotonic()
+        if now >= self.next_sync:
+            self.next_sync = now + self.interval
+            self.sync()
+
+    def sync(self) -> None:
+        """
+        Write out the directories completed since the last sync.
+        """
+        for parts, dir_index in self.pending:
+            self.fp.write(json.dumps(_directory_record(parts, dir_index)) + "\n")
+        self.pending = []
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self) -> None:
+        self.fp.close()
+
+    def __enter__(self) -> "IndexCheckpoint":
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        try:
+            if exc_type is not None:
+                self.sync()
+        finally:
+            self.close()
+
+def load_checkpoint(
+    filename: str, sector_path: str
+) -> Optional[Dict[Tuple[str, ...], "DirectoryIndex"]]:
+    """
+    The subtrees completed by an interrupted walk of `sector_path`, by their
+    path components, from the file its `IndexCheckpoint` kept. None if there is
+    no such file, or if it was written for another medium or by another
+    version of chadow.
+    """
+    try:
+        checkpoint_file = open(filename, "r")
+    except FileNotFoundError:
+        return None
+
+    nodes: Dict[Tuple[str, ...], DirectoryIndex] = {}
+    with checkpoint_file:
+        try:
+            header = json.loads(next(checkpoint_file))
+        except (StopIteration, ValueError):
+            return None
+        if header != {"version": get_version(), "sector_path": sector_path}:
+            return None
+
+        for line in checkpoint_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may have been cut short by the interruption.
+                break
+            parts = tuple(record["path"])
+            nodes[parts] = _load_directory_record(
+                record, DirectoryIndex(sector_path, is_top_level=True) if not parts else None
+            )
+
+    _link_directories(nodes)
+    return nodes
+
+# The files of a snapshot, by their path components (name included).
+SnapshotFiles = Dict[Tuple[str, ...], Optional[FileStat]]
+# A file of a snapshot, as its path components and its stat.
+SnapshotEntry = Tuple[Tuple[str, ...], Optional[FileStat]]
+
+def _sorted_file_stats(
+    file_stats: Iterable[Tuple[Tuple[str, ...], str, Optional[FileStat]]],
+    scratch_dir: str, run_size: Optional[int]=None
+) -> Iterator[SnapshotEntry]:
+    """
+    The files of an index, sorted by path. They are sorted in runs of
+    `run_size` (by default, `HISTORY_SORT_RUN`) files, and every run but the
+    last is spilled to a file in `scratch_dir` and merged back from there.
+    """
+    run_size = run_size or HISTORY_SORT_RUN
+    runs: List[str] = []
+    try:
+        run: List[SnapshotEntry] = []
+        for parts, name, file_stat in file_stats:
+            run.append((parts + (name,), file_stat))
+            if len(run) >= run_size:
+                run.sort(key=lambda entry: entry[0])
+                runs.append(os.path.join(scratch_dir, "sort-%d.tmp" % len(runs)))
+                with open(runs[-1], "w") as run_file:
+                    for path, file_stat in run:
+                        run_file.write(json.dumps([path, file_stat]) + "\n")
+                run = []
+        run.sort(key=lambda entry: entry[0])
+
+        def read_run(filename: str) -> Iterator[SnapshotEntry]:
+            with open(filename, "r") as run_file:
+                for line in run_file:
+                    path, file_stat = json.loads(line)
+                    yield tuple(path), _load_file_stat(file_stat)
+
+        yield from heapq.merge(
+            *(read_run(filename) for filename in runs), iter(run),
+            key=lambda entry: entry[0]
+        )
+    finally:
+        for filename in runs:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(filename)
+
+class IndexHistory(object):
+    """
+    Snapshots of the files on a medium, one per `index` run, kept in a
+    directory of their own next to its index.
+
+    Snapshots are numbered from 1. The first is stored in full (as a base), and
+    every one after it as a delta: the files added (`+`), removed (`-`) and
+    changed (`~`, i.e., whose stat is different) since the one before. Every so
+    often (see `HISTORY_BASE_INTERVAL`), a snapshot is stored as a base as well,
+    so that rebuilding a snapshot only takes the base at or before it and the
+    deltas after that base. Only the first and the last `HISTORY_KEEP_BASES`
+    bases are kept. The deltas are all kept, so any snapshot can still be
+    rebuilt, and the changes between two snapshots come from the deltas
+    between them alone.
+
+    Each is a line-delimited file, `NNNNNN.base.jsonl` or `NNNNNN.delta.jsonl`.
+    Its first line is a header with the number of the snapshot, when it was
+    taken, the chadow version, and how many files it has and were added,
+    removed and changed. Every line after that is a file, as its path (a list of
+    components) and its stat, preceded by the operation in a delta.
+    """
+
+    FILENAME = re.compile(r"^(\d+)\.(base|delta)\.jsonl$")
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def _filename(self, snapshot: int, kind: str) -> str:
+        return os.path.join(self.directory, "%06d.%s.jsonl" % (snapshot, kind))
+
+    def _stored(self) -> Tuple[Set[int], Set[int]]:
+        """
+        The snapshots stored as bases and those stored as deltas.
+        """
+        bases: Set[int] = set()
+        deltas: Set[int] = set()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return bases, deltas
+        for name in names:
+            match = IndexHistory.FILENAME.match(name)
+            if match is not None:
+                (bases if match.group(2) == "base" else deltas).add(int(match.group(1)))
+        return bases, deltas
+
+    def _header(self, snapshot: int, kind: str) -> Dict[str, Any]:
+        with open(self._filename(snapshot, kind), "r") as snapshot_file:
+            return json.loads(next(snapshot_file))
+
+    def _entries(self, snapshot: int, kind: str) -> Iterator[List[Any]]:
+        with open(self._filename(snapshot, kind), "r") as snapshot_file:
+            next(snapshot_file)
+            for line in snapshot_file:
+                yield json.loads(line)
+
+    def snapshots(self) -> List[Dict[str, Any]]:
+        """
+        The header of every snapshot, oldest first, each with whether the
+        snapshot is stored in full as its `base`.
+        """
+        bases, deltas = self._stored()
+        headers = []
+        for snapshot in sorted(bases | deltas):
+            header = self._header(snapshot, "delta" if snapshot in deltas else "base")
+            header["base"] = snapshot in bases
+            headers.append(header)
+        return headers
+
+    def resolve(self, spec: str) -> int:
+        """
+        The number of the snapshot `spec` stands for: a snapshot number, a
+        negative number counting back from the latest (-1 being the latest), or
+        a date or time in ISO 8601, for the last snapshot taken by then.
+        Raises ValueError if there is no such snapshot.
+        """
+        headers = self.snapshots()
+        try:
+            number = int(spec)
+        except ValueError:
+            pass
+        else:
+            numbers = [header["snapshot"] for header in headers]
+            if number < 0 and -number <= len(numbers):
+                return numbers[number]
+            if number in numbers:
+                return number
+            raise ValueError("There is no snapshot %s." % spec)
+
+        moment = datetime.datetime.fromisoformat(spec)
+        if len(spec) == len("YYYY-MM-DD"):
+            # A day includes everything taken on it.
+            moment += datetime.timedelta(days=1)
+        taken = [
+            header["snapshot"] for header in headers
+            if header["time"] < moment.timestamp()
+        ]
+        if not taken:
+            raise ValueError("There is no snapshot as of %s." % spec)
+        return taken[-1]
+
+    def _sorted_entries(self, snapshot: int, kind: str) -> Iterator[List[Any]]:
+        """
+        The entries of a stored snapshot, sorted by path. They are stored that
+        way, except by the chadow versions that did not say so in the header.
+        """
+        if self._header(snapshot, kind).get("sorted"):
+            return self._entries(snapshot, kind)
+        return iter(sorted(self._entries(snapshot, kind), key=lambda entry: entry[-2]))
+
+    def iter_snapshot(self, number: int) -> Iterator[SnapshotEntry]:
+        """
+        The files of a snapshot, sorted by path. They are merged from the base
+        at or before it and the deltas after it, which are read side by side,
+        so this only holds on to a file from each at a time.
+        """
+        bases, deltas = self._stored()
+        if number not in bases | deltas:
+            raise ValueError("There is no snapshot %d." % number)
+        base = max(base for base in bases if base <= number)
+        # The entries of later snapshots sort after those of earlier ones.
+        streams = [(
+            (tuple(path), 0, "+", file_stat)
+            for path, file_stat in self._sorted_entries(base, "base")
+        )] + [self._numbered_delta(delta) for delta in range(base + 1, number + 1)]
+        last: Optional[Tuple[Tuple[str, ...], int, str, Any]] = None
+        for entry in heapq.merge(*streams, key=lambda entry: entry[:2]):
+            if last is not None and last[0] != entry[0] and last[2] != "-":
+                yield last[0], _load_file_stat(last[3])
+            last = entry
+        if last is not None and last[2] != "-":
+            yield last[0], _load_file_stat(last[3])
+
+    def _numbered_delta(self, number: int) -> Iterator[Tuple[Tuple[str, ...], int, str, Any]]:
+        """
+        The entries of delta `number` as `iter_snapshot` merges them, each with
+        the number of the delta.
+        """
+        for op, path, file_stat in self._sorted_entries(number, "delta"):
+            yield tuple(path), number, op, file_stat
+
+    def snapshot(self, number: int) -> SnapshotFiles:
+        """
+        Rebuild a snapshot from the base at or before it and the deltas after.
+        """
+        return dict(self.iter_snapshot(number))
+
+    def changes(self, old: int, new: int) -> List[Tuple[str, Tuple[str, ...]]]:
+        """
+        The files added, removed and changed from snapshot `old` to snapshot
+        `new` (which may come before it), as pairs of the operation and the
+        path, sorted by path. A file that was there at both but was removed in
+        between is reported as removed and then added, since what is there now
+        is another file. Only the deltas in between are read.
+        """
+        if old > new:
+            inverse = {"+": "-", "-": "+", "~": "~"}
+            return sorted(
+                ((inverse[op], path) for op, path in self.changes(new, old)),
+                key=lambda change: (change[1], change[0] != "-")
+            )
+
+        _, deltas = self._stored()
+        # Whether each file touched was there at `old`, whether it is at `new`,
+        # and whether it was gone at some snapshot in between.
+        touched: Dict[Tuple[str, ...], Tuple[bool, bool, bool]] = {}
+        for delta in range(old + 1, new + 1):
+            if delta not in deltas:
+                raise ValueError("There is no snapshot %d." % delta)
+            for op, path, _ in self._entries(delta, "delta"):
+                key = tuple(path)
+                if key in touched:
+                    existed, _, went = touched[key]
+                else:
+                    existed, went = op != "+", False
+                touched[key] = (existed, op != "-", went or op == "-")
+
+        changes = []
+        for path, (existed, exists, went) in sorted(touched.items()):
+            if existed and exists and went:
+                changes.extend((("-", path), ("+", path)))
+            elif existed and exists:
+                changes.append(("~", path))
+            elif existed:
+                changes.append(("-", path))
+            elif exists:
+                changes.append(("+", path))
+        return changes
+
+    def _write(self, snapshot: int, kind: str, header: Dict[str, Any], entries: Iterable[List[Any]]) -> None:
+        """
+        Store a snapshot. The entries go to a file of their own first, so that
+        `header` can be filled in as they are produced, and are then copied
+        behind it.
+        """
+        filename = self._filename(snapshot, kind)
+        try:
+            with open(filename + ".entries", "w") as entries_file:
+                for entry in entries:
+                    entries_file.write(json.dumps(entry) + "\n")
+            with open(filename + ".partial", "w") as snapshot_file, \
+                    open(filename + ".entries", "r") as entries_file:
+                snapshot_file.write(json.dumps(dict(header, sorted=True)) + "\n")
+                shutil.copyfileobj(entries_file, snapshot_file)
+            os.replace(filename + ".partial", filename)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(filename + ".entries")
+
+    def _delta(
+        self, previous: Iterator[SnapshotEntry], current: Iterator[SnapshotEntry],
+        header: Dict[str, Any]
+    ) -> Iterator[List[Any]]:
+        """
+        The delta from one snapshot to the next, both sorted by path, merged
+        side by side. Counts the files and the changes into `header`.
+        """
+        counts = {"+": 0, "-": 0, "~": 0}
+        files = 0
+        old = next(previous, None)
+        new = next(current, None)
+        while old is not None or new is not None:
+            if new is not None and (old is None or new[0] < old[0]):
+                files += 1
+                counts["+"] += 1
+                yield ["+", list(new[0]), new[1]]
+                new = next(current, None)
+            elif new is None or old[0] < new[0]:
+                counts["-"] += 1
+                yield ["-", list(old[0]), None]
+                old = next(previous, None)
+            else:
+                files += 1
+                if old[1] != new[1]:
+                    counts["~"] += 1
+                    yield ["~", list(new[0]), new[1]]
+                old = next(previous, None)
+                new = next(current, None)
+        header.update(files=files, added=counts["+"], removed=counts["-"], changed=counts["~"])
+
+    def record(
+        self, file_stats: Iterable[Tuple[Tuple[str, ...], str, Optional[FileStat]]],
+        taken: Optional[float]=None
+    ) -> Dict[str, Any]:
+        """
+        Store the files of a new index as the next snapshot, and return its
+        header. The files are sorted and compared with the previous snapshot as
+        streams, so this takes bounded memory however large the index is.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        bases, deltas = self._stored()
+        header: Dict[str, Any] = {
+            "snapshot": max(bases | deltas, default=0) + 1,
+            "time": time.time() if taken is None else taken,
+            "version": get_version()
+        }
+        current = _sorted_file_stats(file_stats, self.directory)
+        if not bases:
+            self._write(header["snapshot"], "base", header, (
+                [path, file_stat]
+                for _, path, file_stat in self._delta(iter(()), current, header)
+            ))
+            return header
+
+        self._write(header["snapshot"], "delta", header, self._delta(
+            self.iter_snapshot(header["snapshot"] - 1), current, header
+        ))
+
+        last_base = max(bases)
+        since = [
+            self._header(snapshot, "delta") for snapshot in deltas if snapshot > last_base
+        ] + [header]
+        base_files = self._header(last_base, "base")["files"]
+        if (
+            len(since) >= HISTORY_BASE_INTERVAL or
+            2 * sum(h["added"] + h["removed"] + h["changed"] for h in since) >= base_files
+        ):
+            self._write(header["snapshot"], "base", header, (
+                [list(path), file_stat]
+                for path, file_stat in self.iter_snapshot(header["snapshot"])
+            ))
+            for base in sorted(bases)[1:][:-(HISTORY_KEEP_BASES - 1) or None]:
+                os.remove(self._filename(base, "base"))
+        return header
+
+class Inotify(object):
+    """
+    A minimal binding of Linux's inotify(7), through ctypes. Raises OSError if
+    inotify is not available.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_UNMOUNT = 0x00002000
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_EXCL_UNLINK = 0x04000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    # Everything that changes what an index of the directory would hold.
+    WATCH_MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+    )
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self) -> None:
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        from ctypes.util import find_library
+        self.libc = ctypes.CDLL(find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "This libc has no inotify")
+        self.fd = self.libc.inotify_init1(Inotify.IN_NONBLOCK | Inotify.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path: str) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), Inotify.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def remove_watch(self, wd: int) -> None:
+        # Fails if the watch is already gone with its directory; that's fine.
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: Optional[float]) -> List[Tuple[int, int, int, str]]:
+        """
+        The events that come in within `timeout` seconds (or whenever they come,
+        for None), as tuples of watch descriptor, mask, cookie and name.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        events: List[Tuple[int, int, int, str]] = []
+        while readable:
+            try:
+                buf = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = Inotify.EVENT.unpack_from(buf, pos)
+                pos += Inotify.EVENT.size
+                name = os.fsdecode(buf[pos:pos + length].rstrip(b"\0"))
+                pos += length
+                events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class _WatchingWalker(MediaWalker):
+    """
+    A `MediaWalker` that has its `MediaWatcher` watch every directory just
+    before scanning it, so that no change made after the scan goes unnoticed.
+    """
+
+    def __init__(self, sector_path: str, watcher: "MediaWatcher", **kwargs) -> None:
+        super().__init__(sector_path, **kwargs)
+        self.watcher = watcher
+
+    def _scan(
+        self, path: str, previous: Optional["DirectoryIndex"]
+    ) -> Tuple[Optional[DirectoryFingerprint], DirectoryListing]:
+        self.watcher.watch_directory(path)
+        return super()._scan(path, previous)
+
+class MediaWatcher(object):
+    """
+    Keeps the index of a mounted medium current by applying the changes that
+    inotify reports to it, rather than by walking the medium again.
+
+    Every directory of the medium is watched. A directory that something
+    happens in is marked dirty; a directory that appears (or is moved in) is
+    marked as new, along with everything under it. `refresh` then scans only
+    the dirty and new directories. It rebuilds the directories above them from
+    the index it already has, and takes the rest of the index as it is, so the
+    result is what walking the whole medium would give.
+
+    Where inotify is not available, or runs out of watches, the medium is
+    instead walked every `poll_interval` seconds, incrementally.
+
+    `on_change` is called with the new index when it changes, at most every
+    `debounce` seconds while changes keep coming in. It is also called no later
+    than `max_delay` seconds after the first of them.
+
+    Directories that `rules` exclude are neither indexed nor watched.
+    """
+
+    def __init__(
+        self, sector_path: str, on_change: Callable[["DirectoryIndex"], None],
+        workers: int=DEFAULT_INDEX_WORKERS, sequential: bool=False,
+        debounce: float=WATCH_DEBOUNCE, max_delay: float=WATCH_MAX_DELAY,
+        poll_interval: float=WATCH_POLL_INTERVAL, use_inotify: bool=True,
+        rules: Optional[ExcludeRules]=None
+    ) -> None:
+        self.sector_path = sector_path
+        self.on_change = on_change
+        self.rules = rules
+        self.workers = workers
+        self.sequential = sequential
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.inotify: Optional[Inotify] = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                logging.warning("Can't use inotify (%s). Polling instead." % e)
+        self.watches: Dict[int, Tuple[str, ...]] = {}
+        self.dirty: Set[Tuple[str, ...]] = set()
+        self.new: Set[Tuple[str, ...]] = set()
+        self.unmounted = False
+        self.index: Optional[DirectoryIndex] = None
+        self.first_change: Optional[float] = None
+        self.last_change: Optional[float] = None
+
+    def close(self) -> None:
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def _parts(self, path: str) -> Tuple[str, ...]:
+        relative = os.path.relpath(path, self.sector_path)
+        return () if relative == os.curdir else tuple(relative.split(os.sep))
+
+    def watch_directory(self, path: str) -> None:
+        if self.inotify is None:
+            return
+        try:
+            self.watches[self.inotify.add_watch(path)] = self._parts(path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logging.warning(
+                    "Out of inotify watches (see fs.inotify.max_user_watches). Polling instead."
+                )
+                self.close()
+            # Otherwise the directory is already gone, and its parent will tell.
+
+    def start(self) -> "DirectoryIndex":
+        """
+        Walk the medium, watching it as it goes.
+        """
+        self.index = _WatchingWalker(
+            self.sector_path, self, workers=self.workers, sequential=self.sequential,
+            rules=self.rules
+        ).walk()
+        return self.index
+
+    def handle(self, events: Iterable[Tuple[int, int, int, str]]) -> None:
+        for wd, mask, _, name in events:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                # Events were dropped, so we can't tell what changed.
+                logging.warning("Missed some changes. Walking all of %s again." % self.sector_path)
+                self.new.add(())
+                continue
+
+            parts = self.watches.get(wd)
+            if parts is None:
+                continue
+            if mask & Inotify.IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if mask & Inotify.IN_UNMOUNT:
+                self.unmounted = True
+                continue
+
+            self.dirty.add(parts)
+            if mask & Inotify.IN_ISDIR and name:
+                child = parts + (name,)
+                if mask & (Inotify.IN_MOVED_FROM | Inotify.IN_DELETE):
+                    self.__unwatch(child)
+                elif mask & (Inotify.IN_MOVED_TO | Inotify.IN_CREATE):
+                    self.new.add(child)
+        if self.dirty or self.new:
+            self.last_change = time.monotonic()
+            if self.first_change is None:
+                self.first_change = self.last_change
+
+    def __unwatch(self, parts: Tuple[str, ...]) -> None:
+        """
+        Stop watching a subtree that moved away, whose watches would otherwise
+        report its changes under its old path.
+        """
+        assert self.inotify is not None
+        for wd, watched in list(self.watches.items()):
+            if watched[:len(parts)] == parts:
+                self.inotify.remove_watch(wd)
+                del self.watches[wd]
+
+    def refresh(self) -> "DirectoryIndex":
+        """
+        Apply the changes seen so far to the index.
+        """
+        dirty, new = self.dirty, self.new
+        self.dirty, self.new = set(), set()
+        self.first_change = self.last_change = None
+        changed = dirty | new
+        above_changes = {parts[:i] for parts in changed for i in range(len(parts))}
+
+        # Scans go through a walker for its fingerprinting and watching.
+        walker = _WatchingWalker(self.sector_path, self, sequential=True, rules=self.rules)
+        root = DirectoryIndex(self.sector_path, is_top_level=True)
+        nodes: Dict[Tuple[str, ...], DirectoryIndex] = {(): root}
+        stack: List[Tuple[Tuple[str, ...], Optional[DirectoryIndex]]] = [
+            ((), None if () in new else self.index)
+        ]
+        while stack:
+            parts, previous = stack.pop()
+            node = nodes[parts]
+            if previous is None or parts in dirty:
+                scanned = walker._safe_scan(os.path.join(self.sector_path, *parts))
+                if scanned is None:
+                    # Gone since, or unreadable: left out, as in a walk.
+                    if parts:
+                        del nodes[parts]
+                    continue
+                fingerprint, (dirs, files, stats) = scanned
+            else:
+                fingerprint = previous.fingerprint
+                files = [item for item in previous.index if isinstance(item, str)]
+                stats = [previous.file_stat(_file) for _file in files]
+                dirs = [
+                    item.subdir_path or "" for item in previous.index
+                    if isinstance(item, DirectoryIndex)
+                ]
+
+            node.fingerprint = fingerprint
+            for _file, file_stat in zip(files, stats):
+                node.add_to_index(_file, file_stat)
+            previous_subdirs: Dict[str, DirectoryIndex] = {}
+            if previous is not None:
+                previous_subdirs = {
+                    item.subdir_path or "": item
+                    for item in previous.index if isinstance(item, DirectoryIndex)
+                }
+            for _dir in dirs:
+                child = parts + (_dir,)
+                child_previous = None if child in new else previous_subdirs.get(_dir)
+                if child_previous is not None and child not in changed and child not in above_changes:
+                    node.add_to_index(child_previous)
+                    continue
+                nodes[child] = DirectoryIndex(_dir, is_top_level=False)
+                stack.append((child, child_previous))
+
+        _link_directories(nodes)
+        self.index = root
+        return root
+
+    def poll(self) -> "DirectoryIndex":
+        """
+        Walk the medium again, reusing what did not change since the last walk.
+        """
+        self.index = MediaWalker(
+            self.sector_path, self.workers, self.sequential, previous=self.index,
+            rules=self.rules
+        ).walk()
+        return self.index
+
+    def step(self, timeout: Optional[float]=None) -> bool:
+        """
+        Wait up to `timeout` seconds for changes (with inotify, forever for
+        None) and pass the index on if it is due. True if it was.
+        """
+        if self.inotify is None:
+            time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+            previous = self.index
+            current = self.poll()
+            if previous is not None and _same_index(previous, current):
+                return False
+            self.on_change(current)
+            return True
+
+        if self.first_change is not None and self.last_change is not None:
+            now = time.monotonic()
+            due = min(self.last_change + self.debounce, self.first_change + self.max_delay)
+            timeout = max(0.0, due - now) if timeout is None else min(timeout, max(0.0, due - now))
+        self.handle(self.inotify.read_events(timeout))
+
+        if self.first_change is None or self.last_change is None:
+            return False
+        now = time.monotonic()
+        if (
+            now - self.last_change < self.debounce and
+            now - self.first_change < self.max_delay
+        ):
+            return False
+        self.on_change(self.refresh())
+        return True
+
+    def run(self) -> None:
+        """
+        Watch until the medium is unmounted. On KeyboardInterrupt, pass on
+        any change not passed on yet before giving up.
+        """
+        try:
+            while not self.unmounted:
+                self.step()
+        except KeyboardInterrupt:
+            if self.first_change is not None:
+                self.on_change(self.refresh())
+            raise
+
+def _same_index(index: "DirectoryIndex", other: "DirectoryIndex") -> bool:
+    """
+    Whether two indexes hold the same files with the same stats.
+    """
+    return index == other and all(
+        mine == theirs for mine, theirs in
+        itertools.zip_longest(index.iter_file_stats(), other.iter_file_stats())
+    )
+
+def block_device(path: str) -> str:
+    """
+    Name the disk that `path` is on, so that media on partitions of the same
+    disk can be told apart from media on different disks. Where sysfs does not
+    know the device (e.g., network filesystems), this is just the device number
+    of the filesystem. Paths that can't be stat'd are named after themselves.
+    """
+    try:
+        st_dev = os.stat(path).st_dev
+    except OSError:
+        return path
+
+    device_number = "%d:%d" % (os.major(st_dev), os.minor(st_dev))
+    device = os.path.realpath(os.path.join("/sys/dev/block", device_number))
+    if not os.path.isdir(device):
+        return device_number
+    if os.path.exists(os.path.join(device, "partition")):
+        device = os.path.dirname(device)
+    return os.path.basename(device)
+
+def _copy_range(
+    source_fd: int, destination_fd: int, offset: int, end: int,
+    chunk_size: int=SYNC_CHUNK_SIZE
+) -> int:
+    """
+    Copy the bytes from `offset` to `end` of one file to the same offsets of
+    another, and return where the copy stopped (short of `end` if the source
+    got shorter). The kernel moves the data itself where it can, with
+    copy_file_range (which can also clone it, on filesystems that support it)
+    or failing that with sendfile; otherwise it goes through one large buffer.
+    """
+    methods = [
+        method for method in ("copy_file_range", "sendfile") if hasattr(os, method)
+    ] + ["buffer"]
+    buffer: Optional[memoryview] = None
+    while offset < end:
+        count = min(chunk_size, end - offset)
+        method = methods[0]
+        try:
+            if method == "copy_file_range":
+                copied = os.copy_file_range(source_fd, destination_fd, count, offset, offset)
+            elif method == "sendfile":
+                os.lseek(destination_fd, offset, os.SEEK_SET)
+                copied = os.sendfile(destination_fd, source_fd, offset, count)
+            else:
+                if buffer is None:
+                    buffer = memoryview(bytearray(chunk_size))
+                copied = os.preadv(source_fd, [buffer[:count]], offset)
+                written = 0
+                while written < copied:
+                    written += os.pwrite(
+                        destination_fd, buffer[written:copied], offset + written
+                    )
+        except OSError as e:
+            # Not supported between these files (e.g., across filesystems on
+            # older kernels): try the next way.
+            if method == "buffer" or e.errno not in (
+                errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF
+            ):
+                raise
+            methods.pop(0)
+            continue
+
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+def copy_file(source: str, destination: str, chunk_size: int=SYNC_CHUNK_SIZE) -> int:
+    """
+    Copy a file, with its modification time, through a partial file next to
+    the destination that is only renamed into place once complete. The partial
+    file is named after the size and mtime of the source, so that a copy that
+    was interrupted picks up where it left off, unless the source changed
+    since. Returns the number of bytes copied this time.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        source_stat = os.fstat(source_fd)
+        partial = "%s.chadow-%d-%d.partial" % (
+            destination, source_stat.st_size, source_stat.st_mtime_ns
+        )
+        destination_fd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            start = min(os.fstat(destination_fd).st_size, source_stat.st_size)
+            end = _copy_range(source_fd, destination_fd, start, source_stat.st_size, chunk_size)
+            if end != source_stat.st_size:
+                raise OSError(errno.EIO, "Source changed while it was copied", source)
+            os.ftruncate(destination_fd, end)
+            os.fsync(destination_fd)
+        finally:
+            os.close(destination_fd)
+    finally:
+        os.close(source_fd)
+
+    os.utime(partial, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    os.replace(partial, destination)
+    return end - start
+
+class CopyTask(object):
+    """
+    A file to copy from one medium to the same path on another.
+    """
+
+    def __init__(
+        self, source_media: str, relative_path: str, size: int, mtime_ns: int
+    ) -> None:
+        self.source_media = source_media
+        self.relative_path = relative_path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.destination_media: Optional[str] = None
+
+    @property
+    def source(self) -> str:
+        return os.path.join(self.source_media, self.relative_path)
+
+    @property
+    def destination(self) -> str:
+        assert self.destination_media is not None
+        return os.path.join(self.destination_media, self.relative_path)
+
+    def is_done(self) -> bool:
+        """
+        Whether the destination already is a copy, by size and mtime.
+        """
+        destination_stat = _stat_file(self.destination)
+        return destination_stat is not None and destination_stat[:2] == (self.size, self.mtime_ns)
+
+def plan_copies(
+    tasks: List[CopyTask], destination_media: List[str]
+) -> Tuple[List[CopyTask], List[CopyTask]]:
+    """
+    Pick a destination medium for every task and return the tasks that got one
+    and those that did not fit anywhere. A file goes where a copy of it (even a
+    partial one) already is, else to the medium with the most room left.
+    """
+    room: Dict[str, int] = {}
+    for media_path in destination_media:
+        fs_stat = os.statvfs(media_path)
+        room[media_path] = fs_stat.f_bavail * fs_stat.f_frsize
+
+    planned: List[CopyTask] = []
+    unplaced: List[CopyTask] = []
+    # Biggest first, so that the small files fill in what is left.
+    for task in sorted(tasks, key=lambda task: -task.size):
+        started = [
+            media_path for media_path in destination_media
+            if os.path.lexists(os.path.join(media_path, task.relative_path)) or
+            os.path.lexists("%s.chadow-%d-%d.partial" % (
+                os.path.join(media_path, task.relative_path), task.size, task.mtime_ns
+            ))
+        ]
+        media_path = started[0] if started else max(destination_media, key=lambda media_path: room[media_path])
+        if not started and room[media_path] < task.size:
+            unplaced.append(task)
+            continue
+        task.destination_media = media_path
+        room[media_path] -= task.size
+        planned.append(task)
+    return planned, unplaced
+
+def run_copies(
+    tasks: List[CopyTask], workers_per_device: int=SYNC_WORKERS_PER_DEVICE
+) -> Tuple[List[CopyTask], List[Tuple[CopyTask, OSError]]]:
+    """
+    Carry out planned copies, at most `workers_per_device` at a time onto each
+    disk, so that a slow disk does not hold up the others and none of them is
+    made to seek between too many files. Returns the tasks done and the tasks
+    that failed, with their errors.
+    """
+    devices = {
+        media_path: block_device(media_path)
+        for media_path in {task.destination_media for task in tasks}
+    }
+    by_device: Dict[str, List[CopyTask]] = {}
+    for task in tasks:
+        by_device.setdefault(devices[task.destination_media], []).append(task)
+
+    copied: List[CopyTask] = []
+    failed: List[Tuple[CopyTask, OSError]] = []
+    with contextlib.ExitStack() as pools:
+        futures: Dict[concurrent_futures.Future, CopyTask] = {}
+        for device_tasks in by_device.values():
+            pool = pools.enter_context(
+                concurrent_futures.ThreadPoolExecutor(max_workers=workers_per_device)
+            )
+            for task in device_tasks:
+                futures[pool.submit(copy_file, task.source, task.destination)] = task
+        try:
+            for future in concurrent_futures.as_completed(futures):
+                task = futures[future]
+                try:
+                    future.result()
+                except OSError as e:
+                    logging.error("Unable to copy %s: %s" % (task.source, e))
+                    failed.append((task, e))
+                    continue
+                logging.info("Copied %s to %s." % (task.source, task.destination))
+                copied.append(task)
+        except BaseException:
+            # Let the copies under way finish, but start no more.
+            for future in futures:
+                future.cancel()
+            raise
+    return copied, failed
+
+class IndexSummary(object):
+    """
+    What indexing a medium took, for reporting throughput. `error` is set
+    instead if indexing it failed.
+    """
+
+    def __init__(
+        self, sector_name: str, media_path: str, directories: int=0, files: int=0,
+        seconds: float=0.0, error: Optional[str]=None,
+        metrics: Optional["RunMetrics"]=None
+    ) -> None:
+        self.sector_name = sector_name
+        self.media_path = media_path
+        self.directories = directories
+        self.files = files
+        self.seconds = seconds
+        self.error = error
+        self.metrics = metrics
+
+    def __str__(self) -> str:
+        if self.error is not None:
+            return "%s %s: failed (%s)" % (self.sector_name, self.media_path, self.error)
+        return "%s %s: %d files in %d directories in %.2fs (%.0f files/s)" % (
+            self.sector_name, self.media_path, self.files, self.directories,
+            self.seconds, self.files / max(self.seconds, 1e-9)
+        )
+
+class ProgressReporter(object):
+    """
+    Reports how far a walk has got: the directories and files seen, the rate
+    at which they are being walked and, when an `expected` number of entries
+    (directories and files) is known, how far along it is and an ETA.
+
+    Meant as the `progress` of a `MediaWalker`. Calls are cheap: a report is only
+    put together and written at most every `interval` seconds. With
+    `overwrite`, each report replaces the last one on the same line, for
+    terminals; otherwise every report is a line of its own.
+    """
+
+    def __init__(
+        self, label: str, expected: Optional[int]=None, stream: Optional[IO[str]]=None,
+        overwrite: bool=True, interval: Optional[float]=None
+    ) -> None:
+        self.label = label
+        self.expected = expected
+        self.stream = stream if stream is not None else sys.stderr
+        self.overwrite = overwrite
+        self.interval = interval if interval is not None else (
+            PROGRESS_INTERVAL if overwrite else PROGRESS_LINE_INTERVAL
+        )
+        self.started = time.monotonic()
+        self.next_report = self.started + self.interval
+        self.reported = False
+
+    def __call__(self, directories: int, files: int) -> None:
+        now = time.monotonic()
+        if now < self.next_report:
+            return
+        self.next_report = now + self.interval
+        self.__write(self.format(directories, files, now - self.started))
+
+    def finish(self, directories: int, files: int) -> None:
+        """
+        End the report. Only needed to end the line of an overwritten report.
+        """
+        if self.overwrite and self.reported:
+            self.__write(self.format(directories, files, time.monotonic() - self.started))
+            self.stream.write("\n")
+            self.stream.flush()
+
+    def format(self, directories: int, files: int, elapsed: float) -> str:
+        entries = directories + files
+        rate = entries / max(elapsed, 1e-9)
+        report = "%s: %d directories, %d files, %.0f entries/s" % (
+            self.label, directories, files, rate
+        )
+        if self.expected:
+            if entries < self.expected:
+                report += ", %d%%, ETA %s" % (
+                    100 * entries // self.expected,
+                    _format_duration((self.expected - entries) / max(rate, 1e-9))
+                )
+            else:
+                # More than the estimate; all we can say is that we are close.
+                report += ", 99%, ETA unknown"
+        return report
+
+    def __write(self, report: str) -> None:
+        if self.overwrite:
+            # Pad to erase what is left of a longer previous report.
+            self.stream.write("\r%-79s" % report)
+        else:
+            self.stream.write(report + "\n")
+        self.stream.flush()
+        self.reported = True
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+def count_index_entries(media_index: Any) -> int:
+    """
+    The number of directories and files in an index. Exact for in-memory and
+    binary indexes. For lazily read JSON indexes, only directories that hold
+    files are counted, which is close enough for an estimate.
+    """
+    if isinstance(media_index, MappedIndex):
+        return media_index.node_count + media_index.file_count
+    if isinstance(media_index, DirectoryIndex):
+        entries = 0
+        pending = [media_index]
+        while pending:
+            entries += 1
+            for item in pending.pop().index:
+                if isinstance(item, DirectoryIndex):
+                    pending.append(item)
+                else:
+                    entries += 1
+        return entries
+
+    directories: Set[Tuple[str, ...]] = {()}
+    files = 0
+    for parts, _ in media_index.iter_files():
+        directories.add(parts)
+        files += 1
+    return len(directories) + files
+
+def estimate_media_entries(sector_path: str) -> Optional[int]:
+    """
+    The number of directories and files on a medium mounted at `sector_path`,
+    going by the inodes in use on its filesystem. None if `sector_path` is not
+    a mount point (the filesystem holds more than the medium then) or if the
+    filesystem does not keep count of its inodes, like FAT.
+    """
+    if not os.path.ismount(sector_path):
+        return None
+    try:
+        fs_stat = os.statvfs(sector_path)
+    except (AttributeError, OSError):
+        return None
+    if fs_stat.f_files <= 0:
+        return None
+    return fs_stat.f_files - fs_stat.f_ffree
+
+class RunMetrics(object):
+    """
+    Wall and CPU time spent in each phase of a run, and counters of the work
+    done, for `--profile` and `--metrics`.
+
+    Phases nest, and the time of a phase excludes the time of the phases
+    nested in it, so that the phases of a run add up to (about) its total. CPU
+    time is that of the whole process, worker threads included.
+    """
+
+    def __init__(self, command: str, labels: Optional[Dict[str, str]]=None) -> None:
+        self.command = command
+        self.labels: Dict[str, str] = dict(labels or {})
+        self.started = time.time()
+        self.started_wall = time.perf_counter()
+        self.started_cpu = time.process_time()
+        # Phase name to [wall seconds, CPU seconds].
+        self.phases: Dict[str, List[float]] = {}
+        self.counters: Dict[str, int] = {}
+        # [wall at start, CPU at start, wall of nested phases, CPU of nested
+        # phases] for every phase currently open, innermost last.
+        self._open: List[List[float]] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        frame = [time.perf_counter(), time.process_time(), 0.0, 0.0]
+        self._open.append(frame)
+        try:
+            yield
+        finally:
+            self._open.pop()
+            wall = time.perf_counter() - frame[0]
+            cpu = time.process_time() - frame[1]
+            self.add_phase(name, wall - frame[2], cpu - frame[3])
+            if self._open:
+                self._open[-1][2] += wall
+                self._open[-1][3] += cpu
+
+    def add_phase(self, name: str, wall: float, cpu: float) -> None:
+        totals = self.phases.setdefault(name, [0.0, 0.0])
+        totals[0] += wall
+        totals[1] += cpu
+
+    def count(self, name: str, amount: int=1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, other: "RunMetrics") -> None:
+        """
+        Add the phases and counters of `other`, e.g. of a medium indexed in a
+        worker process, to these.
+        """
+        for name, (wall, cpu) in other.phases.items():
+            self.add_phase(name, wall, cpu)
+        for name, amount in other.counters.items():
+            self.count(name, amount)
+
+    def to_dict(self) -> Dict[str, Any]:
+        wall = time.perf_counter() - self.started_wall
+        walked = self.counters.get("directories", 0) + self.counters.get("files", 0)
+        walk_wall = self.phases.get("walk", [wall])[0]
+        return {
+            "command": self.command,
+            "labels": self.labels,
+            "started": self.started,
+            "wall_seconds": wall,
+            "cpu_seconds": time.process_time() - self.started_cpu,
+            "phases": {
+                name: {"wall_seconds": phase_wall, "cpu_seconds": phase_cpu}
+                for name, (phase_wall, phase_cpu) in self.phases.items()
+            },
+            "counters": dict(self.counters),
+            "entries_per_second": walked / max(walk_wall, 1e-9) if walked else 0.0,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "peak_rss_children_bytes": peak_rss_bytes(children=True)
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        The metrics in the text exposition format, for node_exporter's textfile
+        collector. Every sample carries the command and the labels of the run.
+        """
+        metrics = self.to_dict()
+        lines: List[str] = []
+
+        def gauge(name: str, help_text: str, samples: List[Tuple[Dict[str, str], float]]) -> None:
+            if not samples:
+                return
+            lines.append("# HELP chadow_%s %s" % (name, help_text))
+            lines.append("# TYPE chadow_%s gauge" % name)
+            for extra_labels, value in samples:
+                labels = dict({"command": self.command}, **self.labels)
+                labels.update(extra_labels)
+                lines.append("chadow_%s{%s} %r" % (
+                    name,
+                    ",".join('%s="%s"' % (key, _prometheus_escape(value)) for key, value in sorted(labels.items())),
+                    float(value)
+                ))
+
+        gauge("last_run_timestamp_seconds", "When the run started.", [({}, metrics["started"])])
+        gauge("run_wall_seconds", "Wall time of the run.", [({}, metrics["wall_seconds"])])
+        gauge("run_cpu_seconds", "CPU time of the run.", [({}, metrics["cpu_seconds"])])
+        gauge(
+            "phase_wall_seconds", "Wall time spent in each phase of the run.",
+            [({"phase": name}, phase["wall_seconds"]) for name, phase in sorted(metrics["phases"].items())]
+        )
+        gauge(
+            "phase_cpu_seconds", "CPU time spent in each phase of the run.",
+            [({"phase": name}, phase["cpu_seconds"]) for name, phase in sorted(metrics["phases"].items())]
+        )
+        for name, value in sorted(metrics["counters"].items()):
+            gauge(name, "Count of %s in the run." % name.replace("_", " "), [({}, value)])
+        gauge(
+            "entries_per_second", "Directories and files walked per second.",
+            [({}, metrics["entries_per_second"])]
+        )
+        gauge("peak_rss_bytes", "Peak resident set size.", [
+            ({"process": process}, metrics[key])
+            for process, key in (("self", "peak_rss_bytes"), ("children", "peak_rss_children_bytes"))
+            if metrics[key] is not None
+        ])
+        return "\n".join(lines) + "\n"
+
+    def report(self) -> List[str]:
+        """
+        Human-readable lines for `--profile`, slowest phase first.
+        """
+        metrics = self.to_dict()
+        lines = ["%s: %.2fs wall, %.2fs CPU" % (
+            self.command, metrics["wall_seconds"], metrics["cpu_seconds"]
+        )]
+        for name, phase in sorted(metrics["phases"].items(), key=lambda item: -item[1]["wall_seconds"]):
+            lines.append("  %-12s %8.2fs wall %8.2fs CPU %5.1f%%" % (
+                name, phase["wall_seconds"], phase["cpu_seconds"],
+                100.0 * phase["wall_seconds"] / max(metrics["wall_seconds"], 1e-9)
+            ))
+        for name, value in sorted(metrics["counters"].items()):
+            lines.append("  %-12s %d" % (name, value))
+        if metrics["entries_per_second"]:
+            lines.append("  %-12s %.0f entries/s" % ("rate", metrics["entries_per_second"]))
+        if metrics["peak_rss_bytes"] is not None:
+            lines.append("  %-12s %.1f MiB" % ("peak RSS", metrics["peak_rss_bytes"] / (1 << 20)))
+        return lines
+
+    def write(self, filename: str, metrics_format: str) -> None:
+        """
+        Write the metrics as "json" or "prometheus" to `filename`, atomically so
+        that a collector never reads half a file.
+        """
+        partial_filename = filename + ".partial"
+        with open(partial_filename, "w") as metrics_file:
+            if metrics_format == "prometheus":
+                metrics_file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), metrics_file, indent=2, sort_keys=True)
+                metrics_file.write("\n")
+        os.replace(partial_filename, filename)
+
+def _prometheus_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def peak_rss_bytes(children: bool=False) -> Optional[int]:
+    """
+    The peak resident set size of this process or, with `children`, of the
+    largest of its waited-for children. None where it can't be told.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Linux reports kilobytes, macOS bytes.
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+def _metrics_phase(metrics: Optional[RunMetrics], name: str) -> ContextManager[None]:
+    return metrics.phase(name) if metrics is not None else contextlib.nullcontext()
+
+class _TimedRawFile(io.RawIOBase):
+    """
+    A raw file whose writes count as the "write" phase of a run, so that the
+    time spent getting an index onto the disk can be told apart from the time
+    spent serializing it. Buffered, it is only entered once per buffer-full.
+    """
+
+    def __init__(self, raw: io.RawIOBase, metrics: RunMetrics) -> None:
+        self.raw = raw
+        self.metrics = metrics
+
+    def writable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self.raw.fileno()
+
+    def write(self, b: Any) -> Optional[int]:
+        with self.metrics.phase("write"):
+            written = self.raw.write(b)
+        self.metrics.count("bytes_written", written or 0)
+        return written
+
+    def close(self) -> None:
+        if not self.closed:
+            with self.metrics.phase("write"):
+                self.raw.close()
+        super().close()
+
+def _open_for_write(filename: str, binary: bool, metrics: Optional[RunMetrics]) -> IO[Any]:
+    """
+    Open an index file for writing, timing the writes when profiling.
+    """
+    if metrics is None:
+        return open(filename, "wb" if binary else "w+")
+
+    buffered = io.BufferedWriter(_TimedRawFile(io.FileIO(filename, "w"), metrics), 1 << 16)
+    return buffered if binary else io.TextIOWrapper(buffered)
+
+def iter_diffbins(sector_sets: Dict[str, Collection[str]]) -> Iterator[Tuple[str, Tuple[str, str]]]:
+    """
+    Single pass over every item in every sector. Each item is mapped to a
+    bitmask of the sectors that have it; an item whose mask is not full is then
+    put in the diff bin of every sector missing from its mask, once for every
+    sector that does have it.
+
+    Yields `(sector, (other_sector, item))` for every diff bin entry as it is
+    found, so that a report can be written out without collecting the bins.
+    """
+    sectors = list(sector_sets)
+    membership: Dict[str, int] = {}
+    for bit, sector in enumerate(sectors):
+        sector_bit = 1 << bit
+        for item in sector_sets[sector]:
+            membership[item] = membership.get(item, 0) | sector_bit
+
+    full_mask = (1 << len(sectors)) - 1
+    # Items tend to share the same few masks, so split each mask only once.
+    split_masks: Dict[int, Tuple[List[str], List[str]]] = {}
+    for item, mask in membership.items():
+        if mask == full_mask:
+            continue
+
+        if mask not in split_masks:
+            split_masks[mask] = (
+                [sector for bit, sector in enumerate(sectors) if mask & (1 << bit)],
+                [sector for bit, sector in enumerate(sectors) if not mask & (1 << bit)]
+            )
+        having, lacking = split_masks[mask]
+        for sector in lacking:
+            for other_sector in having:
+                yield sector, (other_sector, item)
+
+def make_diffbins(sector_sets: Dict[str, Set[str]]) -> SectorDiffMapping:
+    mapping: SectorDiffMapping = {sector:[] for sector in sector_sets}
+    for sector, entry in iter_diffbins(sector_sets):
+        mapping[sector].append(entry)
+
+    return mapping
+
+def make_filename_diffbins(sector_sets: Dict[str, Set[str]]) -> SectorDiffMapping:
+    """
+    This is the filename comparator.
+    """
+    return make_diffbins(sector_sets)
+
+def sector_size_extremes(
+    sector_sets: Dict[str, Collection[str]]
+) -> Tuple[Optional[Tuple[str, int]], Optional[Tuple[str, int]]]:
+    """
+    The largest and smallest sectors, each with its item count.
+    """
+    sizes = [(sector, len(items)) for sector, items in sector_sets.items()]
+    if not sizes:
+        return None, None
+    return max(sizes, key=lambda size: size[1]), min(sizes, key=lambda size: size[1])
+
+def make_comparison_report(
+    sector_sets: Dict[str, Set[str]],
+    make_diffbins_fn: Callable[[Dict[str, Set[str]]], SectorDiffMapping]=make_filename_diffbins
+) -> SectorComparisonReport:
+    """
+    Compare the item sets of every sector in a library. The largest and
+    smallest sectors are reported with their item counts.
+    """
+    largest_sector, smallest_sector = sector_size_extremes(sector_sets)
+    return SectorComparisonReport(
+        largest_sector, smallest_sector, make_diffbins_fn(sector_sets)
+    )
+
+def match_moves(
+    entries: Iterable[Tuple[str, Tuple[str, str]]],
+    signatures: Callable[[Set[Tuple[str, str]]], Dict[Tuple[str, str], FileSignature]],
+    same_file: Optional[Callable[[Tuple[str, str], Tuple[str, str]], bool]]=None
+) -> Tuple[List[Tuple[str, Tuple[str, str]]], List[SectorMove]]:
+    """
+    Pair up the diff bin entries (as from `iter_diffbins`) that are one file
+    moved or renamed on one of two sectors, i.e. an item that a sector lacks
+    and another item that the other sector lacks, where both stand for files
+    with the same signature. `signatures` is given the `(sector, item)` pairs
+    whose signatures are needed and maps them to their signatures.
+
+    Only signatures that single out one file on each side are paired, and
+    never two with different content hashes. Size and mtime alone are a weak
+    match: unless both content hashes are known, `same_file` (if given) is
+    asked whether the two items are the same file. Returns the entries left
+    over, and the moves, once from the side of each of the two sectors.
+
+    This needs the whole diff, so nothing is returned before it is all in.
+    """
+    entries = list(entries)
+    missing: Dict[Tuple[str, str], List[str]] = {}
+    for sector, (other_sector, item) in entries:
+        missing.setdefault((sector, other_sector), []).append(item)
+    pairs = [
+        (sector, other_sector) for sector, other_sector in missing
+        if sector < other_sector and (other_sector, sector) in missing
+    ]
+    wanted: Set[Tuple[str, str]] = set()
+    for sector, other_sector in pairs:
+        wanted.update((other_sector, item) for item in missing[(sector, other_sector)])
+        wanted.update((sector, item) for item in missing[(other_sector, sector)])
+    file_signatures = signatures(wanted)
+
+    def by_key(sector: str, items: List[str]) -> Dict[Any, List[str]]:
+        keyed: Dict[Any, List[str]] = {}
+        for item in items:
+            file_signature = file_signatures.get((sector, item))
+            if file_signature is not None:
+                keyed.setdefault(file_signature[0], []).append(item)
+        return keyed
+
+    moves: List[SectorMove] = []
+    for sector, other_sector in pairs:
+        there = by_key(other_sector, missing[(sector, other_sector)])
+        here = by_key(sector, missing[(other_sector, sector)])
+        for key in there.keys() & here.keys():
+            if len(there[key]) != 1 or len(here[key]) != 1:
+                continue
+            item, own_item = there[key][0], here[key][0]
+            digest = file_signatures[(other_sector, item)][1]
+            own_digest = file_signatures[(sector, own_item)][1]
+            if digest is not None and own_digest is not None:
+                if digest != own_digest:
+                    continue
+            elif same_file is not None and not same_file((other_sector, item), (sector, own_item)):
+                continue
+            moves.append((sector, other_sector, item, own_item))
+            moves.append((other_sector, sector, own_item, item))
+
+    moved = {(sector, (other_sector, item)) for sector, other_sector, item, _ in moves}
+    return [entry for entry in entries if entry not in moved], moves
+
+class HashCache(object):
+    """
+    Content hashes of the files on a medium, kept next to its index so that
+    files only need to be read again when they change. Entries are keyed on
+    the (device, inode, size, mtime_ns) of the file they were computed from.
+    Saving drops the entries that were not looked up since loading, so files
+    that are gone do not linger in the cache.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.entries: Dict[str, str] = {}
+        self.__seen: Set[str] = set()
+
+    @staticmethod
+    def key(file_stat: os.stat_result) -> str:
+        return "%d:%d:%d:%d" % (
+            file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+        )
+
+    def load(self) -> "HashCache":
+        try:
+            with open(self.filename, "r") as cache_file:
+                cached = json.load(cache_file)
+            if cached.get("algorithm") == CONTENT_HASH_ALGORITHM:
+                self.entries = cached["entries"]
+            else:
+                logging.info("Hash cache %s uses another algorithm. Ignoring it." % self.filename)
+        except FileNotFoundError:
+            pass
+        except (json.decoder.JSONDecodeError, KeyError, TypeError, AttributeError):
+            logging.warning("Hash cache %s is unreadable. Ignoring it." % self.filename)
+
+        return self
+
+    def get(self, key: str) -> Optional[str]:
+        self.__seen.add(key)
+        return self.entries.get(key)
+
+    def put(self, key: str, digest: str) -> None:
+        self.__seen.add(key)
+        self.entries[key] = digest
+
+    def save(self, prune: bool=True) -> None:
+        """
+        Unless `prune` is unset, entries that were not looked up are dropped.
+        """
+        if prune:
+            entries = {key: self.entries[key] for key in self.__seen if key in self.entries}
+        else:
+            entries = self.entries
+        partial_filename = self.filename + ".partial"
+        with open(partial_filename, "w") as cache_file:
+            json.dump(
+                {"version": get_version(), "algorithm": CONTENT_HASH_ALGORITHM, "entries": entries},
+                cache_file
+            )
+        os.replace(partial_filename, self.filename)
+
+def hash_file(path: str) -> str:
+    """
+    Hex digest of the contents of the file at `path`, read in large chunks
+    into a reused buffer.
+    """
+    digest = hashlib.new(CONTENT_HASH_ALGORITHM)
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as media_file:
+        while True:
+            read = media_file.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+
+    return digest.hexdigest()
+
+def hash_file_ends(path: str, size: int, block_size: int=DUPES_BLOCK_SIZE) -> str:
+    """
+    Hex digest of the first and the last `block_size` bytes of a file of `size`
+    bytes. Files no larger than two blocks are hashed whole, so their digest is
+    the same as `hash_file`'s.
+    """
+    digest = hashlib.new(CONTENT_HASH_ALGORITHM)
+    with open(path, "rb", buffering=0) as media_file:
+        if size <= 2 * block_size:
+            digest.update(media_file.readall())
+        else:
+            digest.update(os.pread(media_file.fileno(), block_size, 0))
+            digest.update(os.pread(media_file.fileno(), block_size, size - block_size))
+    return digest.hexdigest()
+
+def _hash_or_none(hash_fn: Callable[..., Optional[str]], *args: Any) -> Optional[str]:
+    try:
+        return hash_fn(*args)
+    except OSError as e:
+        logging.warning("Unable to hash %s: %s" % (args[0], e))
+        return None
+
+def find_duplicates(
+    files: Iterable[Tuple[str, int]], workers: int=DEFAULT_HASH_WORKERS,
+    hash_full: Optional[Callable[[str], Optional[str]]]=None,
+    block_size: int=DUPES_BLOCK_SIZE
+) -> List[Tuple[int, List[str]]]:
+    """
+    The groups of files with the same contents among `files`, given as pairs of
+    path and size. Each group comes with the size of its files, and the groups
+    that waste the most space come first.
+
+    Files are told apart in stages, each of which only goes through the files
+    the one before could not tell apart:
+
+    1. Files are grouped by size, without being read.
+    2. Files that share their size have their first and last `block_size`
+       bytes hashed.
+    3. Files whose ends match are hashed whole with `hash_full` (by default,
+       `hash_file`), unless their ends were all of them.
+
+    Hashing is spread over `workers` threads. Files that can't be read are
+    left out.
+    """
+    hash_full = hash_full or hash_file
+    by_size: Dict[int, List[str]] = {}
+    for path, size in files:
+        by_size.setdefault(size, []).append(path)
+    groups: Dict[Tuple[Any, ...], List[str]] = {
+        (size,): paths for size, paths in by_size.items() if len(paths) > 1
+    }
+    by_size = {}
+    logging.info(
+        "%d file(s) in %d group(s) share their size." %
+        (sum(len(paths) for paths in groups.values()), len(groups))
+    )
+
+    def split(
+        groups: Dict[Tuple[Any, ...], List[str]], hash_fn: Callable[[Tuple[Any, ...], str], Optional[str]]
+    ) -> Dict[Tuple[Any, ...], List[str]]:
+        jobs = [(key, path) for key, paths in groups.items() for path in paths]
+        split_groups: Dict[Tuple[Any, ...], List[str]] = {}
+        with concurrent_futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            digests = pool.map(lambda job: hash_fn(*job), jobs)
+            for (key, path), digest in zip(jobs, digests):
+                if digest is not None:
+                    split_groups.setdefault(key + (digest,), []).append(path)
+        return {key: paths for key, paths in split_groups.items() if len(paths) > 1}
+
+    groups = split(
+        groups, lambda key, path: _hash_or_none(hash_file_ends, path, key[0], block_size)
+    )
+    whole = {key: paths for key, paths in groups.items() if key[0] <= 2 * block_size}
+    groups = {key: paths for key, paths in groups.items() if key[0] > 2 * block_size}
+    logging.info(
+        "%d file(s) in %d group(s) also share their ends; %d of them to hash whole." % (
+            sum(len(paths) for paths in groups.values()) +
+            sum(len(paths) for paths in whole.values()),
+            len(groups) + len(whole), sum(len(paths) for paths in groups.values())
+        )
+    )
+
+    groups = split(groups, lambda key, path: _hash_or_none(hash_full, path))
+    groups.update(whole)
+    return sorted(
+        ((key[0], sorted(paths)) for key, paths in groups.items()),
+        key=lambda group: (-group[0] * (len(group[1]) - 1), group[1])
+    )
+
+def __hash_media_file(path: str, key: str) -> Tuple[Optional[str], bool]:
+    """
+    Hash a file for the content comparator. Also tells whether the file was
+    left alone while it was being read, which is when its hash can be cached.
+    """
+    try:
+        digest = hash_file(path)
+        return digest, HashCache.key(os.stat(path)) == key
+    except OSError as e:
+        logging.warning("Unable to hash %s: %s" % (path, e))
+        return None, False
+
+def __cached_media_hash(path: str, cache: HashCache) -> Optional[str]:
+    """
+    Hash a file the same way as for the content comparator, through the hash
+    cache of the medium it is on.
+    """
+    key = HashCache.key(os.stat(path))
+    digest = cache.get(key)
+    if digest is None:
+        digest, cacheable = __hash_media_file(path, key)
+        if digest is not None and cacheable:
+            cache.put(key, digest)
+    return digest
+
+# A comparator turns the index of a medium into the identifiers of the items on
+# it, each with the path (relative to the medium) of a file that is that item.
+# Sectors are compared by these identifiers and the library's "comparator"
+# setting picks which function is used. Comparators are also given the path the
+# medium is mounted on and its index directory under APP_ROOT.
+MediaItems = Callable[[str, DirectoryIndex, str], Iterable[Tuple[str, str]]]
+
+def filename_items(
+    media_path: str, media_index: DirectoryIndex, sector_path_dir: str
+) -> Iterable[Tuple[str, str]]:
+    return (
+        (name, os.path.join(*parts, name))
+        for parts, name in media_index.iter_files()
+    )
+
+def content_items(
+    media_path: str, media_index: DirectoryIndex, sector_path_dir: str
+) -> Iterable[Tuple[str, str]]:
+    """
+    Identifies files by a hash of their contents. Hashes are cached per medium,
+    and files that are not in the cache are hashed by a pool of threads (hashlib
+    releases the GIL while it digests, as does reading from the medium).
+    Files that can't be read are left out.
+    """
+    cache = HashCache(os.path.join(sector_path_dir, HASH_CACHE_NAME)).load()
+    items: List[Tuple[str, str]] = []
+    to_hash: List[Tuple[str, str, str]] = []
+    for parts, name in media_index.iter_files():
+        relative_path = os.path.join(*parts, name)
+        path = os.path.join(media_path, relative_path)
+        try:
+            file_stat = os.stat(path)
+        except OSError as e:
+            logging.warning("Unable to stat %s: %s" % (path, e))
+            continue
+
+        if not stat.S_ISREG(file_stat.st_mode):
+            continue
+
+        key = HashCache.key(file_stat)
+        digest = cache.get(key)
+        if digest is None:
+            to_hash.append((key, relative_path, path))
+        else:
+            items.append((digest, relative_path))
+
+    logging.info(
+        "%d file(s) of %s to hash, %d cached." % (len(to_hash), media_path, len(items))
+    )
+    with concurrent_futures.ThreadPoolExecutor(max_workers=DEFAULT_HASH_WORKERS) as pool:
+        hashed = pool.map(
+            __hash_media_file,
+            [path for _, _, path in to_hash],
+            [key for key, _, _ in to_hash]
+        )
+        for (key, relative_path, _), (digest, cacheable) in zip(to_hash, hashed):
+            if digest is None:
+                continue
+            if cacheable:
+                cache.put(key, digest)
+            items.append((digest, relative_path))
+
+    cache.save()
+    return items
+
+def size_mtime_items(
+    media_path: str, media_index: DirectoryIndex, sector_path_dir: str
+) -> Iterable[Tuple[str, str]]:
+    """
+    Identifies regular files by name, size and modification time, using the
+    stats recorded in the index. This catches truncated and partial copies
+    without reading any file. Modification times are compared at
+    `SIZE_MTIME_GRANULARITY_NS` since not every filesystem keeps nanoseconds.
+
+    Files indexed without a stat are stat'd on the medium, if it is mounted.
+    """
+    for parts, name, file_stat in media_index.iter_file_stats():
+        relative_path = os.path.join(*parts, name)
+        if file_stat is None:
+            file_stat = _stat_file(os.path.join(media_path, relative_path))
+            if file_stat is None:
+                logging.warning(
+                    "No stat for %s. Leaving it out." % os.path.join(media_path, relative_path)
+                )
+                continue
+
+        size, mtime_ns, _, kind = file_stat
+        if kind == "f":
+            yield (
+                "%s\t%d\t%d" % (name, size, mtime_ns // SIZE_MTIME_GRANULARITY_NS),
+                relative_path
+            )
+
+COMPARATORS: Dict[str, MediaItems] = {
+    "filename": filename_items,
+    "size-mtime": size_mtime_items,
+    "content": content_items
+}
+
+def _catalog_name(name: str) -> Tuple[str, Optional[bytes]]:
+    """
+    SQLite text has to be valid UTF-8, so names that are not (i.e., that carry
+    surrogate escapes from the filesystem) are stored with their undecodable
+    bytes replaced, for matching, along with their raw bytes.
+    """
+    try:
+        name.encode("utf-8")
+        return name, None
+    except UnicodeEncodeError:
+        raw_name = _encode_name(name)
+        return raw_name.decode("utf-8", "replace"), raw_name
+
+def _load_catalog_name(name: str, raw_name: Optional[bytes]) -> str:
+    if raw_name is not None:
+        return raw_name.decode("utf-8", "surrogateescape")
+    return name
+
+def _catalog_parts(path: str, raw_path: Optional[bytes]) -> Tuple[str, ...]:
+    path = _load_catalog_name(path, raw_path)
+    return tuple(path.split("/")) if path else ()
+
+class CatalogMedia(object):
+    """
+    The indexed files of a medium, as stored in the catalog. Can stand in for
+    a `DirectoryIndex` wherever only its files are needed (e.g., comparators).
+    """
+
+    def __init__(self, connection: sqlite3.Connection, media_id: int) -> None:
+        self.connection = connection
+        self.media_id = media_id
+
+    def iter_files(self) -> Iterator[Tuple[Tuple[str, ...], str]]:
+        for parts, name, _ in self.iter_file_stats():
+            yield parts, name
+
+    def iter_file_stats(self) -> Iterator[Tuple[Tuple[str, ...], str, Optional[FileStat]]]:
+        rows = self.connection.execute(
+            """
+            SELECT directories.path, directories.raw_path, files.name,
+                files.raw_name, files.size, files.mtime_ns, files.inode, files.kind
+            FROM directories JOIN files ON files.directory_id = directories.id
+            WHERE directories.media_id = ?
+            """,
+            (self.media_id,)
+        )
+        for path, raw_path, name, raw_name, size, mtime_ns, inode, kind in rows:
+            file_stat = None if size is None else (size, mtime_ns, inode, kind)
+            yield (
+                _catalog_parts(path, raw_path), _load_catalog_name(name, raw_name),
+                file_stat
+            )
+
+class Catalog(object):
+    """
+    An SQLite catalog of the library mapping in the config and of the index of
+    every medium. It is created by `initcatalog`; from then on, every command
+    that changes the config or an index updates it in the same transaction, and
+    lookups across media become indexed queries instead of loads of whole
+    index files.
+
+    Directories are stored by their path relative to their medium, with their
+    parts joined by "/" (which can't appear in a name). See `_catalog_name` for
+    names that are not valid UTF-8.
+    """
+    SCHEMA_VERSION: int = 1
+    SCHEMA: str = """
+        CREATE TABLE IF NOT EXISTS libraries (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            comparator TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sectors (
+            id INTEGER PRIMARY KEY,
+            library_id INTEGER NOT NULL REFERENCES libraries (id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            UNIQUE (library_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS media (
+            id INTEGER PRIMARY KEY,
+            sector_id INTEGER NOT NULL REFERENCES sectors (id) ON DELETE CASCADE,
+            path TEXT NOT NULL,
+            -- The chadow version that indexed this medium, NULL until then.
+            version TEXT,
+            UNIQUE (sector_id, path)
+        );
+        CREATE TABLE IF NOT EXISTS directories (
+            id INTEGER PRIMARY KEY,
+            media_id INTEGER NOT NULL REFERENCES media (id) ON DELETE CASCADE,
+            path TEXT NOT NULL,
+            raw_path BLOB
+        );
+        CREATE INDEX IF NOT EXISTS directories_by_media ON directories (media_id, path);
+        CREATE TABLE IF NOT EXISTS files (
+            directory_id INTEGER NOT NULL REFERENCES directories (id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            raw_name BLOB,
+            size INTEGER,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            kind TEXT
+        );
+        CREATE INDEX IF NOT EXISTS files_by_directory ON files (directory_id);
+        CREATE INDEX IF NOT EXISTS files_by_name ON files (name);
+    """
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.connection = connection
+        self.connection.execute("PRAGMA foreign_keys = ON")
+
+    @staticmethod
+    def create(filename: str) -> "Catalog":
+        catalog = Catalog(sqlite3.connect(filename, isolation_level=None))
+        # Lets compare's worker processes read while an index is being stored.
+        catalog.connection.execute("PRAGMA journal_mode = WAL")
+        catalog.connection.executescript(Catalog.SCHEMA)
+        catalog.connection.execute("PRAGMA user_version = %d" % Catalog.SCHEMA_VERSION)
+        return catalog
+
+    @staticmethod
+    def open(filename: str) -> Optional["Catalog"]:
+        """
+        Open an existing catalog. None if there is none, or if it is unusable.
+        """
+        if not os.path.exists(filename):
+            # Spares the commands that would only fall back to the config the
+            # import of sqlite3.
+            return None
+
+        try:
+            connection = sqlite3.connect(
+                "file:%s?mode=rw" % urllib_parse.quote(filename),
+                uri=True, isolation_level=None
+            )
+            schema_version = connection.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+        if schema_version != Catalog.SCHEMA_VERSION:
+            logging.warning(
+                "Catalog %s has an unknown schema. Ignoring it; run initcatalog to rebuild it." %
+                filename
+            )
+            connection.close()
+            return None
+
+        return Catalog(connection)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator["Catalog"]:
+        """
+        Everything done within is committed together, or not at all. Exiting
+        the program (as commands do on errors) also rolls back.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def __library_id(self, library: str) -> Optional[int]:
+        row = self.connection.execute(
+            "SELECT id FROM libraries WHERE name = ?", (library,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def __sector_id(self, library: str, sector_name: str) -> Optional[int]:
+        row = self.connection.execute(
+            """
+            SELECT sectors.id FROM sectors JOIN libraries ON sectors.library_id = libraries.id
+            WHERE libraries.name = ? AND sectors.name = ?
+            """,
+            (library, sector_name)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def __media_row(self, library: str, sector_name: str, media_path: str) -> Optional[Tuple[int, Optional[str]]]:
+        return self.connection.execute(
+            """
+            SELECT media.id, media.version
+            FROM media JOIN sectors ON media.sector_id = sectors.id
+                JOIN libraries ON sectors.library_id = libraries.id
+            WHERE libraries.name = ? AND sectors.name = ? AND media.path = ?
+            """,
+            (library, sector_name, media_path)
+        ).fetchone()
+
+    def add_library(self, name: str, comparator: str) -> None:
+        self.remove_library(name)
+        self.connection.execute(
+            "INSERT INTO libraries (name, comparator) VALUES (?, ?)", (name, comparator)
+        )
+
+    def remove_library(self, name: str) -> None:
+        self.connection.execute("DELETE FROM libraries WHERE name = ?", (name,))
+
+    def add_sector(self, library: str, sector_name: str) -> None:
+        self.connection.execute(
+            "INSERT OR IGNORE INTO sectors (library_id, name) SELECT id, ? FROM libraries WHERE name = ?",
+            (sector_name, library)
+        )
+
+    def add_media(self, library: str, sector_name: str, media_path: str) -> None:
+        sector_id = self.__sector_id(library, sector_name)
+        if sector_id is not None:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO media (sector_id, path) VALUES (?, ?)",
+                (sector_id, media_path)
+            )
+
+    def sync_mapping(self, config: "ChadowConfig") -> None:
+        """
+        Replace the library mapping in the catalog with that of `config`. This
+        drops every stored index too.
+        """
+        self.connection.execute("DELETE FROM libraries")
+        for library, data_library in config.get("libraryMapping", {}).items():
+            self.add_library(library, data_library.get("comparator", "filename"))
+            for sector_name, media_paths in data_library["sectors"].items():
+                self.add_sector(library, sector_name)
+                for media_path in media_paths:
+                    self.add_media(library, sector_name, media_path)
+
+    def libraries(self) -> List[str]:
+        return [
+            name for name, in
+            self.connection.execute("SELECT name FROM libraries ORDER BY id")
+        ]
+
+    def sectors(self, library: str) -> Optional[List[str]]:
+        library_id = self.__library_id(library)
+        if library_id is None:
+            return None
+        return [
+            name for name, in self.connection.execute(
+                "SELECT name FROM sectors WHERE library_id = ? ORDER BY id", (library_id,)
+            )
+        ]
+
+    def media_paths(self, library: str, sector_name: str) -> Optional[List[str]]:
+        sector_id = self.__sector_id(library, sector_name)
+        if sector_id is None:
+            return None
+        return [
+            path for path, in self.connection.execute(
+                "SELECT path FROM media WHERE sector_id = ? ORDER BY id", (sector_id,)
+            )
+        ]
+
+    def begin_index(self, library: str, sector_name: str, media_path: str) -> Optional[int]:
+        """
+        Clear the stored index of a medium so that a new one can be stored with
+        `store_directory` and `finish_index`. Returns the id of the medium, or
+        None if it is not in the catalog.
+        """
+        media_row = self.__media_row(library, sector_name, media_path)
+        if media_row is None:
+            logging.warning(
+                "%s is not in the catalog. Run initcatalog to bring it up to date." % media_path
+            )
+            return None
+
+        media_id = media_row[0]
+        self.connection.execute("DELETE FROM directories WHERE media_id = ?", (media_id,))
+        self.connection.execute("UPDATE media SET version = NULL WHERE id = ?", (media_id,))
+        return media_id
+
+    def __insert_directory(
+        self, media_id: int, parts: Tuple[str, ...],
+        files: Iterable[Tuple[str, Optional[FileStat]]]
+    ) -> None:
+        directory_id = self.connection.execute(
+            "INSERT INTO directories (media_id, path, raw_path) VALUES (?, ?, ?)",
+            (media_id,) + _catalog_name("/".join(parts))
+        ).lastrowid
+        rows = [
+            (directory_id,) + _catalog_name(name) +
+            (file_stat if file_stat is not None else (None, None, None, None))
+            for name, file_stat in files
+        ]
+        self.connection.executemany(
+            """
+            INSERT INTO files (directory_id, name, raw_name, size, mtime_ns, inode, kind)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows
+        )
+
+    def store_directory(self, media_id: int, parts: Tuple[str, ...], dir_index: DirectoryIndex) -> None:
+        """
+        Store the files directly under `dir_index`. Its subdirectories are
+        stored with calls of their own.
+        """
+        self.__insert_directory(media_id, parts, (
+            (item, dir_index.file_stat(item))
+            for item in dir_index.index if not isinstance(item, DirectoryIndex)
+        ))
+
+    def finish_index(self, media_id: int, version: Optional[str]=None) -> None:
+        self.connection.execute(
+            "UPDATE media SET version = ? WHERE id = ?", (version or get_version(), media_id)
+        )
+
+    def store_index(
+        self, library: str, sector_name: str, media_path: str, root_index: DirectoryIndex
+    ) -> None:
+        media_id = self.begin_index(library, sector_name, media_path)
+        if media_id is None:
+            return
+
+        pending: List[Tuple[Tuple[str, ...], DirectoryIndex]] = [((), root_index)]
+        while pending:
+            parts, dir_index = pending.pop()
+            self.store_directory(media_id, parts, dir_index)
+            pending.extend(
+                (parts + (item.subdir_path or "",), item)
+                for item in dir_index.index if isinstance(item, DirectoryIndex)
+            )
+        self.finish_index(media_id, root_index.version)
+
+    def store_records(
+        self, library: str, sector_name: str, media_path: str, records: Iterable[str]
+    ) -> None:
+        """
+        Like `store_index`, from the line-delimited records written by
+        `StreamingIndexWriter`, one directory at a time.
+        """
+        media_id = self.begin_index(library, sector_name, media_path)
+        if media_id is None:
+            return
+
+        lines = iter(records)
+        header = json.loads(next(lines))
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            stats = record.get("stats") or {}
+            self.__insert_directory(media_id, tuple(record["path"]), (
+                (name, _load_file_stat(stats.get(name))) for name in record["index"]
+            ))
+        self.finish_index(media_id, header.get("version"))
+
+    def media_index(self, library: str, sector_name: str, media_path: str) -> Optional[CatalogMedia]:
+        """
+        The stored index of a medium. None if it has not been indexed since the
+        catalog was created.
+        """
+        media_row = self.__media_row(library, sector_name, media_path)
+        if media_row is None or media_row[1] is None:
+            return None
+        return CatalogMedia(self.connection, media_row[0])
+
+    def locate(self, library: str, pattern: str) -> Iterator[Tuple[str, str, str]]:
+        """
+        Every file in `library` whose name matches the glob `pattern`, as
+        (sector, media path, path relative to the medium). Patterns with a
+        literal prefix are answered from the index on file names.
+        """
+        rows = self.connection.execute(
+            """
+            SELECT sectors.name, media.path, directories.path, directories.raw_path,
+                files.name, files.raw_name
+            FROM files JOIN directories ON files.directory_id = directories.id
+                JOIN media ON directories.media_id = media.id
+                JOIN sectors ON media.sector_id = sectors.id
+                JOIN libraries ON sectors.library_id = libraries.id
+            WHERE libraries.name = ? AND files.name GLOB ?
+            ORDER BY sectors.id, media.id, directories.path, files.name
+            """,
+            (library, _catalog_name(pattern)[0])
+        )
+        for sector_name, media_path, path, raw_path, name, raw_name in rows:
+            yield (
+                sector_name, media_path,
+                os.path.join(
+                    *_catalog_parts(path, raw_path), _load_catalog_name(name, raw_name)
+                )
+            )
+
+@click.group()
+def cli():
+    # Configured here rather than on import so that importing chadow (for the
+    # benchmarks, say) leaves the root logger alone.
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+DataLibrary = TypedDict(
+    "DataLibrary",
+    {
+        "sectors": Dict[str, List[str]],
+        "comparator": str,
+        # Lines of a .gitignore; see `ExcludeRules`.
+        "exclude": List[str]
+    }
+)
+ChadowConfig = TypedDict(
+    "ChadowConfig",
+    {
+        "version": str,
+        "installationId": str,
+        "libraryMapping": Dict[str, DataLibrary]
+    }
+)
+
+def __version_check(cfg_dict: ChadowConfig):
+    """
+    Side-effect-ful version check: check config version and inform user as
+    necessary.
+    """
+    version = cfg_dict.get("version")
+    if version and version != get_version():
+        logging.warning("loading a chadow config from an old version.")
+    elif not version:
+        logging.warning("config does not specify a version.")
+
+class BatchSession(object):
+    """
+    The config and catalog shared by the commands of a `batch`. The config is
+    read once and kept in memory, and the catalog is kept in one transaction,
+    until the batch commits.
+
+    Commands also change things outside of the config and the catalog (index
+    directories, the metadata on media) as they go. They leave a way to undo
+    each change in `undo`, which `rollback` goes through, latest first.
+    """
+
+    def __init__(self, config_filename: str) -> None:
+        self.config_filename = config_filename
+        self.config: Optional[ChadowConfig] = None
+        self.dirty = False
+        self.undo: List[Callable[[], None]] = []
+        self.__catalog: Optional[Catalog] = None
+        self.__catalog_opened = False
+
+    def catalog(self) -> Optional[Catalog]:
+        if not self.__catalog_opened:
+            self.__catalog = open_catalog()
+            if self.__catalog is not None:
+                self.__catalog.connection.execute("BEGIN IMMEDIATE")
+            self.__catalog_opened = True
+        return self.__catalog
+
+    def end_catalog(self, commit: bool) -> None:
+        if self.__catalog is not None:
+            self.__catalog.connection.execute("COMMIT" if commit else "ROLLBACK")
+            self.__catalog.close()
+        self.__catalog = None
+        self.__catalog_opened = False
+
+    def rollback(self) -> None:
+        """
+        Drop the changes made since the last commit.
+        """
+        self.end_catalog(commit=False)
+        while self.undo:
+            try:
+                self.undo.pop()()
+            except OSError as e:
+                logging.error("Unable to undo a change: %s" % e)
+
+# Set while `batch` runs its commands.
+_batch_session: Optional[BatchSession] = None
+
+def __read_config(full_config_name: str) -> ChadowConfig:
+    config: ChadowConfig = {"version": get_version(), "libraryMapping": {}}
+    with open(full_config_name, "r") as config_file:
+        config = json.load(config_file)
+        __version_check(config)
+
+    return config
+
+def __config_load(full_config_name: str) -> ChadowConfig:
+    """
+    Load the config from the specified filename. Also performs verification that
+    the config is valid.
+
+    In a batch, the config is only read the first time and then shared by the
+    commands that follow.
+    """
+    session = _batch_session
+    if session is None or session.config_filename != full_config_name:
+        return __read_config(full_config_name)
+
+    if session.config is None:
+        session.config = __read_config(full_config_name)
+    return session.config
+
+def __write_config_file(updated_config: ChadowConfig, config_filename: str) -> None:
+    # Swapped in once completely written, so that a failed write can't leave a
+    # truncated config behind.
+    partial_filename = config_filename + ".partial"
+    with open(partial_filename, "w") as config_file:
+        json.dump(updated_config, config_file)
+    os.replace(partial_filename, config_filename)
+
+def __write_cfg(updated_config: ChadowConfig, config_filename: str, log_mesg: str):
+    session = _batch_session
+    if session is not None and session.config_filename == config_filename:
+        # Written when the batch commits.
+        session.config = updated_config
+        session.dirty = True
+    else:
+        __write_config_file(updated_config, config_filename)
+
+    logging.info(log_mesg)
+
+def __commit_batch(session: BatchSession) -> None:
+    if session.dirty and session.config is not None:
+        __write_config_file(session.config, session.config_filename)
+        session.dirty = False
+    session.end_catalog(commit=True)
+    session.undo = []
+    logging.info("Committed.")
+
+def __undo_on_rollback(undo: Callable[[], None]) -> None:
+    """
+    In a batch, have `undo` called if the batch drops the change just made.
+    """
+    if _batch_session is not None:
+        _batch_session.undo.append(undo)
+
+def open_catalog() -> Optional[Catalog]:
+    return Catalog.open(os.path.join(APP_ROOT, CATALOG_NAME))
+
+def __open_catalog_reader() -> Optional[Catalog]:
+    """
+    The catalog, for commands that only read it. In a batch, the config in
+    memory is ahead of the catalog on disk, so there it is not used.
+    """
+    if _batch_session is not None:
+        return None
+    return open_catalog()
+
+@contextlib.contextmanager
+def __catalog_transaction() -> Iterator[Optional[Catalog]]:
+    """
+    A transaction on the catalog, or None if there is no catalog. Commands
+    change the config within it so that a failure leaves the catalog as it was.
+    In a batch, this is the transaction of the whole batch.
+    """
+    if _batch_session is not None:
+        yield _batch_session.catalog()
+        return
+
+    catalog = open_catalog()
+    if catalog is None:
+        yield None
+        return
+
+    try:
+        with catalog.transaction():
+            yield catalog
+    finally:
+        catalog.close()
+
+def __read_metadata(metadata_path: str) -> Set[str]:
+    """
+    chadow leaves metadata on the media that it manages. This is a custom format
+    which should hold minimal data. At the moment, it only holds installationIds
+    which manage the given medium.
+    """
+    with open(metadata_path) as metadata:
+        manager_ids = set([uuid for uuid in metadata])
+        return manager_ids
+
+def __restore_metadata(metadata_path: str, previous_metadata: Optional[str]) -> None:
+    """
+    Put back the metadata of a medium as it was before we wrote to it.
+    """
+    try:
+        if previous_metadata is None:
+            os.remove(metadata_path)
+        else:
+            with open(metadata_path, "w") as metadata:
+                metadata.write(previous_metadata)
+    except OSError as e:
+        logging.error("Unable to restore %s: %s" % (metadata_path, e))
+
+def __normalize_path_separator(path: str):
+    return path.replace(os.path.sep, PATH_SEPARATOR_REPLACEMENT) 
+
+def __denormalize_index_dir(index_dir: str):
+    return index_dir.replace(PATH_SEPARATOR_REPLACEMENT, os.path.sep)
+
+def make_sector_dirname(library_name: str, sector_name: str):
+    return os.path.join(APP_ROOT, library_name, sector_name)
+
+def __make_sectorpath_dirname(
+    library_name: str, sector_name: str, sector_path: str
+):
+    return os.path.join(
+        APP_ROOT, library_name, sector_name, __normalize_path_separator(sector_path)
+    )
+
+INDEX_FORMATS: Dict[str, str] = {
+    "binary": BINARY_INDEX_NAME,
+    "jsonl": STREAMED_INDEX_NAME,
+    "json": INDEX_NAME
+}
+
+def __load_media_index(
+    sector_path_dir: str, lazy: bool=False
+) -> Optional[Union[DirectoryIndex, MappedIndex, LazyIndex]]:
+    """
+    Load the index of a medium from its index directory, in whichever format it
+    was last written. Returns None if there is no usable index.
+
+    If `lazy` is set and the index is in the binary or JSON format, it is
+    returned as a `MappedIndex` or `LazyIndex` (which the caller must close)
+    instead of being loaded into memory.
+    """
+    try:
+        try:
+            binary_index = MappedIndex(os.path.join(sector_path_dir, BINARY_INDEX_NAME))
+            if lazy:
+                return binary_index
+            with binary_index:
+                return binary_index.to_directory_index()
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(os.path.join(sector_path_dir, STREAMED_INDEX_NAME), "r") as index_file:
+                return DirectoryIndex.construct_from_records(index_file)
+        except FileNotFoundError:
+            index_filename = os.path.join(sector_path_dir, INDEX_NAME)
+            if lazy:
+                return LazyIndex(index_filename)
+            try:
+                with open(index_filename, "r") as index_file:
+                    return DirectoryIndex.construct_from_dict(json.load(index_file))
+            except RecursionError:
+                # json.load recurses once for every level of the tree.
+                with LazyIndex(index_filename) as lazy_index:
+                    return lazy_index.to_directory_index()
+    except FileNotFoundError:
+        logging.info("No index found in %s." % sector_path_dir)
+    except (json.decoder.JSONDecodeError, StopIteration, KeyError, TypeError, ValueError, struct.error):
+        logging.warning("Index in %s is unreadable." % sector_path_dir)
+
+    return None
+
+def __remove_if_exists(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def __remove_other_index_formats(sector_path_dir: str, kept_format: str) -> None:
+    """
+    Only the most recently written index of a medium is kept, so that there is
+    never any doubt about which one is current.
+    """
+    for index_format, index_name in INDEX_FORMATS.items():
+        if index_format != kept_format:
+            __remove_if_exists(os.path.join(sector_path_dir, index_name))
+
+def __write_media_index(
+    root_index: DirectoryIndex, sector_path_dir: str, index_format: str,
+    metrics: Optional[RunMetrics]=None
+) -> None:
+    """
+    Write a complete index in the given format. Only used for indexes that are
+    already in memory; streamed indexes are written while walking.
+    """
+    index_name = INDEX_FORMATS[index_format]
+    logging.info("Writing %s to %s" % (index_name, sector_path_dir))
+    if index_format == "binary":
+        partial_filename = os.path.join(sector_path_dir, index_name + ".partial")
+        with _metrics_phase(metrics, "serialize"):
+            with _open_for_write(partial_filename, True, metrics) as path_index:
+                write_binary_index(root_index, path_index)
+        with _metrics_phase(metrics, "write"):
+            os.replace(partial_filename, os.path.join(sector_path_dir, index_name))
+    elif index_format == "json":
+        with _metrics_phase(metrics, "serialize"):
+            with _open_for_write(os.path.join(sector_path_dir, index_name), False, metrics) as path_index:
+                root_index.write_json(path_index)
+    else:
+        with _metrics_phase(metrics, "serialize"), \
+                _open_for_write(os.path.join(sector_path_dir, index_name), False, metrics) as path_index:
+            writer = StreamingIndexWriter(path_index, version=root_index.version)
+            pending: List[Tuple[Tuple[str, ...], DirectoryIndex]] = [((), root_index)]
+            while pending:
+                parts, dir_index = pending.pop()
+                writer(parts, dir_index)
+                pending.extend(
+                    (parts + (item.subdir_path or "",), item)
+                    for item in dir_index.index if isinstance(item, DirectoryIndex)
+                )
+
+    __remove_other_index_formats(sector_path_dir, index_format)
+
+def __load_media_items(
+    library: str, sector_name: str, media_path: str, comparator: str
+) -> Optional[Dict[str, str]]:
+    """
+    The items on a medium according to the given comparator, each mapped to
+    the full path of a file that is that item. None if the medium has not been
+    indexed. Runs in a worker process when comparing.
+    """
+    sector_path_dir = __make_sectorpath_dirname(library, sector_name, media_path)
+
+    def media_items(media_index: Any) -> Dict[str, str]:
+        return {
+            item: os.path.join(media_path, relative_path)
+            for item, relative_path in COMPARATORS[comparator](
+                media_path, media_index, sector_path_dir
+            )
+        }
+
+    catalog = __open_catalog_reader()
+    if catalog is not None:
+        try:
+            catalog_index = catalog.media_index(library, sector_name, media_path)
+            if catalog_index is not None:
+                return media_items(catalog_index)
+        finally:
+            catalog.close()
+
+    media_index = __load_media_index(sector_path_dir, lazy=True)
+    if media_index is None:
+        return None
+
+    try:
+        return media_items(media_index)
+    finally:
+        if isinstance(media_index, (MappedIndex, LazyIndex)):
+            media_index.close()
+
+def __item_signatures(
+    library: str, item_media: Dict[str, Dict[str, str]],
+    sector_sets: Dict[str, Dict[str, str]], wanted: Set[Tuple[str, str]]
+) -> Dict[Tuple[str, str], FileSignature]:
+    """
+    The signatures of the files that items (as `(sector, item)` pairs) stand
+    for, for `match_moves`: their size and mtime (to `SIZE_MTIME_GRANULARITY_NS`)
+    as indexed, and their content hash if the medium is mounted and the content
+    comparator has it cached. `item_media` maps the items of each sector to
+    the medium they were loaded from. Each medium's index is read once, in
+    place.
+    """
+    by_media: Dict[Tuple[str, str], Dict[str, Tuple[str, str]]] = {}
+    for sector, item in wanted:
+        media_path = item_media[sector][item]
+        by_media.setdefault((sector, media_path), {})[
+            os.path.relpath(sector_sets[sector][item], media_path)
+        ] = (sector, item)
+
+    signatures: Dict[Tuple[str, str], FileSignature] = {}
+    for (sector, media_path), relative_paths in by_media.items():
+        sector_path_dir = __make_sectorpath_dirname(library, sector, media_path)
+        media_index = __load_media_index(sector_path_dir, lazy=True)
+        if media_index is None:
+            continue
+        cache = None
+        if os.path.isdir(media_path):
+            cache = HashCache(os.path.join(sector_path_dir, HASH_CACHE_NAME)).load()
+        try:
+            for parts, name, file_stat in media_index.iter_file_stats():
+                key = relative_paths.get(os.path.join(*parts, name))
+                if key is None or file_stat is None or file_stat[3] != "f":
+                    continue
+                digest = None
+                if cache is not None:
+                    try:
+                        digest = cache.get(HashCache.key(os.stat(sector_sets[key[0]][key[1]])))
+                    except OSError:
+                        pass
+                size, mtime_ns, _, _ = file_stat
+                signatures[key] = ((size, mtime_ns // SIZE_MTIME_GRANULARITY_NS), digest)
+        finally:
+            if isinstance(media_index, (MappedIndex, LazyIndex)):
+                media_index.close()
+    return signatures
+
+@contextlib.contextmanager
+def __same_contents(
+    library: str, item_media: Dict[str, Dict[str, str]],
+    sector_sets: Dict[str, Dict[str, str]]
+) -> Iterator[Callable[[Tuple[str, str], Tuple[str, str]], bool]]:
+    """
+    Tells, for `match_moves`, whether the files that two items (as `(sector,
+    item)` pairs) stand for have the same contents. Both are hashed through the
+    hash cache of their medium, as for the content comparator, and the caches
+    are saved on exit. Files on media that are not mounted can't be checked and
+    are taken to differ.
+    """
+    caches: Dict[Tuple[str, str], HashCache] = {}
+
+    def media_hash(sector: str, item: str) -> Optional[str]:
+        media_path = item_media[sector][item]
+        if not os.path.isdir(media_path):
+            return None
+        if (sector, media_path) not in caches:
+            caches[(sector, media_path)] = HashCache(os.path.join(
+                __make_sectorpath_dirname(library, sector, media_path), HASH_CACHE_NAME
+            )).load()
+        return _hash_or_none(
+            __cached_media_hash, sector_sets[sector][item], caches[(sector, media_path)]
+        )
+
+    def same_file(first: Tuple[str, str], second: Tuple[str, str]) -> bool:
+        digest = media_hash(*first)
+        return digest is not None and digest == media_hash(*second)
+
+    try:
+        yield same_file
+    finally:
+        for cache in caches.values():
+            cache.save(prune=False)
+
+def __write_comparison_report(
+    sector_sets: Dict[str, Dict[str, str]], emit: Callable[[str], None],
+    signatures: Optional[Callable[[Set[Tuple[str, str]]], Dict[Tuple[str, str], FileSignature]]]=None,
+    same_file: Optional[Callable[[Tuple[str, str], Tuple[str, str]], bool]]=None
+) -> Tuple[int, int]:
+    """
+    Write a comparison report as line-delimited JSON, one diff bin entry per
+    line. Returns the number of entries and of moves written.
+
+    Without `signatures`, entries are written as soon as they are found.
+    With them, moved and renamed files are told apart (see `match_moves`) and
+    written after the rest, as entries that also have the path the file was
+    `moved_from` in the sector lacking it. Nothing is written then until the
+    whole diff is in.
+    """
+    largest_sector, smallest_sector = sector_size_extremes(sector_sets)
+    emit(json.dumps({
+        "largest_sector": largest_sector, "smallest_sector": smallest_sector
+    }))
+
+    diffbins: Iterable[Tuple[str, Tuple[str, str]]] = iter_diffbins(sector_sets)
+    moves: List[SectorMove] = []
+    if signatures is not None:
+        diffbins, moves = match_moves(diffbins, signatures, same_file)
+
+    entries = 0
+    for sector, (other_sector, item) in diffbins:
+        emit(json.dumps({
+            "sector": sector,
+            "found_in": other_sector,
+            "item": item,
+            "path": sector_sets[other_sector][item]
+        }))
+        entries += 1
+
+    for sector, other_sector, item, own_item in moves:
+        emit(json.dumps({
+            "sector": sector,
+            "found_in": other_sector,
+            "item": item,
+            "path": sector_sets[other_sector][item],
+            "moved_from": sector_sets[sector][own_item]
+        }))
+
+    return entries, len(moves)
+
+def make_default_lib(comparator: str, exclude: Iterable[str]=()) -> DataLibrary:
+    return {
+        "sectors": {},
+        "comparator": comparator,
+        "exclude": list(exclude)
+    }
+
+@cli.command()
+@click.argument("name")
+@click.option("--force", is_flag=True, default=False, help="Set to force recreation of a corrupted library")
+@click.option("--comparator", type=click.Choice(sorted(COMPARATORS)), default="filename", show_default=True, help="how items are told apart when comparing sectors")
+@click.option("--exclude", multiple=True, metavar="PATTERN", help="leave what matches this gitignore-style pattern out of indexes; may be repeated")
+def createlib(name: str, force: bool, comparator: str="filename", exclude: Tuple[str, ...]=()):
+    def __createlib(config: ChadowConfig):
+        existing_libraries = config.get("libraryMapping", {})
+
+        if name in existing_libraries:
+            logging.error("specified name is already taken. Delete name first if you really want to use this name.")
+            exit(ExitCodes.STATE_CONFLICT.value)
+        else:
+            existing_libraries[name] = make_default_lib(comparator, exclude)
+
+        config["libraryMapping"] = existing_libraries
+        return config
+
+    config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+    updated_config = None
+    with __catalog_transaction() as catalog:
+        try:
+            logging.info("Writing config file: %s" % config_filename)
+            updated_config = __createlib(__config_load(config_filename))
+            __write_cfg(updated_config, config_filename, "Created new lib: %s" % name)
+            os.mkdir(os.path.join(APP_ROOT, name))
+            __undo_on_rollback(functools.partial(os.rmdir, os.path.join(APP_ROOT, name)))
+        except json.decoder.JSONDecodeError:
+            if force:
+                fresh_config = json.dumps({
+                    "version": "%s" % get_version(),
+                    "libraryMapping": {}
+                })
+                with open(config_filename, "w") as config_file:
+                    logging.warning("Forced to recreate corrupted library.")
+                    config_file.write(fresh_config)
+                    config_file.flush()
+                    updated_config = __createlib(json.loads(fresh_config))
+                __write_cfg(updated_config, config_filename, "Created new lib: %s" % name)
+                os.mkdir(os.path.join(APP_ROOT, name))
+                __undo_on_rollback(functools.partial(os.rmdir, os.path.join(APP_ROOT, name)))
+            else:
+                logging.error("Corrupted config file. You can either fix it manually or call createlib with --force.")
+                exit(ExitCodes.INVALID_CONFIG.value)
+
+        if catalog is not None:
+            catalog.add_library(name, comparator)
+
+@cli.command()
+def lslib():
+    catalog = __open_catalog_reader()
+    if catalog is not None:
+        try:
+            print("\n".join(catalog.libraries()))
+        finally:
+            catalog.close()
+        return
+
+    config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+    try:
+        cfg = __config_load(config_filename)
+        libs = cfg["libraryMapping"].keys()
+        print("\n".join(libs))
+    except json.decoder.JSONDecodeError:
+        logging.error("Can't read config, invalid JSON. Forcing creation of a new library would recreate a valid config but will destroy existing data.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+@cli.command()
+@click.argument("name")
+def deletelib(name: str):
+    try:
+        config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+        with __catalog_transaction() as catalog:
+            config = __config_load(config_filename)
+            existing_libraries = config.get("libraryMapping", {})
+
+            if name in existing_libraries:
+                del existing_libraries[name]
+                if catalog is not None:
+                    catalog.remove_library(name)
+                __write_cfg(config, config_filename, "Deleted library: %s" % name)
+            else:
+                logging.error("asked to delete a nonexistent library.")
+                exit(ExitCodes.STATE_CONFLICT.value)
+    except FileNotFoundError:
+        logging.error("config file not found. Is chadow installed properly?")
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+    finally:
+        try:
+            os.rmdir(os.path.join(APP_ROOT, name))
+            __undo_on_rollback(functools.partial(os.mkdir, os.path.join(APP_ROOT, name)))
+        except FileNotFoundError:
+            logging.warning(
+                "%s does not exist. Possible data loss condition!" %
+                os.path.join(APP_ROOT, name)
+            )
+
+def __library_rules(data_library: DataLibrary) -> ExcludeRules:
+    """
+    The compiled exclude rules of a library, exiting if they don't compile.
+    """
+    try:
+        return ExcludeRules(data_library.get("exclude", []))
+    except re.error as e:
+        logging.error("Invalid exclude pattern: %s" % e)
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+@cli.command()
+@click.argument("library")
+@click.argument("patterns", nargs=-1, required=True)
+@click.option("--remove", is_flag=True, default=False, help="drop these patterns instead of adding them")
+def exclude(library: str, patterns: Tuple[str, ...], remove: bool=False):
+    """
+    Add gitignore-style PATTERNS to the exclude rules of a library. What they
+    match is left out the next time a medium is indexed.
+    """
+    try:
+        ExcludeRules(patterns)
+    except re.error as e:
+        logging.error("Invalid exclude pattern: %s" % e)
+        exit(ExitCodes.INVALID_ARG.value)
+
+    config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+    try:
+        config = __config_load(config_filename)
+        data_library = config["libraryMapping"][library]
+    except FileNotFoundError:
+        logging.error("config file not found. Is chadow installed properly?")
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+    except KeyError:
+        logging.error("Library %s not found." % library)
+        exit(ExitCodes.STATE_CONFLICT.value)
+
+    rules = data_library.get("exclude", [])
+    if remove:
+        missing = [pattern for pattern in patterns if pattern not in rules]
+        if missing:
+            logging.error("Not an exclude rule of %s: %s" % (library, ", ".join(missing)))
+            exit(ExitCodes.STATE_CONFLICT.value)
+        data_library["exclude"] = [rule for rule in rules if rule not in patterns]
+    else:
+        data_library["exclude"] = rules + [pattern for pattern in patterns if pattern not in rules]
+    __write_cfg(
+        config, config_filename, "%s exclude rules of library %s." % (
+            "Removed" if remove else "Added", library
+        )
+    )
+
+@cli.command()
+@click.argument("library")
+def lsexclude(library: str):
+    """
+    List the exclude rules of a library, the default ones included.
+    """
+    config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+    try:
+        cfg = __config_load(config_filename)
+        print("\n".join(__library_rules(cfg["libraryMapping"][library]).patterns))
+    except json.decoder.JSONDecodeError:
+        logging.error("Can't read config, invalid JSON. Forcing creation of a new library would recreate a valid config but will destroy existing data.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+    except KeyError:
+        logging.error("Expected config structure not found. Was the config edited manually?")
+        exit(ExitCodes.STATE_CONFLICT.value)
+
+@cli.command()
+@click.argument("library")
+@click.argument("sector_name")
+def regsector(library: str, sector_name: str):
+    logging.info("Registering sector %s for library %s." % (sector_name, library))
+    if os.path.sep in sector_name:
+        logging.error("sector_name could not contain the path separator %s" % os.path.sep)
+        exit(ExitCodes.INVALID_ARG.value)
+
+    try:
+        config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+        config = __config_load(config_filename)
+        library_sectors = config["libraryMapping"][library]["sectors"]
+
+        if library_sectors.get(sector_name) is not None:
+            logging.error("Asked to register a sector that already exists")
+            if type(library_sectors[sector_name]) is not list:
+                logging.warning("Pre-existing sector might be corrupted.")
+
+            exit(ExitCodes.STATE_CONFLICT.value)
+        else:
+            library_sectors[sector_name] = []
+            try:
+                sector_dirname = make_sector_dirname(library, sector_name)
+                os.mkdir(sector_dirname)
+                __undo_on_rollback(functools.partial(os.rmdir, sector_dirname))
+                logging.info("Created sector index directory: %s" % sector_dirname)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    logging.info("Sector index directory already exists.")
+                else:
+                    logging.error("Unable to create sector index directory.")
+                    exit(ExitCodes.OS_ERROR.value)
+            except PermissionError:
+                logging.error("No permission to create sector index directory.")
+                exit(ExitCodes.PERMISSIONS_PROBLEM.value)
+            with __catalog_transaction() as catalog:
+                if catalog is not None:
+                    catalog.add_sector(library, sector_name)
+                __write_cfg(
+                    config, config_filename,
+                    "Created sector %s for library %s." % (sector_name, library)
+                )
+    except FileNotFoundError:
+        logging.error("config file not found. Is chadow installed properly?")
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+    except AttributeError:
+        logging.error("Library sectors for %s is not readable! Please reformat." % library)
+        exit(ExitCodes.STATE_CONFLICT.value)
+
+@cli.command()
+@click.argument("library")
+def lssector(library: str):
+    catalog = __open_catalog_reader()
+    if catalog is not None:
+        try:
+            sectors = catalog.sectors(library)
+        finally:
+            catalog.close()
+        if sectors is None:
+            logging.error("Library %s is not in the catalog." % library)
+            exit(ExitCodes.STATE_CONFLICT.value)
+        print("\n".join(sectors))
+        return
+
+    config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+    try:
+        cfg = __config_load(config_filename)
+        sectors = cfg["libraryMapping"][library]["sectors"].keys()
+        print("\n".join(sectors))
+    except json.decoder.JSONDecodeError:
+        logging.error("Can't read config, invalid JSON. Forcing creation of a new library would recreate a valid config but will destroy existing data.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+    except KeyError:
+        logging.error("Expected config structure not found. Was the config edited manually?")
+        exit(ExitCodes.STATE_CONFLICT.value)
+
+@cli.command()
+@click.argument("library")
+@click.argument("sector_name")
+@click.argument("sector_path")
+def regmedia(library: str, sector_name: str, sector_path: str):
+    logging.info("asked to register media %s in sector %s." % (sector_path, sector_name))
+
+    if PATH_SEPARATOR_REPLACEMENT in sector_path:
+        logging.error(
+            "sector_path cannot have the %s character!\nGiven: %s" % (
+                PATH_SEPARATOR_REPLACEMENT, sector_path
+            )
+        )
+        exit(ExitCodes.INVALID_ARG.value)
+
+    try:
+        config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+        config = __config_load(config_filename)
+        metadata_path = os.path.join(sector_path, CHADOW_METADATA)
+        previous_metadata: Optional[str] = None
+        if os.path.isfile(metadata_path):
+            with open(metadata_path) as metadata:
+                previous_metadata = metadata.read()
+            managers = __read_metadata(metadata_path)
+
+            if config["installationId"] in managers:
+                logging.error("specified path %s is already registered." % sector_path)
+                exit(ExitCodes.STATE_CONFLICT.value)
+        elif os.path.isdir(metadata_path):
+            logging.error("Reserved metadata path is a directory. Please verify %s." % metadata_path)
+            exit(ExitCodes.STATE_CONFLICT.value)
+
+        # Everything is checked before anything is written, and whatever was
+        # written is undone if a later step fails, so that the medium, the
+        # index directory, the config and the catalog never disagree.
+        if config["libraryMapping"][library].get("sectors") is None:
+            logging.error("Sector %s not found. Are you sure you have registered this sector before?" % sector_name)
+            exit(ExitCodes.STATE_CONFLICT.value)
+        if not os.path.isdir(make_sector_dirname(library, sector_name)):
+            logging.error("State conflict: missing directory for sector %s." % sector_name)
+            exit(ExitCodes.STATE_CONFLICT.value)
+
+        sector_path_dir = __make_sectorpath_dirname(library, sector_name, sector_path)
+        with __catalog_transaction() as catalog:
+            os.mkdir(sector_path_dir)
+            metadata_written = False
+            try:
+                try:
+                    with open(metadata_path, "w+") as metadata:
+                        metadata_written = True
+                        metadata.write(sector_name)
+                        metadata.flush()
+                except FileNotFoundError:
+                    logging.error("metadata can't be opened. Please check the sector path provided.")
+                    exit(ExitCodes.METADATA_NOT_FOUND.value)
+                except PermissionError:
+                    logging.error("can't open metadata file. Are you sure we have the proper permissions to the path?")
+                    exit(ExitCodes.PERMISSIONS_PROBLEM.value)
+
+                config["libraryMapping"][library]["sectors"][sector_name].append(sector_path)
+                if catalog is not None:
+                    catalog.add_media(library, sector_name, sector_path)
+                __write_cfg(
+                    config, config_filename,
+                    "Registered media for library %s at sector %s at path %s." % (
+                        library, sector_name, sector_path
+                    )
+                )
+            except BaseException:
+                logging.info("Rolling back the registration of %s." % sector_path)
+                if metadata_written:
+                    __restore_metadata(metadata_path, previous_metadata)
+                os.rmdir(sector_path_dir)
+                raise
+
+            def undo() -> None:
+                __restore_metadata(metadata_path, previous_metadata)
+                # Along with whatever later lines of the batch put in it.
+                shutil.rmtree(sector_path_dir)
+            __undo_on_rollback(undo)
+    except FileNotFoundError as fnfe:
+        logging.error("config file not found. Is chadow installed properly?")
+        logging.error(fnfe, exc_info=True)
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+
+@cli.command()
+@click.argument("library")
+@click.argument("sector_name")
+def lsmedia(library: str, sector_name: str):
+    catalog = __open_catalog_reader()
+    if catalog is not None:
+        try:
+            paths = catalog.media_paths(library, sector_name)
+        finally:
+            catalog.close()
+        if paths is None:
+            logging.error("Sector %s of %s is not in the catalog." % (sector_name, library))
+            exit(ExitCodes.STATE_CONFLICT.value)
+        print("\n".join(paths))
+        return
+
+    config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+    try:
+        cfg = __config_load(config_filename)
+        paths = cfg["libraryMapping"][library]["sectors"][sector_name]
+        print("\n".join(paths))
+    except json.decoder.JSONDecodeError:
+        logging.error("Can't read config, invalid JSON. Forcing creation of a new library would recreate a valid config but will destroy existing data.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+    except KeyError:
+        logging.error("Expected config structure not found. Was the config edited manually?")
+        exit(ExitCodes.STATE_CONFLICT.value)
+
+
+def __registered_media_dir(library: str, sector_name: str, sector_path: str) -> str:
+    """
+    The index directory of a medium, exiting if the medium is not registered.
+    """
+    try:
+        config = __config_load(os.path.join(APP_ROOT, CONFIG_NAME))
+    except FileNotFoundError:
+        logging.error("config file not found. Is chadow installed properly?")
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+    except PermissionError:
+        logging.error("can't open config file. Are you sure we have the proper permissions for it?")
+        exit(ExitCodes.PERMISSIONS_PROBLEM.value)
+
+    try:
+        if sector_path not in config["libraryMapping"][library]["sectors"][sector_name]:
+            logging.error("%s is not a registered media in this sector." % sector_path)
+            exit(ExitCodes.STATE_CONFLICT.value)
+    except KeyError:
+        logging.error("Config invalid for given arguments.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+    return __make_sectorpath_dirname(library, sector_name, sector_path)
+
+def __record_history(
+    sector_path_dir: str, root_index: Optional[DirectoryIndex],
+    metrics: Optional[RunMetrics]=None
+) -> None:
+    """
+    Add the index just written to the history of its medium. Streamed indexes
+    are read back from their index.jsonl.
+    """
+    history = IndexHistory(os.path.join(sector_path_dir, HISTORY_DIR_NAME))
+    with _metrics_phase(metrics, "history"):
+        if root_index is not None:
+            header = history.record(root_index.iter_file_stats())
+        else:
+            with open(os.path.join(sector_path_dir, STREAMED_INDEX_NAME), "r") as index_file:
+                header = history.record(iter_record_file_stats(index_file))
+    logging.info(
+        "Recorded snapshot %d (+%d -%d ~%d)." %
+        (header["snapshot"], header["added"], header["removed"], header["changed"])
+    )
+
+def __media_index_format(sector_path_dir: str) -> str:
+    """
+    The format a medium's index was last written in, as `__load_media_index`
+    would find it.
+    """
+    for index_format in ("binary", "jsonl"):
+        if os.path.exists(os.path.join(sector_path_dir, INDEX_FORMATS[index_format])):
+            return index_format
+    return "json"
+
+def __update_catalog(
+    library: str, sector_name: str, sector_path: str,
+    root_index: Optional[DirectoryIndex]=None, metrics: Optional[RunMetrics]=None
+) -> None:
+    """
+    Store the new index of a medium in the catalog, if there is one. Streamed
+    indexes are stored from their index.jsonl, one directory at a time.
+    """
+    with _metrics_phase(metrics, "catalog"), __catalog_transaction() as catalog:
+        if catalog is None:
+            return
+
+        if root_index is not None:
+            catalog.store_index(library, sector_name, sector_path, root_index)
+            return
+
+        sector_path_dir = __make_sectorpath_dirname(library, sector_name, sector_path)
+        try:
+            with open(os.path.join(sector_path_dir, STREAMED_INDEX_NAME), "r") as index_file:
+                catalog.store_records(library, sector_name, sector_path, index_file)
+        except FileNotFoundError:
+            media_index = __load_media_index(sector_path_dir)
+            if media_index is not None:
+                catalog.store_index(library, sector_name, sector_path, media_index)
+
+def __report_metrics(
+    metrics: Optional[RunMetrics], profile: bool, metrics_file: Optional[str],
+    metrics_format: str
+) -> None:
+    """
+    Log the metrics of a run for `--profile` and write them out for `--metrics`.
+    """
+    if metrics is None:
+        return
+
+    if profile:
+        for line in metrics.report():
+            logging.info(line)
+    if metrics_file is not None:
+        try:
+            metrics.write(metrics_file, metrics_format)
+        except OSError as e:
+            logging.error("Unable to write metrics to %s: %s" % (metrics_file, e))
+            exit(ExitCodes.OS_ERROR.value)
+
+def __expected_entries(
+    sector_path_dir: str, sector_path: str, previous_index: Optional[DirectoryIndex]
+) -> Optional[int]:
+    """
+    How many directories and files to expect on a medium: as many as in its
+    last index if it has one, else as many inodes as its filesystem uses.
+    """
+    if previous_index is not None:
+        return count_index_entries(previous_index)
+
+    try:
+        media_index = __load_media_index(sector_path_dir, lazy=True)
+    except OSError:
+        media_index = None
+    if media_index is not None:
+        try:
+            return count_index_entries(media_index)
+        except ValueError:
+            pass
+        finally:
+            if isinstance(media_index, (MappedIndex, LazyIndex)):
+                media_index.close()
+    return estimate_media_entries(sector_path)
+
+def __index_media(
+    library: str, sector_name: str, sector_path: str, workers: int, sequential: bool,
+    incremental: bool, stream: bool, binary: bool, verbose: bool,
+    update_catalog: bool=True, metrics: Optional[RunMetrics]=None,
+    progress: bool=False, progress_overwrite: bool=True, resume: bool=False,
+    exclude_patterns: Iterable[str]=(), history: bool=True
+) -> IndexSummary:
+    """
+    Walk a registered medium and write its index, leaving out what
+    `exclude_patterns` exclude. Its phases are recorded in `metrics` when given.
+    With `progress`, how far the walk has got is reported on stderr as it goes.
+
+    Unless `history` is off, the index is also recorded in the history of the
+    medium.
+
+    Unless streaming, the walk keeps a checkpoint next to the index until the
+    index is written. With `resume`, the subtrees in the checkpoint left behind
+    by an interrupted run are not walked again.
+    """
+    started = time.monotonic()
+    sector_path_dir = __make_sectorpath_dirname(library, sector_name, sector_path)
+    rules = ExcludeRules(exclude_patterns)
+    previous_index = None
+    if incremental:
+        with _metrics_phase(metrics, "load"):
+            previous_index = __load_media_index(sector_path_dir)
+        if previous_index is None:
+            logging.info("No previous index to reuse. Doing a full walk.")
+
+    checkpoint_filename = os.path.join(sector_path_dir, CHECKPOINT_NAME)
+    resumed = None
+    if resume:
+        with _metrics_phase(metrics, "load"):
+            resumed = load_checkpoint(checkpoint_filename, sector_path)
+        if resumed is None:
+            logging.info("No checkpoint to resume from. Doing a full walk.")
+        else:
+            logging.info("Resuming from a checkpoint of %d directories." % len(resumed))
+
+    reporter = None
+    if progress:
+        with _metrics_phase(metrics, "load"):
+            expected = __expected_entries(sector_path_dir, sector_path, previous_index)
+        reporter = ProgressReporter(
+            "%s %s" % (sector_name, sector_path), expected, overwrite=progress_overwrite
+        )
+
+    root_index = None
+    if stream:
+        streamed_filename = os.path.join(sector_path_dir, STREAMED_INDEX_NAME)
+        partial_filename = streamed_filename + ".partial"
+        logging.info("Streaming %s to %s" % (STREAMED_INDEX_NAME, sector_path_dir))
+        # Write next to the old index and swap it in at the end so that an
+        # interrupted run does not leave us with a truncated index.
+        # Records are serialized as directories are walked, so that time
+        # counts as walking.
+        with _metrics_phase(metrics, "walk"), \
+                _open_for_write(partial_filename, False, metrics) as path_index:
+            walker = MediaWalker(
+                sector_path, workers, sequential, previous=previous_index,
+                sink=StreamingIndexWriter(path_index, echo=verbose), progress=reporter,
+                rules=rules
+            )
+            walker.walk()
+        with _metrics_phase(metrics, "write"):
+            os.replace(partial_filename, streamed_filename)
+            __remove_other_index_formats(sector_path_dir, "jsonl")
+    else:
+        with _metrics_phase(metrics, "walk"), IndexCheckpoint(
+            checkpoint_filename, sector_path, append=resumed is not None
+        ) as checkpoint:
+            walker = MediaWalker(
+                sector_path, workers, sequential, previous=previous_index,
+                progress=reporter, checkpoint=checkpoint, resumed=resumed, rules=rules
+            )
+            root_index = walker.walk()
+        # Let the previous tree be collected before we serialize the new one.
+        previous_index = None
+        resumed = None
+
+        __write_media_index(
+            root_index, sector_path_dir, "binary" if binary else "json", metrics
+        )
+        __remove_if_exists(checkpoint_filename)
+
+    if reporter is not None:
+        reporter.finish(walker.directories, walker.files)
+
+    if history:
+        __record_history(sector_path_dir, root_index, metrics)
+
+    if update_catalog:
+        __update_catalog(library, sector_name, sector_path, root_index, metrics)
+
+    if verbose and root_index is not None:
+        print(str(root_index.to_json()))
+
+    if metrics is not None:
+        metrics.count("media")
+        metrics.count("directories", walker.directories)
+        metrics.count("files", walker.files)
+        metrics.count("bytes_stat", walker.bytes_stat)
+
+    return IndexSummary(
+        sector_name, sector_path, walker.directories, walker.files,
+        time.monotonic() - started, metrics=metrics
+    )
+
+def __index_device(
+    library: str, media: List[Tuple[str, str]], workers: int, sequential: bool,
+    incremental: bool, stream: bool, binary: bool, verbose: bool, profile: bool=False,
+    progress: bool=False, resume: bool=False, exclude_patterns: Iterable[str]=(),
+    history: bool=True
+) -> List[IndexSummary]:
+    """
+    Index media that share a disk one after the other, so that they don't
+    compete for its heads. Runs in a worker process for `index --all`. With
+    `profile`, each summary carries the metrics of its medium.
+    """
+    summaries = []
+    for sector_name, sector_path in media:
+        try:
+            summaries.append(__index_media(
+                library, sector_name, sector_path, workers, sequential,
+                incremental, stream, binary, verbose, update_catalog=False,
+                metrics=RunMetrics("index") if profile else None,
+                # Media on other disks report from other processes at the
+                # same time, so each report gets a line of its own.
+                progress=progress, progress_overwrite=False, resume=resume,
+                exclude_patterns=exclude_patterns, history=history
+            ))
+        except OSError as e:
+            logging.error("Unable to index %s: %s" % (sector_path, e))
+            summaries.append(IndexSummary(sector_name, sector_path, error=str(e)))
+    return summaries
+
+@cli.command()
+@click.argument("library")
+@click.argument("sector_name", required=False)
+@click.argument("sector_path", required=False)
+@click.option("--verbose", is_flag=True, default=False, help="verbose will output the index written as a text stream")
+@click.option("--workers", type=click.IntRange(min=1), default=DEFAULT_INDEX_WORKERS, show_default=True, help="number of directories scanned concurrently")
+@click.option("--sequential", is_flag=True, default=False, help="scan one directory at a time in a single thread")
+@click.option("--incremental", is_flag=True, default=False, help="only rescan directories that changed since the last index")
+@click.option("--stream", is_flag=True, default=False, help="write a line-delimited index.jsonl while walking instead of building the index in memory")
+@click.option("--binary", is_flag=True, default=False, help="write a memory-mappable index.bin instead of index.json")
+@click.option("--all", "index_all", is_flag=True, default=False, help="index every medium of the library (or of SECTOR_NAME), one process per disk")
+@click.option("--resume", is_flag=True, default=False, help="continue from the checkpoint of an interrupted run instead of walking the whole medium again")
+@click.option("--history/--no-history", default=True, show_default=True, help="record the index in the history of the medium")
+@click.option("--progress/--no-progress", default=None, help="report directories and files walked, rate and ETA on stderr while indexing [default: when stderr is a terminal]")
+@click.option("--profile", is_flag=True, default=False, help="log the wall and CPU time of each phase, counters and peak memory use")
+@click.option("--metrics", "metrics_file", type=click.Path(dir_okay=False), default=None, help="write the same figures to this file")
+@click.option("--metrics-format", type=click.Choice(["json", "prometheus"]), default="json", show_default=True, help="format of the --metrics file; prometheus suits node_exporter's textfile collector")
+def index(
+    library: str, sector_name: Optional[str]=None, sector_path: Optional[str]=None,
+    verbose: bool=False, workers: int=DEFAULT_INDEX_WORKERS, sequential: bool=False,
+    incremental: bool=False, stream: bool=False, binary: bool=False,
+    index_all: bool=False, resume: bool=False, history: bool=True,
+    progress: Optional[bool]=None, profile: bool=False,
+    metrics_file: Optional[str]=None, metrics_format: str="json"
+):
+    logging.info("Indexing %s.%s.%s..." % (library, sector_name or "*", sector_path or "*"))
+    config: ChadowConfig = {"version": get_version(), "libraryMapping": {}}
+
+    if stream and binary:
+        logging.error("--stream and --binary can't be used together.")
+        exit(ExitCodes.INVALID_ARG.value)
+    if stream and resume:
+        logging.error("Streamed indexes are not checkpointed, so --stream can't --resume.")
+        exit(ExitCodes.INVALID_ARG.value)
+    if index_all and sector_path is not None:
+        logging.error("--all indexes every registered medium. Don't give a SECTOR_PATH.")
+        exit(ExitCodes.INVALID_ARG.value)
+    if not index_all and (sector_name is None or sector_path is None):
+        logging.error("SECTOR_NAME and SECTOR_PATH are required unless --all is given.")
+        exit(ExitCodes.INVALID_ARG.value)
+
+    try:
+        config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+        config = __config_load(config_filename)
+    except FileNotFoundError:
+        logging.error("config file not found. Is chadow installed properly?")
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+    except PermissionError:
+        logging.error("can't open config file. Are you sure we have the proper permissions for it?")
+        exit(ExitCodes.PERMISSIONS_PROBLEM.value)
+
+    # This is a pre-emptive check. Technically, nothing stops us from creating
+    # an index even if it is not registered in the config. However, this would
+    # singify a state discrepancy---the directory to save the index in probably
+    # does not exist! We could still reach this conclusion later but checking
+    # here saves us an expensive operation.
+    try:
+        sectors = config["libraryMapping"][library]["sectors"]
+        if index_all:
+            media = [
+                (_sector_name, media_path)
+                for _sector_name in ([sector_name] if sector_name else sectors)
+                for media_path in sectors[_sector_name]
+            ]
+        else:
+            if sector_path not in sectors[sector_name]:
+                logging.error("%s is not a registered media in this sector." % sector_path)
+                exit(ExitCodes.STATE_CONFLICT.value)
+    except KeyError:
+        logging.error("Config invalid for given arguments.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+    # Compiled here too, so that a bad pattern is caught before any walk.
+    __library_rules(config["libraryMapping"][library])
+    exclude_patterns = config["libraryMapping"][library].get("exclude", [])
+
+    metrics = None
+    if profile or metrics_file is not None:
+        metrics = RunMetrics("index", {"library": library, "sector": sector_name or ""})
+
+    options = (workers, sequential, incremental, stream, binary, verbose)
+    if progress is None:
+        progress = sys.stderr.isatty()
+    if not index_all:
+        logging.info(str(__index_media(
+            library, sector_name, sector_path, *options, metrics=metrics,
+            progress=progress, resume=resume, exclude_patterns=exclude_patterns,
+            history=history
+        )))
+        __report_metrics(metrics, profile, metrics_file, metrics_format)
+        return
+
+    devices: Dict[str, List[Tuple[str, str]]] = {}
+    for _sector_name, media_path in media:
+        devices.setdefault(block_device(media_path), []).append((_sector_name, media_path))
+    logging.info("Indexing %d media on %d disk(s)..." % (len(media), len(devices)))
+
+    started = time.monotonic()
+    summaries: List[IndexSummary] = []
+    if len(devices) <= 1:
+        for device_media in devices.values():
+            summaries.extend(__index_device(
+                library, device_media, *options, metrics is not None, progress, resume,
+                exclude_patterns, history
+            ))
+    else:
+        with concurrent_futures.ProcessPoolExecutor(max_workers=len(devices)) as pool:
+            for device_summaries in pool.map(
+                __index_device,
+                [library] * len(devices), list(devices.values()),
+                *(
+                    [option] * len(devices)
+                    for option in options + (
+                        metrics is not None, progress, resume, exclude_patterns, history
+                    )
+                )
+            ):
+                summaries.extend(device_summaries)
+    elapsed = time.monotonic() - started
+
+    # Workers leave the catalog alone so that they don't queue up on its lock.
+    for summary in summaries:
+        if summary.error is None:
+            __update_catalog(
+                library, summary.sector_name, summary.media_path, metrics=metrics
+            )
+
+    for summary in summaries:
+        click.echo(str(summary))
+    indexed = [summary for summary in summaries if summary.error is None]
+    total_files = sum(summary.files for summary in indexed)
+    click.echo(
+        "total: %d files in %d directories on %d media in %.2fs (%.0f files/s)" % (
+            total_files, sum(summary.directories for summary in indexed),
+            len(indexed), elapsed, total_files / max(elapsed, 1e-9)
+        )
+    )
+
+    if metrics is not None:
+        for summary in summaries:
+            if summary.metrics is not None:
+                metrics.merge(summary.metrics)
+        metrics.count("failed", len(summaries) - len(indexed))
+    __report_metrics(metrics, profile, metrics_file, metrics_format)
+
+    if len(indexed) < len(summaries):
+        exit(ExitCodes.OS_ERROR.value)
+
+@cli.command()
+@click.argument("library")
+@click.argument("sector_name")
+@click.argument("sector_path")
+@click.option("--workers", type=click.IntRange(min=1), default=DEFAULT_INDEX_WORKERS, show_default=True, help="number of directories scanned concurrently on the first walk")
+@click.option("--sequential", is_flag=True, default=False, help="scan one directory at a time in a single thread")
+@click.option("--debounce", type=click.FloatRange(min=0), default=WATCH_DEBOUNCE, show_default=True, help="seconds without changes after which the index is written")
+@click.option("--max-delay", type=click.FloatRange(min=0), default=WATCH_MAX_DELAY, show_default=True, help="seconds after a change by which the index is written even if changes keep coming")
+@click.option("--poll", is_flag=True, default=False, help="walk the medium periodically instead of using inotify")
+@click.option("--poll-interval", type=click.FloatRange(min=0), default=WATCH_POLL_INTERVAL, show_default=True, help="seconds between walks when polling")
+def watch(
+    library: str, sector_name: str, sector_path: str,
+    workers: int=DEFAULT_INDEX_WORKERS, sequential: bool=False,
+    debounce: float=WATCH_DEBOUNCE, max_delay: float=WATCH_MAX_DELAY,
+    poll: bool=False, poll_interval: float=WATCH_POLL_INTERVAL
+):
+    """
+    Keep the index of a mounted medium up to date as it changes, until it is
+    unmounted or we are interrupted.
+    """
+    sector_path_dir = __registered_media_dir(library, sector_name, sector_path)
+    rules = __library_rules(
+        __config_load(os.path.join(APP_ROOT, CONFIG_NAME))["libraryMapping"][library]
+    )
+
+    def write_index(root_index: DirectoryIndex) -> None:
+        __write_media_index(root_index, sector_path_dir, "json")
+        __update_catalog(library, sector_name, sector_path, root_index)
+
+    watcher = MediaWatcher(
+        sector_path, write_index, workers=workers, sequential=sequential,
+        debounce=debounce, max_delay=max_delay, poll_interval=poll_interval,
+        use_inotify=not poll, rules=rules
+    )
+    try:
+        logging.info("Walking %s..." % sector_path)
+        write_index(watcher.start())
+        logging.info("Watching %s for changes." % sector_path)
+        watcher.run()
+        logging.info("%s was unmounted." % sector_path)
+    except KeyboardInterrupt:
+        logging.info("Stopped watching %s." % sector_path)
+    finally:
+        watcher.close()
+
+def __resolve_snapshot(history: IndexHistory, spec: str) -> int:
+    try:
+        return history.resolve(spec)
+    except ValueError as e:
+        logging.error(str(e))
+        exit(ExitCodes.INVALID_ARG.value)
+
+# Lets negative snapshot numbers through as arguments.
+@cli.command(context_settings={"ignore_unknown_options": True})
+@click.argument("library")
+@click.argument("sector_name")
+@click.argument("sector_path")
+@click.argument("snapshot", required=False)
+def history(library: str, sector_name: str, sector_path: str, snapshot: Optional[str]=None):
+    """
+    List the snapshots of a medium's index, one per index run, or the files
+    in one of them (by number, negative to count back from the latest, or by
+    date).
+    """
+    index_history = IndexHistory(os.path.join(
+        __registered_media_dir(library, sector_name, sector_path), HISTORY_DIR_NAME
+    ))
+    if snapshot is None:
+        for header in index_history.snapshots():
+            click.echo("%6d  %s  %9d files  +%d -%d ~%d%s" % (
+                header["snapshot"],
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(header["time"])),
+                header["files"], header["added"], header["removed"], header["changed"],
+                "  (full)" if header["base"] else ""
+            ))
+        return
+
+    for path, _ in index_history.iter_snapshot(__resolve_snapshot(index_history, snapshot)):
+        click.echo(os.path.join(*path))
+
+@cli.command(name="diff-snapshots", context_settings={"ignore_unknown_options": True})
+@click.argument("library")
+@click.argument("sector_name")
+@click.argument("sector_path")
+@click.argument("old")
+@click.argument("new", default="-1")
+def diff_snapshots(library: str, sector_name: str, sector_path: str, old: str, new: str="-1"):
+    """
+    List the files added (+), removed (-) and changed (~) on a medium between
+    two snapshots of its index, the latest by default. Snapshots are given as
+    in history.
+    """
+    index_history = IndexHistory(os.path.join(
+        __registered_media_dir(library, sector_name, sector_path), HISTORY_DIR_NAME
+    ))
+    old_snapshot = __resolve_snapshot(index_history, old)
+    new_snapshot = __resolve_snapshot(index_history, new)
+    changes = index_history.changes(old_snapshot, new_snapshot)
+    for op, path in changes:
+        click.echo("%s %s" % (op, os.path.join(*path)))
+    ops = [op for op, _ in changes]
+    logging.info(
+        "Snapshot %d to %d: %d added, %d removed, %d changed." %
+        (old_snapshot, new_snapshot, ops.count("+"), ops.count("-"), ops.count("~"))
+    )
+
+@cli.command()
+@click.argument("library")
+@click.option("--output", type=click.Path(dir_okay=False), default=None, help="write the report to this file instead of printing it")
+@click.option("--workers", type=click.IntRange(min=1), default=None, help="number of media indexes loaded concurrently [default: number of CPUs]")
+@click.option("--sequential", is_flag=True, default=False, help="load one media index at a time in this process")
+@click.option("--moves/--no-moves", default=False, show_default=True, help="report files moved or renamed on one sector as such, rather than as missing from both, once their contents are checked to match; the report is then written all at once at the end")
+@click.option("--profile", is_flag=True, default=False, help="log the wall and CPU time of each phase, counters and peak memory use")
+@click.option("--metrics", "metrics_file", type=click.Path(dir_okay=False), default=None, help="write the same figures to this file")
+@click.option("--metrics-format", type=click.Choice(["json", "prometheus"]), default="json", show_default=True, help="format of the --metrics file; prometheus suits node_exporter's textfile collector")
+def compare(
+    library: str, output: Optional[str]=None, workers: Optional[int]=None,
+    sequential: bool=False, moves: bool=False, profile: bool=False,
+    metrics_file: Optional[str]=None, metrics_format: str="json"
+):
+    config: ChadowConfig = {"version": get_version(), "libraryMapping": {}}
+    metrics = None
+    if profile or metrics_file is not None:
+        metrics = RunMetrics("compare", {"library": library})
+
+    try:
+        config_filename = os.path.join(APP_ROOT, CONFIG_NAME)
+        config = __config_load(config_filename)
+    except FileNotFoundError:
+        logging.error("config file not found. Is chadow installed properly?")
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+    except PermissionError:
+        logging.error("can't open config file. Are you sure we have the proper permissions for it?")
+        exit(ExitCodes.PERMISSIONS_PROBLEM.value)
+
+    try:
+        data_library = config["libraryMapping"][library]
+        sectors = data_library["sectors"]
+        comparator = data_library.get("comparator", "filename")
+    except KeyError:
+        logging.error("Config invalid for given arguments.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+    if comparator not in COMPARATORS:
+        logging.error(
+            "Unknown comparator %s. Expected one of: %s" %
+            (comparator, ", ".join(sorted(COMPARATORS)))
+        )
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+    logging.info("Comparing sectors of %s by %s..." % (library, comparator))
+    media = [
+        (sector_name, media_path)
+        for sector_name, media_paths in sectors.items()
+        for media_path in media_paths
+    ]
+    load_args = (
+        [library] * len(media),
+        [sector_name for sector_name, _ in media],
+        [media_path for _, media_path in media],
+        [comparator] * len(media)
+    )
+    sector_sets: Dict[str, Dict[str, str]] = {sector_name: {} for sector_name in sectors}
+    # The medium each item was loaded from, to look its signature up in.
+    item_media: Dict[str, Dict[str, str]] = {sector_name: {} for sector_name in sectors}
+
+    def union_media(media_items: Iterable[Optional[Dict[str, str]]]) -> None:
+        for (sector_name, media_path), items in zip(media, media_items):
+            if items is None:
+                logging.error(
+                    "%s in sector %s has not been indexed yet." % (media_path, sector_name)
+                )
+                exit(ExitCodes.STATE_CONFLICT.value)
+            sector_sets[sector_name].update(items)
+            if moves:
+                item_media[sector_name].update(dict.fromkeys(items, media_path))
+            if metrics is not None:
+                metrics.count("media")
+                metrics.count("items", len(items))
+
+    with _metrics_phase(metrics, "load"):
+        if sequential or workers == 1:
+            union_media(map(__load_media_items, *load_args))
+        else:
+            with concurrent_futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                union_media(pool.map(__load_media_items, *load_args))
+
+    signatures = None
+    if moves:
+        signatures = functools.partial(__item_signatures, library, item_media, sector_sets)
+    with _metrics_phase(metrics, "report"), \
+            __same_contents(library, item_media, sector_sets) as same_file:
+        if output is not None:
+            with open(output, "w") as report_file:
+                entries, moved = __write_comparison_report(
+                    sector_sets, lambda line: report_file.write(line + "\n"), signatures,
+                    same_file
+                )
+            logging.info("Wrote comparison report to %s" % output)
+        else:
+            entries, moved = __write_comparison_report(
+                sector_sets, click.echo, signatures, same_file
+            )
+
+    logging.info("%d item(s) missing across sectors, %d moved." % (entries, moved))
+    if metrics is not None:
+        metrics.count("missing", entries)
+        metrics.count("moved", moved)
+    __report_metrics(metrics, profile, metrics_file, metrics_format)
+
+@cli.command()
+@click.argument("library")
+@click.argument("sector_name", required=False)
+@click.option("--workers", type=click.IntRange(min=1), default=DEFAULT_HASH_WORKERS, show_default=True, help="number of files hashed concurrently")
+@click.option("--min-size", type=click.IntRange(min=0), default=1, show_default=True, help="leave out files smaller than this many bytes")
+def dupes(
+    library: str, sector_name: Optional[str]=None, workers: int=DEFAULT_HASH_WORKERS,
+    min_size: int=1
+):
+    """
+    List the files with the same contents across the media of a library, or
+    of one of its sectors. Only media that are mounted are looked at.
+    """
+    try:
+        config = __config_load(os.path.join(APP_ROOT, CONFIG_NAME))
+    except FileNotFoundError:
+        logging.error("config file not found. Is chadow installed properly?")
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+    except PermissionError:
+        logging.error("can't open config file. Are you sure we have the proper permissions for it?")
+        exit(ExitCodes.PERMISSIONS_PROBLEM.value)
+
+    try:
+        sectors = config["libraryMapping"][library]["sectors"]
+        media = [
+            (_sector_name, media_path)
+            for _sector_name in ([sector_name] if sector_name else sectors)
+            for media_path in sectors[_sector_name]
+        ]
+    except KeyError:
+        logging.error("Config invalid for given arguments.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+    files: List[Tuple[str, int]] = []
+    caches: List[HashCache] = []
+    # The cache of the medium that each file was found on.
+    owners: Dict[str, HashCache] = {}
+    for _sector_name, media_path in media:
+        if not os.path.isdir(media_path):
+            logging.warning("%s is not mounted. Leaving it out." % media_path)
+            continue
+
+        sector_path_dir = __make_sectorpath_dirname(library, _sector_name, media_path)
+        media_index = __load_media_index(sector_path_dir, lazy=True)
+        if media_index is None:
+            logging.error(
+                "%s in sector %s has not been indexed yet." % (media_path, _sector_name)
+            )
+            exit(ExitCodes.STATE_CONFLICT.value)
+
+        cache = HashCache(os.path.join(sector_path_dir, HASH_CACHE_NAME)).load()
+        caches.append(cache)
+        # Hard links to a file take no more space, so they are not copies.
+        inodes: Set[int] = set()
+        try:
+            for parts, name, file_stat in media_index.iter_file_stats():
+                path = os.path.join(media_path, *parts, name)
+                if file_stat is None:
+                    file_stat = _stat_file(path)
+                    if file_stat is None:
+                        continue
+                size, _, inode, kind = file_stat
+                # A file can also be on a medium nested in another one.
+                if kind != "f" or size < min_size or inode in inodes or path in owners:
+                    continue
+                inodes.add(inode)
+                files.append((path, size))
+                owners[path] = cache
+        finally:
+            if isinstance(media_index, (MappedIndex, LazyIndex)):
+                media_index.close()
+
+    # Whole files are hashed the same way as for the content comparator, so
+    # they share its cache.
+    groups = find_duplicates(
+        files, workers, lambda path: __cached_media_hash(path, owners[path])
+    )
+    for cache in caches:
+        cache.save(prune=False)
+
+    for size, paths in groups:
+        click.echo("%d copies of %d bytes:" % (len(paths), size))
+        for path in paths:
+            click.echo("    %s" % path)
+    logging.info(
+        "%d file(s) with copies; the copies take %d bytes." % (
+            len(groups), sum(size * (len(paths) - 1) for size, paths in groups)
+        )
+    )
+
+@cli.command()
+@click.argument("library")
+@click.option("--from", "from_sector", required=True, help="sector to copy the missing items from")
+@click.option("--to", "to_sector", required=True, help="sector to copy them to")
+@click.option("--dry-run", is_flag=True, default=False, help="only print what would be copied where")
+@click.option("--workers-per-device", type=click.IntRange(min=1), default=SYNC_WORKERS_PER_DEVICE, show_default=True, help="number of files copied concurrently onto each disk")
+@click.option("--moves/--no-moves", default=False, show_default=True, help="move files that were moved or renamed on the destination back into place instead of copying them again, once their contents are checked to match")
+def sync(
+    library: str, from_sector: str, to_sector: str, dry_run: bool=False,
+    workers_per_device: int=SYNC_WORKERS_PER_DEVICE, moves: bool=False
+):
+    """
+    Copy the items that a sector lacks from another sector, to the same paths
+    on the (mounted) media of the sector that lacks them. Copies that were
+    interrupted are resumed by running sync again.
+    """
+    try:
+        config = __config_load(os.path.join(APP_ROOT, CONFIG_NAME))
+    except FileNotFoundError:
+        logging.error("config file not found. Is chadow installed properly?")
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+    except PermissionError:
+        logging.error("can't open config file. Are you sure we have the proper permissions for it?")
+        exit(ExitCodes.PERMISSIONS_PROBLEM.value)
+
+    try:
+        data_library = config["libraryMapping"][library]
+        comparator = data_library.get("comparator", "filename")
+        from_media = data_library["sectors"][from_sector]
+        to_media = data_library["sectors"][to_sector]
+    except KeyError:
+        logging.error("Config invalid for given arguments.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+    if from_sector == to_sector:
+        logging.error("Can't sync a sector with itself.")
+        exit(ExitCodes.INVALID_ARG.value)
+    if comparator not in COMPARATORS:
+        logging.error(
+            "Unknown comparator %s. Expected one of: %s" %
+            (comparator, ", ".join(sorted(COMPARATORS)))
+        )
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+    def media_items(sector_name: str, media_path: str) -> Dict[str, str]:
+        items = __load_media_items(library, sector_name, media_path, comparator)
+        if items is None:
+            logging.error("%s in sector %s has not been indexed yet." % (media_path, sector_name))
+            exit(ExitCodes.STATE_CONFLICT.value)
+        return items
+
+    # The medium each item was indexed on, as media can be nested in others.
+    to_items: Dict[str, str] = {}
+    to_item_media: Dict[str, str] = {}
+    for media_path in to_media:
+        items = media_items(to_sector, media_path)
+        to_items.update(items)
+        to_item_media.update(dict.fromkeys(items, media_path))
+    destination_media = [media_path for media_path in to_media if os.path.isdir(media_path)]
+    if not destination_media:
+        logging.error("No medium of sector %s is mounted." % to_sector)
+        exit(ExitCodes.STATE_CONFLICT.value)
+
+    source_media = []
+    from_items: Dict[str, str] = {}
+    from_item_media: Dict[str, str] = {}
+    for media_path in from_media:
+        if not os.path.isdir(media_path):
+            logging.warning("%s is not mounted. Leaving it out." % media_path)
+            continue
+        source_media.append(media_path)
+        for item, path in media_items(from_sector, media_path).items():
+            if item not in from_items:
+                from_items[item] = path
+                from_item_media[item] = media_path
+
+    sector_sets = {from_sector: from_items, to_sector: to_items}
+    entries = list(iter_diffbins(sector_sets))
+    # Files moved or renamed on the destination are moved into place there
+    # rather than copied again. (media, path there, path wanted), relative.
+    renames: List[Tuple[str, str, str]] = []
+    if moves:
+        item_media = {from_sector: from_item_media, to_sector: to_item_media}
+        # The signatures only say that the files look alike. Nothing is moved
+        # over a path unless both files are hashed and found to be the same.
+        with __same_contents(library, item_media, sector_sets) as same_file:
+            entries, sector_moves = match_moves(entries, functools.partial(
+                __item_signatures, library, item_media, sector_sets
+            ), same_file)
+        for sector, _, item, own_item in sector_moves:
+            if sector != to_sector:
+                continue
+            media_path = to_item_media[own_item]
+            renames.append((
+                media_path, os.path.relpath(to_items[own_item], media_path),
+                os.path.relpath(from_items[item], from_item_media[item])
+            ))
+
+    tasks: List[CopyTask] = []
+    for sector, (_, item) in entries:
+        if sector != to_sector:
+            continue
+        path = from_items[item]
+        try:
+            source_stat = os.stat(path)
+        except OSError as e:
+            logging.warning("Unable to stat %s: %s" % (path, e))
+            continue
+        if stat.S_ISREG(source_stat.st_mode):
+            media_path = from_item_media[item]
+            tasks.append(CopyTask(
+                media_path, os.path.relpath(path, media_path), source_stat.st_size,
+                source_stat.st_mtime_ns
+            ))
+
+    planned, unplaced = plan_copies(tasks, destination_media)
+    for task in unplaced:
+        logging.error("No room for %s (%d bytes) on sector %s." % (task.source, task.size, to_sector))
+    to_copy: List[CopyTask] = []
+    done: List[CopyTask] = []
+    conflicts = 0
+    for task in planned:
+        if task.is_done():
+            done.append(task)
+        elif os.path.lexists(task.destination):
+            logging.warning(
+                "%s is in the way of %s. Leaving it alone." % (task.destination, task.source)
+            )
+            conflicts += 1
+        else:
+            to_copy.append(task)
+    to_rename: List[Tuple[str, str, str]] = []
+    for media_path, old_path, new_path in renames:
+        if os.path.lexists(os.path.join(media_path, new_path)):
+            logging.warning(
+                "%s is in the way of moving %s there. Leaving it alone." %
+                (os.path.join(media_path, new_path), os.path.join(media_path, old_path))
+            )
+            conflicts += 1
+        else:
+            to_rename.append((media_path, old_path, new_path))
+
+    if dry_run:
+        for media_path, old_path, new_path in sorted(to_rename):
+            click.echo("%s -> %s (moved)" % (
+                os.path.join(media_path, old_path), os.path.join(media_path, new_path)
+            ))
+        for task in sorted(to_copy, key=lambda task: task.source):
+            click.echo("%s -> %s (%d bytes)" % (task.source, task.destination, task.size))
+        click.echo(
+            "%d file(s) to move; %d file(s), %d bytes to copy; %d already copied." %
+            (len(to_rename), len(to_copy), sum(task.size for task in to_copy), len(done))
+        )
+        return
+
+    # Index changes of every destination medium, as files added and removed.
+    changes: Dict[str, Tuple[List[Tuple[Tuple[str, ...], str, Optional[FileStat]]], List[Tuple[Tuple[str, ...], str]]]] = {}
+    renamed = 0
+    failed_renames = 0
+    for media_path, old_path, new_path in to_rename:
+        try:
+            os.makedirs(os.path.dirname(os.path.join(media_path, new_path)), exist_ok=True)
+            os.rename(os.path.join(media_path, old_path), os.path.join(media_path, new_path))
+        except OSError as e:
+            logging.error("Unable to move %s: %s" % (os.path.join(media_path, old_path), e))
+            failed_renames += 1
+            continue
+        logging.info("Moved %s to %s." % (
+            os.path.join(media_path, old_path), os.path.join(media_path, new_path)
+        ))
+        renamed += 1
+        added, removed = changes.setdefault(media_path, ([], []))
+        old_parts = tuple(old_path.split(os.sep))
+        new_parts = tuple(new_path.split(os.sep))
+        removed.append((old_parts[:-1], old_parts[-1]))
+        added.append((
+            new_parts[:-1], new_parts[-1], _stat_file(os.path.join(media_path, new_path))
+        ))
+
+    started = time.monotonic()
+    copied, failed = run_copies(to_copy, workers_per_device)
+    elapsed = time.monotonic() - started
+    for task in copied + done:
+        parts = tuple(task.relative_path.split(os.sep))
+        changes.setdefault(task.destination_media or "", ([], []))[0].append(
+            (parts[:-1], parts[-1], _stat_file(task.destination))
+        )
+
+    # Rather than have the destination media indexed again, update their
+    # indexes with what was done to them.
+    for media_path, (added, removed) in changes.items():
+        sector_path_dir = __make_sectorpath_dirname(library, to_sector, media_path)
+        media_index = __load_media_index(sector_path_dir)
+        if media_index is None:
+            continue
+        update_files(media_index, added, removed)
+        __write_media_index(media_index, sector_path_dir, __media_index_format(sector_path_dir))
+        __record_history(sector_path_dir, media_index)
+        __update_catalog(library, to_sector, media_path, media_index)
+
+    copied_bytes = sum(task.size for task in copied)
+    click.echo(
+        "moved %d file(s); copied %d file(s), %d bytes in %.2fs (%.1f MB/s); %d already copied, %d in the way, %d failed, %d without room" % (
+            renamed, len(copied), copied_bytes, elapsed, copied_bytes / max(elapsed, 1e-9) / 1e6,
+            len(done), conflicts, len(failed) + failed_renames, len(unplaced)
+        )
+    )
+    if failed or failed_renames or unplaced:
+        exit(ExitCodes.OS_ERROR.value)
+
+@cli.command()
+@click.argument("library")
+@click.argument("sector_name")
+@click.argument("sector_path")
+@click.option("--to", "index_format", type=click.Choice(sorted(INDEX_FORMATS)), default="binary", show_default=True, help="format to convert the index to")
+def convertindex(library: str, sector_name: str, sector_path: str, index_format: str="binary"):
+    """
+    Rewrite the existing index of a medium in another format, without
+    walking the medium again.
+    """
+    sector_path_dir = __make_sectorpath_dirname(library, sector_name, sector_path)
+    media_index = __load_media_index(sector_path_dir)
+    if media_index is None:
+        logging.error("No readable index for %s. Index it first." % sector_path)
+        exit(ExitCodes.STATE_CONFLICT.value)
+
+    __write_media_index(media_index, sector_path_dir, index_format)
+
+@cli.command()
+def initcatalog():
+    """
+    Create the catalog from the config and the index of every medium, or
+    rebuild it from scratch if there already is one.
+    """
+    try:
+        config = __config_load(os.path.join(APP_ROOT, CONFIG_NAME))
+    except FileNotFoundError:
+        logging.error("config file not found. Is chadow installed properly?")
+        exit(ExitCodes.CONFIG_NOT_FOUND.value)
+    except json.decoder.JSONDecodeError:
+        logging.error("Can't read config, invalid JSON. Forcing creation of a new library would recreate a valid config but will destroy existing data.")
+        exit(ExitCodes.INVALID_CONFIG.value)
+
+    catalog_filename = os.path.join(APP_ROOT, CATALOG_NAME)
+    partial_filename = catalog_filename + ".partial"
+    __remove_if_exists(partial_filename)
+    catalog = Catalog.create(partial_filename)
+    try:
+        with catalog.transaction():
+            catalog.sync_mapping(config)
+            for library, data_library in config["libraryMapping"].items():
+                for sector_name, media_paths in data_library["sectors"].items():
+                    for media_path in media_paths:
+                        media_index = __load_media_index(
+                            __make_sectorpath_dirname(library, sector_name, media_path)
+                        )
+                        if media_index is not None:
+                            catalog.store_index(library, sector_name, media_path, media_index)
+    except (KeyError, AttributeError):
+        logging.error("Expected config structure not found. Was the config edited manually?")
+        exit(ExitCodes.STATE_CONFLICT.value)
+    finally:
+        catalog.close()
+
+    os.replace(partial_filename, catalog_filename)
+    logging.info("Wrote catalog to %s" % catalog_filename)
+
+@cli.command()
+@click.argument("library")
+@click.argument("pattern")
+def locate(library: str, pattern: str):
+    """
+    Find the files of a library whose names match the glob PATTERN, across
+    every indexed medium. Needs the catalog (see initcatalog).
+    """
+    catalog = open_catalog()
+    if catalog is None:
+        logging.error("No catalog found. Create one with initcatalog.")
+        exit(ExitCodes.STATE_CONFLICT.value)
+
+    try:
+        for sector_name, media_path, relative_path in catalog.locate(library, pattern):
+            # Names are echoed as the bytes they have on the medium.
+            click.echo(os.fsencode(
+                "%s\t%s" % (sector_name, os.path.join(media_path, relative_path))
+            ))
+    finally:
+        catalog.close()
+
+@cli.command()
+@click.argument("script", type=click.File("r"), default="-")
+def batch(script: IO[str]):
+    """
+    Run the chadow commands in SCRIPT (standard input by default), one per
+    line, in this process. The config is read once and written when the batch
+    is done, or whenever a line just says "commit". Everything after # on a
+    line is ignored. The batch stops at the first command that fails, dropping
+    the changes since the last commit.
+    """
+    global _batch_session
+    if _batch_session is not None:
+        logging.error("batch can't be run from a batch.")
+        exit(ExitCodes.INVALID_ARG.value)
+
+    session = BatchSession(os.path.join(APP_ROOT, CONFIG_NAME))
+    _batch_session = session
+    committed = False
+    try:
+        for line_number, line in enumerate(script, 1):
+            try:
+                args = shlex.split(line, comments=True)
+            except ValueError as e:
+                logging.error("line %d: %s" % (line_number, e))
+                exit(ExitCodes.INVALID_ARG.value)
+
+            if not args:
+                continue
+            if args == ["commit"]:
+                __commit_batch(session)
+                continue
+
+            exit_code = 0
+            try:
+                cli.main(args=args, prog_name="chadow", standalone_mode=False)
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except click.ClickException as e:
+                e.show()
+                exit_code = e.exit_code
+            if exit_code:
+                logging.error(
+                    "line %d failed: %s. Dropping the changes since the last commit." %
+                    (line_number, line.strip())
+                )
+                exit(exit_code)
+
+        __commit_batch(session)
+        committed = True
+    finally:
+        if not committed:
+            session.rollback()
+        _batch_session = None
@@ -1,14 +1,20 @@
-import chadow
+import chadow_core as chadow
 import copy
+import datetime
+import errno
+import io
 import json
 import os
 import traceback
 import unittest
 import unittest.mock
+import shutil
 import sys
 import string
+import subprocess
+import tempfile
 
-from chadow import DirectoryIndex, ExitCodes
+from chadow_core import DirectoryIndex, ExitCodes
 from click.testing import CliRunner
 
 DEFAULT_CONFIG = {
@@ -34,11 +40,1886 @@ class DirectoryIndexTests(unittest.TestCase):
         self.assertEqual(index1, index2)
         self.assertEqual(hash(index1), hash(index2))
 
+    def test_frozen_index(self):
+        index1 = DirectoryIndex("test")
+        index2 = DirectoryIndex("test")
+        for letter in string.ascii_lowercase:
+            index1.add_to_index(letter)
+            index2.add_to_index(letter)
+        subdir = DirectoryIndex("sub", is_top_level=False)
+        subdir.add_to_index("a")
+        index1.add_to_index(subdir)
+        index2.add_to_index(DirectoryIndex.construct_from_dict({
+            "subdir_path": "sub", "index": ["a"]
+        }))
+
+        index1.freeze()
+        self.assertTrue(index1.is_frozen)
+        self.assertFalse(index2.is_frozen)
+        self.assertEqual(index1, index2)
+        self.assertEqual(hash(index1), hash(index2))
+        self.assertEqual(
+            tuple(string.ascii_lowercase) + (subdir,), tuple(index1.index)
+        )
+
+        index1.add_to_index("z2")
+        self.assertFalse(index1.is_frozen)
+        self.assertNotEqual(index1, index2)
+        index2.add_to_index("z2")
+        self.assertEqual(index1.freeze(), index2.freeze())
+
+    def test_compact_representation(self):
+        index = DirectoryIndex("test")
+        self.assertFalse(hasattr(index, "__dict__"))
+
+        loaded = DirectoryIndex.construct_from_dict(json.loads(json.dumps({
+            "version": "0.1.0",
+            "index": [
+                {"subdir_path": "a", "index": ["IMG_0001.JPG"]},
+                {"subdir_path": "b", "index": ["IMG_0001.JPG"]}
+            ]
+        })))
+        names = [
+            name for subdir in loaded.index for name in subdir.index
+        ]
+        self.assertIs(names[0], names[1])
+
+    def test_digest_roundtrip(self):
+        index = DirectoryIndex.construct_from_dict({
+            "version": "0.1.0",
+            "index": ["a.jpg", {"subdir_path": "sub", "index": ["b.jpg"]}]
+        })
+        stored = json.loads(index.to_json())
+        self.assertEqual(index.content_digest(), stored["digest"])
+        self.assertEqual(
+            index.content_digest(),
+            DirectoryIndex.construct_from_dict(stored).content_digest()
+        )
+
+        # Same contents under a different name: same digest, still unequal.
+        renamed = DirectoryIndex.construct_from_dict({
+            "subdir_path": "other", "index": ["b.jpg"]
+        })
+        sub = [item for item in index.index if isinstance(item, DirectoryIndex)][0]
+        self.assertEqual(sub.content_digest(), renamed.content_digest())
+        self.assertNotEqual(sub, renamed)
+
+        moved = DirectoryIndex.construct_from_dict({
+            "version": "0.1.0",
+            "index": ["b.jpg", {"subdir_path": "sub", "index": ["a.jpg"]}]
+        })
+        self.assertNotEqual(index, moved)
+
+    def test_diff(self):
+        common = {"subdir_path": "common", "index": ["c%d.jpg" % i for i in range(10)]}
+        index1 = DirectoryIndex.construct_from_dict({
+            "version": "0.1.0",
+            "index": [
+                "a.jpg", "both.jpg", common,
+                {"subdir_path": "changed", "index": ["x.jpg", "y.jpg"]},
+                {"subdir_path": "gone", "index": ["g.jpg"]}
+            ]
+        })
+        index2 = DirectoryIndex.construct_from_dict({
+            "version": "0.1.0",
+            "index": [
+                "b.jpg", "both.jpg", common,
+                {"subdir_path": "changed", "index": ["x.jpg", "z.jpg"]}
+            ]
+        })
+        only1, only2 = index1.diff(index2)
+        self.assertEqual(
+            sorted([("a.jpg",), ("changed", "y.jpg"), ("gone",)]), sorted(only1)
+        )
+        self.assertEqual(sorted([("b.jpg",), ("changed", "z.jpg")]), sorted(only2))
+
+        with unittest.mock.patch.object(
+            DirectoryIndex, "_DirectoryIndex__split_items",
+            side_effect=AssertionError("descended into an identical tree")
+        ):
+            self.assertEqual(([], []), index1.diff(copy.deepcopy(index1)))
+
+    def test_file_stats(self):
+        index = DirectoryIndex("test")
+        index.add_to_index("a.jpg", (10, 1000, 7, "f"))
+        index.add_to_index("b.jpg")
+        index.add_to_index("c.lnk", (5, 2000, 8, "l"))
+        index.add_to_index(DirectoryIndex("sub", is_top_level=False))
+
+        for frozen in (False, True):
+            if frozen:
+                index.freeze()
+            self.assertEqual((10, 1000, 7, "f"), index.file_stat("a.jpg"))
+            self.assertIsNone(index.file_stat("b.jpg"))
+            self.assertEqual((5, 2000, 8, "l"), index.file_stat("c.lnk"))
+            self.assertIsNone(index.file_stat("sub"))
+            self.assertIsNone(index.file_stat("zzz"))
+
+        loaded = DirectoryIndex.construct_from_dict(json.loads(index.to_json()))
+        self.assertEqual((10, 1000, 7, "f"), loaded.file_stat("a.jpg"))
+        written = io.StringIO()
+        loaded.write_json(written)
+        self.assertEqual(loaded.to_json(), written.getvalue())
+
+        # Stats survive thawing.
+        loaded.add_to_index("d.jpg", (1, 1, 1, "f"))
+        self.assertEqual((10, 1000, 7, "f"), loaded.file_stat("a.jpg"))
+        self.assertEqual((1, 1, 1, "f"), loaded.file_stat("d.jpg"))
+        self.assertEqual(
+            sorted([((), "a.jpg", (10, 1000, 7, "f")), ((), "b.jpg", None),
+                    ((), "c.lnk", (5, 2000, 8, "l")), ((), "d.jpg", (1, 1, 1, "f"))]),
+            sorted(loaded.iter_file_stats())
+        )
+
+    def _make_nested_index(self):
+        index = DirectoryIndex("root")
+        index.fingerprint = (1, 100)
+        index.add_to_index("top.txt")
+        child = DirectoryIndex("child", is_top_level=False)
+        child.add_to_index("inner.txt")
+        grandchild = DirectoryIndex("grandchild", is_top_level=False)
+        grandchild.fingerprint = (3, 300)
+        child.add_to_index(grandchild)
+        index.add_to_index(child)
+        return index
+
+    def test_write_json(self):
+        index = self._make_nested_index()
+        written = io.StringIO()
+        index.write_json(written)
+        self.assertEqual(index.to_json(), written.getvalue())
+
+    def test_construct_from_records(self):
+        index = self._make_nested_index()
+        records = io.StringIO()
+        writer = chadow.StreamingIndexWriter(records)
+        writer((), index)
+        child = [item for item in index.index if isinstance(item, DirectoryIndex)][0]
+        writer(("child",), child)
+        writer(("child", "grandchild"), list(child.index - {"inner.txt"})[0])
+
+        records.seek(0)
+        loaded = DirectoryIndex.construct_from_records(records)
+        self.assertEqual(index, loaded)
+        self.assertEqual((1, 100), loaded.fingerprint)
+
+class DiffBinsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sector_sets = {
+            "s1": {"a", "b", "c", "d"},
+            "s2": {"a", "b", "e"},
+            "s3": {"a", "c", "e", "f"}
+        }
+
+    def _pairwise_diffbins(self, sector_sets):
+        # What make_filename_diffbins used to compute, minus the duplicates.
+        mapping = {sector: set() for sector in sector_sets}
+        for sector in sector_sets:
+            for other_sector in sector_sets:
+                if other_sector != sector:
+                    for item in sector_sets[other_sector] - sector_sets[sector]:
+                        mapping[sector].add((other_sector, item))
+        return mapping
+
+    def test_make_filename_diffbins(self):
+        mapping = chadow.make_filename_diffbins(self.sector_sets)
+        for sector, diff_bin in mapping.items():
+            self.assertEqual(len(set(diff_bin)), len(diff_bin))
+        self.assertEqual(
+            self._pairwise_diffbins(self.sector_sets),
+            {sector: set(diff_bin) for sector, diff_bin in mapping.items()}
+        )
+        self.assertEqual(
+            sorted([("s2", "e"), ("s3", "e"), ("s3", "f")]), sorted(mapping["s1"])
+        )
+
+    def test_make_filename_diffbins_consistent(self):
+        mapping = chadow.make_filename_diffbins({"s1": {"a", "b"}, "s2": {"b", "a"}})
+        self.assertEqual({"s1": [], "s2": []}, mapping)
+
+    def test_make_comparison_report(self):
+        report = chadow.make_comparison_report(self.sector_sets)
+        self.assertEqual(("s1", 4), report.largest_sector)
+        self.assertEqual(("s2", 3), report.smallest_sector)
+        self.assertEqual(
+            chadow.make_filename_diffbins(self.sector_sets), report.diff_bins
+        )
+
+        empty = chadow.make_comparison_report({})
+        self.assertIsNone(empty.largest_sector)
+        self.assertIsNone(empty.smallest_sector)
+
+class ContentComparatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.media_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_path)
+        self.sector_path_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sector_path_dir)
+        os.mkdir(os.path.join(self.media_path, "copies"))
+        for path, contents in (
+            ("DSC_1234.NEF", b"raw" * 1000),
+            (os.path.join("copies", "DSC_1234.NEF"), b"raw" * 1000),
+            (os.path.join("copies", "renamed.NEF"), b"raw" * 1000),
+            ("DSC_1235.NEF", b"other raw")
+        ):
+            with open(os.path.join(self.media_path, path), "wb") as media_file:
+                media_file.write(contents)
+
+    def _content_items(self):
+        media_index = chadow.MediaWalker(self.media_path).walk()
+        return chadow.content_items(self.media_path, media_index, self.sector_path_dir)
+
+    def test_content_items(self):
+        items = self._content_items()
+        digests = {relative_path: digest for digest, relative_path in items}
+        self.assertEqual(4, len(digests))
+        self.assertEqual(
+            digests["DSC_1234.NEF"], digests[os.path.join("copies", "renamed.NEF")]
+        )
+        self.assertNotEqual(digests["DSC_1234.NEF"], digests["DSC_1235.NEF"])
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.sector_path_dir, chadow.HASH_CACHE_NAME))
+        )
+
+    def test_hash_cache(self):
+        first = sorted(self._content_items())
+        with unittest.mock.patch("chadow_core.hash_file", wraps=chadow.hash_file) as mock_hash:
+            self.assertEqual(first, sorted(self._content_items()))
+            mock_hash.assert_not_called()
+
+            changed = os.path.join(self.media_path, "DSC_1235.NEF")
+            with open(changed, "ab") as media_file:
+                media_file.write(b" truncated?")
+            second = self._content_items()
+            mock_hash.assert_called_once_with(changed)
+
+        self.assertNotEqual(first, sorted(second))
+
+class SizeMtimeComparatorTests(unittest.TestCase):
+
+    def test_size_mtime_items(self):
+        media = {}
+        for media_name in ("ehd1", "ehd2"):
+            media[media_name] = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, media[media_name])
+
+        for name in ("DSC_1234.NEF", "DSC_1235.NEF"):
+            original = os.path.join(media["ehd1"], name)
+            with open(original, "wb") as media_file:
+                media_file.write(b"raw" * 1000)
+            shutil.copy2(original, os.path.join(media["ehd2"], name))
+
+        # A partial copy keeps its name and, with cp -p, its mtime.
+        partial = os.path.join(media["ehd2"], "DSC_1235.NEF")
+        original_stat = os.stat(partial)
+        os.truncate(partial, 100)
+        os.utime(partial, ns=(original_stat.st_atime_ns, original_stat.st_mtime_ns))
+
+        items = {
+            media_name: dict(chadow.size_mtime_items(
+                media_path, chadow.MediaWalker(media_path).walk(), media_path
+            ))
+            for media_name, media_path in media.items()
+        }
+        self.assertEqual(
+            ["DSC_1234.NEF"],
+            [items["ehd1"][item] for item in set(items["ehd1"]) & set(items["ehd2"])]
+        )
+        self.assertEqual(["DSC_1234.NEF", "DSC_1235.NEF"], sorted(items["ehd1"].values()))
+
+class BinaryIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.media_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_path)
+        for path in (
+            ("a.jpg",), ("b.jpg",), ("summer", "c.jpg"),
+            ("summer", "vacation", "d.jpg"), ("summer", "vacation", "e.jpg"),
+            ("winter", "f\udcff.jpg"), ("empty",)
+        ):
+            os.makedirs(os.path.join(self.media_path, *path[:-1]), exist_ok=True)
+            if path == ("empty",):
+                os.mkdir(os.path.join(self.media_path, "empty"))
+            else:
+                with open(os.path.join(self.media_path, *path), "w") as media_file:
+                    media_file.write("x" * len(path))
+        self.media_index = chadow.MediaWalker(self.media_path).walk()
+        self.binary_filename = os.path.join(self.media_path, "index.bin")
+        with open(self.binary_filename, "wb") as index_file:
+            chadow.write_binary_index(self.media_index, index_file)
+
+    def test_roundtrip(self):
+        with chadow.MappedIndex(self.binary_filename) as mapped:
+            self.assertEqual(chadow.VERSION, mapped.version)
+            loaded = mapped.to_directory_index()
+
+        self.assertEqual(self.media_index, loaded)
+        self.assertEqual(self.media_index.to_json(), loaded.to_json())
+
+    def test_lookup(self):
+        with chadow.MappedIndex(self.binary_filename) as mapped:
+            vacation = mapped.lookup(("summer", "vacation"))
+            self.assertEqual(["d.jpg", "e.jpg"], list(vacation.files()))
+            self.assertEqual(("summer", "vacation"), vacation.parts)
+            self.assertEqual(3, vacation.file_stat("d.jpg")[0])
+            self.assertIsNone(vacation.file_stat("nope.jpg"))
+            self.assertIsNone(mapped.lookup(("summer", "nope")))
+            self.assertEqual(
+                ["empty", "summer", "winter"],
+                [subdir.name for subdir in mapped.root().subdirs()]
+            )
+            self.assertEqual(
+                sorted(self.media_index.iter_file_stats()),
+                sorted(mapped.iter_file_stats())
+            )
+            self.assertEqual(
+                [(("summer", "vacation"), "d.jpg"), (("summer", "vacation"), "e.jpg")],
+                sorted(mapped.iter_files(vacation))
+            )
+
+    def test_not_an_index(self):
+        with open(self.binary_filename, "wb") as index_file:
+            index_file.write(b"{\"version\": \"0.1.0\", \"index\": []}")
+        self.assertRaises(ValueError, chadow.MappedIndex, self.binary_filename)
+
+class LazyIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir)
+        self.index_filename = os.path.join(self.index_dir, chadow.INDEX_NAME)
+
+    def _write(self, media_index):
+        with open(self.index_filename, "w") as index_file:
+            media_index.write_json(index_file)
+
+    def _lazy_index(self):
+        lazy_index = chadow.LazyIndex(self.index_filename)
+        self.addCleanup(lazy_index.close)
+        return lazy_index
+
+    def test_roundtrip(self):
+        media_index = DirectoryIndex.construct_from_dict({
+            "version": "0.1.0",
+            "fingerprint": [7, 1000],
+            "stats": {"a.jpg": [3, 1000, 12, "f"]},
+            "index": [
+                "a.jpg", "b\"\\.jpg",
+                {
+                    "subdir_path": "summer",
+                    "stats": {"c.jpg": [5, 2000, 13, "f"]},
+                    "index": ["c.jpg", {"subdir_path": "f\udcff", "index": ["d.jpg"]}]
+                },
+                {"subdir_path": "empty", "index": []}
+            ]
+        })
+        self._write(media_index)
+
+        lazy_index = self._lazy_index()
+        self.assertEqual("0.1.0", lazy_index.version)
+        loaded = lazy_index.to_directory_index()
+        self.assertEqual(media_index, loaded)
+        self.assertEqual(media_index.to_json(), loaded.to_json())
+        self.assertEqual(
+            sorted(media_index.iter_file_stats()), sorted(lazy_index.iter_file_stats())
+        )
+
+    def test_lookup(self):
+        media_index = DirectoryIndex.construct_from_dict({
+            "version": "0.1.0",
+            "index": [
+                "a.jpg",
+                {
+                    "subdir_path": "summer",
+                    "fingerprint": [8, 2000],
+                    "stats": {"c.jpg": [5, 2000, 13, "f"]},
+                    "index": ["c.jpg", {"subdir_path": "vacation", "index": ["d.jpg"]}]
+                }
+            ]
+        })
+        self._write(media_index)
+
+        lazy_index = self._lazy_index()
+        summer = lazy_index.lookup(("summer",))
+        self.assertEqual(("summer",), summer.parts)
+        self.assertEqual((8, 2000), summer.fingerprint)
+        self.assertEqual(["c.jpg"], list(summer.files()))
+        self.assertEqual((5, 2000, 13, "f"), summer.file_stat("c.jpg"))
+        self.assertIsNone(summer.file_stat("a.jpg"))
+        self.assertEqual(["vacation"], [subdir.name for subdir in summer.subdirs()])
+        self.assertEqual(
+            [(("summer", "vacation"), "d.jpg")],
+            list(lazy_index.iter_files(summer.subdir("vacation")))
+        )
+        self.assertIsNone(lazy_index.lookup(("summer", "nope")))
+
+        summer_index = [
+            item for item in media_index.index if isinstance(item, DirectoryIndex)
+        ][0]
+        self.assertEqual(summer_index.content_digest(), summer.content_digest())
+        self.assertEqual(summer_index, lazy_index.to_directory_index(summer))
+
+    def test_hand_written(self):
+        with open("sample_index.json") as sample:
+            expected = DirectoryIndex.construct_from_dict(json.load(sample))
+        self.index_filename = "sample_index.json"
+        self.assertEqual(expected, self._lazy_index().to_directory_index())
+
+    def test_deep_tree(self):
+        depth = sys.getrecursionlimit() * 2
+        leaf = {"subdir_path": "d%d" % depth, "index": ["leaf.txt"]}
+        for level in range(depth - 1, 0, -1):
+            leaf = {"subdir_path": "d%d" % level, "index": [leaf]}
+        media_index = DirectoryIndex.construct_from_dict({"version": "0.1.0", "index": [leaf]})
+        self._write(media_index)
+
+        self.assertEqual(
+            [(tuple("d%d" % level for level in range(1, depth + 1)), "leaf.txt")],
+            list(self._lazy_index().iter_files())
+        )
+        self.assertEqual(
+            media_index, chadow.__dict__["__load_media_index"](self.index_dir)
+        )
+
+    def test_malformed(self):
+        with open(self.index_filename, "w") as index_file:
+            index_file.write('{"version": "0.1.0", "index": ["a.jpg", {"subdir_path": "x", "ind')
+        self.assertRaises(ValueError, lambda: list(self._lazy_index().iter_files()))
+        with open(self.index_filename, "w") as index_file:
+            index_file.write("[]")
+        self.assertRaises(ValueError, chadow.LazyIndex, self.index_filename)
+
+class ConvertIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app_root)
+        patcher = unittest.mock.patch("chadow_core.APP_ROOT", self.app_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.runner = CliRunner()
+
+    def test_convertindex(self):
+        sector_path_dir = os.path.join(self.app_root, "testlib", "sector1", "+media+ehd1")
+        os.makedirs(sector_path_dir)
+        media_index = DirectoryIndex.construct_from_dict({
+            "version": "0.1.0",
+            "index": ["a.jpg", {"subdir_path": "sub", "index": ["b.jpg"]}]
+        })
+        with open(os.path.join(sector_path_dir, chadow.INDEX_NAME), "w") as index_file:
+            index_file.write(media_index.to_json())
+
+        for index_format, index_name in (
+            ("binary", chadow.BINARY_INDEX_NAME),
+            ("jsonl", chadow.STREAMED_INDEX_NAME),
+            ("json", chadow.INDEX_NAME)
+        ):
+            result = self.runner.invoke(
+                chadow.convertindex,
+                ["testlib", "sector1", "/media/ehd1", "--to", index_format]
+            )
+            self.assertEqual(0, result.exit_code)
+            self.assertEqual([index_name], os.listdir(sector_path_dir))
+            self.assertEqual(
+                media_index, chadow.__dict__["__load_media_index"](sector_path_dir)
+            )
+
+    def test_convertindex_no_index(self):
+        result = self.runner.invoke(
+            chadow.convertindex, ["testlib", "sector1", "/media/ehd1"]
+        )
+        self.assertEqual(ExitCodes.STATE_CONFLICT.value, result.exit_code)
+
+class CatalogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app_root)
+        patcher = unittest.mock.patch("chadow_core.APP_ROOT", self.app_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.runner = CliRunner()
+
+        self.media = {}
+        for sector_name, files in (
+            ("sector1", (("a.jpg",), ("2019", "b.jpg"))),
+            ("sector2", (("photos", "a.jpg"), ("photos", "c\udcff.jpg")))
+        ):
+            media_path = os.path.join(self.app_root, "media", sector_name)
+            for parts in files:
+                os.makedirs(os.path.join(media_path, *parts[:-1]), exist_ok=True)
+                with open(os.path.join(media_path, *parts), "w") as media_file:
+                    media_file.write(sector_name)
+            self.media[sector_name] = media_path
+            os.makedirs(os.path.join(
+                self.app_root, "testlib", sector_name,
+                media_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)
+            ))
+
+        self.config = copy.deepcopy(DEFAULT_CONFIG)
+        self.config["libraryMapping"]["testlib"] = chadow.make_default_lib("filename")
+        self.config["libraryMapping"]["testlib"]["sectors"] = {
+            sector_name: [media_path] for sector_name, media_path in self.media.items()
+        }
+        self.config_filename = os.path.join(self.app_root, chadow.CONFIG_NAME)
+        with open(self.config_filename, "w") as config_file:
+            json.dump(self.config, config_file)
+
+    def _invoke(self, click_fn, args, expected_return=0):
+        result = self.runner.invoke(click_fn, args)
+        if result.exception is not None and not isinstance(result.exception, SystemExit):
+            traceback.print_exception(*result.exc_info)
+        self.assertEqual(expected_return, result.exit_code)
+        return result.output
+
+    def _index(self, *args):
+        for sector_name, media_path in self.media.items():
+            self._invoke(chadow.index, ["testlib", sector_name, media_path] + list(args))
+
+    def test_store_index(self):
+        catalog = chadow.Catalog.create(os.path.join(self.app_root, "test.db"))
+        self.addCleanup(catalog.close)
+        media_index = chadow.MediaWalker(self.media["sector2"]).walk()
+        with catalog.transaction():
+            catalog.sync_mapping(self.config)
+            catalog.store_index("testlib", "sector2", self.media["sector2"], media_index)
+
+        stored = catalog.media_index("testlib", "sector2", self.media["sector2"])
+        self.assertEqual(
+            sorted(media_index.iter_file_stats()), sorted(stored.iter_file_stats())
+        )
+        self.assertIsNone(catalog.media_index("testlib", "sector1", self.media["sector1"]))
+        self.assertEqual(
+            [("sector2", self.media["sector2"], os.path.join("photos", "c\udcff.jpg"))],
+            list(catalog.locate("testlib", "c*.jpg"))
+        )
+
+    def test_transaction_rollback(self):
+        catalog = chadow.Catalog.create(os.path.join(self.app_root, "test.db"))
+        self.addCleanup(catalog.close)
+        with catalog.transaction():
+            catalog.sync_mapping(self.config)
+
+        with self.assertRaises(SystemExit):
+            with catalog.transaction():
+                catalog.remove_library("testlib")
+                exit(ExitCodes.STATE_CONFLICT.value)
+        self.assertEqual(["testlib"], catalog.libraries())
+
+    def test_initcatalog(self):
+        self._index()
+        self._invoke(chadow.initcatalog, [])
+
+        with unittest.mock.patch("chadow_core.open", side_effect=AssertionError("config read")):
+            self.assertEqual("testlib\n", self._invoke(chadow.lslib, []))
+            self.assertEqual("sector1\nsector2\n", self._invoke(chadow.lssector, ["testlib"]))
+            self.assertEqual(
+                self.media["sector1"] + "\n", self._invoke(chadow.lsmedia, ["testlib", "sector1"])
+            )
+            self._invoke(chadow.lssector, ["nolib"], ExitCodes.STATE_CONFLICT.value)
+
+        self.assertEqual(
+            [
+                "sector1\t%s" % os.path.join(self.media["sector1"], "a.jpg"),
+                "sector2\t%s" % os.path.join(self.media["sector2"], "photos", "a.jpg")
+            ],
+            self._invoke(chadow.locate, ["testlib", "a.jpg"]).splitlines()
+        )
+
+    def test_index_updates_catalog(self):
+        self._invoke(chadow.initcatalog, [])
+        self.assertEqual("", self._invoke(chadow.locate, ["testlib", "*"]))
+
+        self._index("--stream")
+        self.assertEqual(4, len(self._invoke(chadow.locate, ["testlib", "*"]).splitlines()))
+
+        os.remove(os.path.join(self.media["sector1"], "a.jpg"))
+        self._index()
+        self.assertEqual(
+            ["sector2\t%s" % os.path.join(self.media["sector2"], "photos", "a.jpg")],
+            self._invoke(chadow.locate, ["testlib", "a.jpg"]).splitlines()
+        )
+
+    def test_compare_from_catalog(self):
+        self._invoke(chadow.initcatalog, [])
+        self._index()
+        for sector_name, media_path in self.media.items():
+            shutil.rmtree(os.path.join(
+                self.app_root, "testlib", sector_name,
+                media_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)
+            ))
+
+        output = self._invoke(chadow.compare, ["testlib", "--sequential"])
+        self.assertEqual(
+            [("sector1", "c\udcff.jpg"), ("sector2", "b.jpg")],
+            sorted(
+                (record["sector"], record["item"])
+                for record in map(json.loads, output.splitlines()[1:])
+            )
+        )
+
+    def test_regmedia_rollback(self):
+        self._invoke(chadow.initcatalog, [])
+        media_path = os.path.join(self.app_root, "media", "sector3")
+        os.mkdir(media_path)
+
+        with unittest.mock.patch("chadow_core.json.dump", side_effect=OSError("disk full")):
+            result = self.runner.invoke(chadow.regmedia, ["testlib", "sector1", media_path])
+        self.assertIsInstance(result.exception, OSError)
+
+        self.assertEqual([], os.listdir(media_path))
+        self.assertEqual(
+            [self.media["sector1"].replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)],
+            os.listdir(os.path.join(self.app_root, "testlib", "sector1"))
+        )
+        self.assertEqual(
+            self.media["sector1"] + "\n", self._invoke(chadow.lsmedia, ["testlib", "sector1"])
+        )
+
+        self._invoke(chadow.regmedia, ["testlib", "sector1", media_path])
+        self.assertEqual(
+            [self.media["sector1"], media_path],
+            self._invoke(chadow.lsmedia, ["testlib", "sector1"]).splitlines()
+        )
+        with open(self.config_filename) as config_file:
+            self.assertEqual(
+                [self.media["sector1"], media_path],
+                json.load(config_file)["libraryMapping"]["testlib"]["sectors"]["sector1"]
+            )
+
+class LibraryOnDiskTests(unittest.TestCase):
+    """
+    A library of one medium of real files, with a real config, for tests that
+    run commands end to end.
+    """
+
+    def setUp(self):
+        self.app_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app_root)
+        patcher = unittest.mock.patch("chadow_core.APP_ROOT", self.app_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.runner = CliRunner()
+
+        self.media_path = os.path.join(self.app_root, "media", "ehd1")
+        os.makedirs(os.path.join(self.media_path, "2019"))
+        for name, content in (("a.jpg", "aaaa"), (os.path.join("2019", "b.jpg"), "bb")):
+            with open(os.path.join(self.media_path, name), "w") as media_file:
+                media_file.write(content)
+        self.sector_path_dir = os.path.join(
+            self.app_root, "testlib", "sector1",
+            self.media_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)
+        )
+        os.makedirs(self.sector_path_dir)
+
+        config = copy.deepcopy(DEFAULT_CONFIG)
+        config["libraryMapping"]["testlib"] = chadow.make_default_lib("filename")
+        config["libraryMapping"]["testlib"]["sectors"] = {
+            "sector1": [self.media_path], "sector2": []
+        }
+        with open(os.path.join(self.app_root, chadow.CONFIG_NAME), "w") as config_file:
+            json.dump(config, config_file)
+
+    def _invoke(self, click_fn, args):
+        result = self.runner.invoke(click_fn, args)
+        if result.exception is not None and not isinstance(result.exception, SystemExit):
+            traceback.print_exception(*result.exc_info)
+        self.assertEqual(0, result.exit_code)
+        return result.output
+
+class MetricsTests(LibraryOnDiskTests):
+
+    def setUp(self):
+        super().setUp()
+        self.metrics_filename = os.path.join(self.app_root, "chadow_core.prom")
+
+    def test_phases(self):
+        metrics = chadow.RunMetrics("index")
+        clock = iter([0.0, 1.0, 3.0, 6.0])
+        with unittest.mock.patch("chadow_core.time.perf_counter", lambda: next(clock)), \
+                unittest.mock.patch("chadow_core.time.process_time", return_value=0.0):
+            with metrics.phase("serialize"):
+                with metrics.phase("write"):
+                    pass
+
+        self.assertEqual({"serialize": [4.0, 0.0], "write": [2.0, 0.0]}, metrics.phases)
+
+        other = chadow.RunMetrics("index")
+        other.add_phase("write", 1.0, 0.5)
+        other.count("files", 3)
+        metrics.merge(other)
+        self.assertEqual([3.0, 0.5], metrics.phases["write"])
+        self.assertEqual({"files": 3}, metrics.counters)
+
+    def test_index_metrics(self):
+        self._invoke(chadow.index, [
+            "testlib", "sector1", self.media_path, "--metrics", self.metrics_filename
+        ])
+
+        with open(self.metrics_filename) as metrics_file:
+            metrics = json.load(metrics_file)
+        self.assertEqual("index", metrics["command"])
+        self.assertEqual({"library": "testlib", "sector": "sector1"}, metrics["labels"])
+        self.assertEqual(
+            {"walk", "serialize", "write", "history", "catalog"}, set(metrics["phases"])
+        )
+        written = os.path.getsize(os.path.join(self.sector_path_dir, chadow.INDEX_NAME))
+        self.assertEqual(
+            {"media": 1, "directories": 2, "files": 2, "bytes_stat": 6, "bytes_written": written},
+            metrics["counters"]
+        )
+        self.assertGreater(metrics["entries_per_second"], 0)
+        self.assertGreater(metrics["peak_rss_bytes"], 0)
+
+        # Timing the writes must not change what is written.
+        media_index = chadow.__dict__["__load_media_index"](self.sector_path_dir)
+        self.assertEqual(
+            sorted(chadow.MediaWalker(self.media_path).walk().iter_file_stats()),
+            sorted(media_index.iter_file_stats())
+        )
+
+    def test_index_all_prometheus(self):
+        self._invoke(chadow.index, [
+            "testlib", "--all", "--binary", "--metrics", self.metrics_filename,
+            "--metrics-format", "prometheus"
+        ])
+
+        with open(self.metrics_filename) as metrics_file:
+            lines = metrics_file.read().splitlines()
+        self.assertIn("# TYPE chadow_files gauge", lines)
+        self.assertIn('chadow_files{command="index",library="testlib",sector=""} 2.0', lines)
+        self.assertTrue(any(
+            line.startswith('chadow_phase_wall_seconds{command="index",library="testlib",phase="walk",sector=""} ')
+            for line in lines
+        ))
+        self.assertFalse(os.path.exists(self.metrics_filename + ".partial"))
+
+    def test_compare_profile(self):
+        self._invoke(chadow.index, ["testlib", "sector1", self.media_path])
+        with self.assertLogs(level="INFO") as logs:
+            self._invoke(chadow.compare, ["testlib", "--sequential", "--profile"])
+
+        profile = [line for line in logs.output if line.startswith("INFO:root:  ")]
+        self.assertEqual(
+            {"load", "report", "items", "media", "missing", "moved"},
+            {line.split()[1] for line in profile if "peak" not in line}
+        )
+
+class ProgressTests(LibraryOnDiskTests):
+
+    def test_report(self):
+        stream = io.StringIO()
+        clock = iter([0.0, 0.5, 1.0, 1.5, 4.0])
+        with unittest.mock.patch("chadow_core.time.monotonic", lambda: next(clock)):
+            reporter = chadow.ProgressReporter(
+                "sector1 /media", 1000, stream=stream, overwrite=False, interval=1.0
+            )
+            for directories, files in ((1, 99), (2, 198), (3, 297), (50, 1000)):
+                reporter(directories, files)
+            reporter.finish(50, 1000)
+
+        self.assertEqual(
+            "sector1 /media: 2 directories, 198 files, 200 entries/s, 20%, ETA 0:00:04\n"
+            "sector1 /media: 50 directories, 1000 files, 262 entries/s, 99%, ETA unknown\n",
+            stream.getvalue()
+        )
+
+    def test_expected_entries(self):
+        media_index = chadow.MediaWalker(self.media_path).walk()
+        self.assertEqual(4, chadow.count_index_entries(media_index))
+        binary_filename = os.path.join(self.app_root, chadow.BINARY_INDEX_NAME)
+        json_filename = os.path.join(self.app_root, chadow.INDEX_NAME)
+        with open(binary_filename, "wb") as index_file:
+            chadow.write_binary_index(media_index, index_file)
+        with open(json_filename, "w") as index_file:
+            media_index.write_json(index_file)
+        with chadow.MappedIndex(binary_filename) as mapped, chadow.LazyIndex(json_filename) as lazy:
+            self.assertEqual(4, chadow.count_index_entries(mapped))
+            self.assertEqual(4, chadow.count_index_entries(lazy))
+        # Empty directories count too in an in-memory index.
+        os.mkdir(os.path.join(self.media_path, "empty"))
+        self.assertEqual(5, chadow.count_index_entries(chadow.MediaWalker(self.media_path).walk()))
+
+        self.assertIsNone(chadow.estimate_media_entries(self.media_path))
+        with unittest.mock.patch("chadow_core.os.path.ismount", return_value=True), \
+                unittest.mock.patch("chadow_core.os.statvfs") as mock_statvfs:
+            mock_statvfs.return_value.f_files = 1000
+            mock_statvfs.return_value.f_ffree = 900
+            self.assertEqual(100, chadow.estimate_media_entries(self.media_path))
+            mock_statvfs.return_value.f_files = 0
+            self.assertIsNone(chadow.estimate_media_entries(self.media_path))
+
+    def test_index_progress(self):
+        with unittest.mock.patch("chadow_core.PROGRESS_INTERVAL", 0):
+            self._invoke(chadow.index, ["testlib", "sector1", self.media_path])
+            output = self._invoke(chadow.index, ["testlib", "sector1", self.media_path, "--progress"])
+
+        reports = output.split("\r")[1:]
+        self.assertEqual(3, len(reports))
+        self.assertTrue(reports[0].startswith("sector1 %s: 1 directories, 1 files, " % self.media_path))
+        self.assertTrue(reports[-1].startswith("sector1 %s: 2 directories, 2 files, " % self.media_path))
+        self.assertIn(", 99%, ETA unknown", reports[-1])
+
+class ResumeTests(LibraryOnDiskTests):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.media_path, "2018", "summer"))
+        with open(os.path.join(self.media_path, "2018", "summer", "c.jpg"), "w") as media_file:
+            media_file.write("c")
+        self.index_filename = os.path.join(self.sector_path_dir, chadow.INDEX_NAME)
+        self.checkpoint_filename = os.path.join(self.sector_path_dir, chadow.CHECKPOINT_NAME)
+        self.args = ["testlib", "sector1", self.media_path, "--sequential"]
+
+        # A sequential walk goes through the directories last listed first;
+        # make that 2019, then 2018.
+        scan_directory = chadow._scan_directory
+
+        def _sorted_scan(path, *args):
+            dirs, files, stats = scan_directory(path, *args)
+            return sorted(dirs), files, stats
+
+        patcher = unittest.mock.patch("chadow_core._scan_directory", side_effect=_sorted_scan)
+        self.mock_scan = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _interrupted_index(self, interrupted_dir):
+        scan_directory = self.mock_scan.side_effect
+
+        def _scan(path, *args):
+            if path == os.path.join(self.media_path, interrupted_dir):
+                raise KeyboardInterrupt
+            return scan_directory(path, *args)
+
+        with unittest.mock.patch("chadow_core._scan_directory", side_effect=_scan):
+            result = self.runner.invoke(chadow.index, self.args)
+        self.assertNotEqual(0, result.exit_code)
+        self.assertFalse(os.path.exists(self.index_filename))
+
+    def test_resume(self):
+        self._invoke(chadow.index, self.args)
+        with open(self.index_filename) as index_file:
+            uninterrupted = index_file.read()
+        os.remove(self.index_filename)
+
+        # 2019 is walked first and completes; 2018 is never got to.
+        self._interrupted_index("2018")
+        with open(self.checkpoint_filename) as checkpoint_file:
+            self.assertEqual(2, len(checkpoint_file.readlines()))
+
+        self.mock_scan.reset_mock()
+        self._invoke(chadow.index, self.args + ["--resume"])
+        self.assertEqual(
+            [
+                self.media_path, os.path.join(self.media_path, "2018"),
+                os.path.join(self.media_path, "2018", "summer")
+            ],
+            [call[0][0] for call in self.mock_scan.call_args_list]
+        )
+        with open(self.index_filename) as index_file:
+            self.assertEqual(uninterrupted, index_file.read())
+        self.assertFalse(os.path.exists(self.checkpoint_filename))
+
+    def test_resume_partial(self):
+        os.makedirs(os.path.join(self.media_path, "2018", "winter"))
+        self._invoke(chadow.index, self.args)
+        with open(self.index_filename) as index_file:
+            uninterrupted = index_file.read()
+        os.remove(self.index_filename)
+
+        # winter completes, but 2018 does not since summer is not got to.
+        self._interrupted_index(os.path.join("2018", "summer"))
+        self.mock_scan.reset_mock()
+        self._invoke(chadow.index, self.args + ["--resume"])
+        self.assertEqual(
+            [
+                self.media_path, os.path.join(self.media_path, "2018"),
+                os.path.join(self.media_path, "2018", "summer")
+            ],
+            [call[0][0] for call in self.mock_scan.call_args_list]
+        )
+        with open(self.index_filename) as index_file:
+            self.assertEqual(uninterrupted, index_file.read())
+
+    def test_resume_without_checkpoint(self):
+        self._invoke(chadow.index, self.args + ["--resume"])
+        self.assertTrue(os.path.exists(self.index_filename))
+
+    def test_unreadable_directory(self):
+        checkpointed = []
+        scan_directory = self.mock_scan.side_effect
+
+        def _scan(path, *args):
+            if path.endswith("summer"):
+                raise PermissionError(path)
+            return scan_directory(path, *args)
+
+        with unittest.mock.patch("chadow_core._scan_directory", side_effect=_scan):
+            chadow.MediaWalker(
+                self.media_path, sequential=True,
+                checkpoint=lambda parts, dir_index: checkpointed.append(parts)
+            ).walk()
+        # Neither 2018 nor the root are complete without summer.
+        self.assertEqual([("2019",)], checkpointed)
+
+    def test_resume_stream(self):
+        result = self.runner.invoke(chadow.index, self.args + ["--resume", "--stream"])
+        self.assertEqual(ExitCodes.INVALID_ARG.value, result.exit_code)
+
+class WatchTests(LibraryOnDiskTests):
+
+    def setUp(self):
+        super().setUp()
+        self.index_filename = os.path.join(self.sector_path_dir, chadow.INDEX_NAME)
+        self.written = []
+
+    def _watcher(self, **kwargs):
+        watcher = chadow.MediaWatcher(
+            self.media_path, self.written.append, sequential=True, debounce=0, **kwargs
+        )
+        self.addCleanup(watcher.close)
+        watcher.start()
+        return watcher
+
+    def _settle(self, watcher):
+        """
+        Take in events until there are no more, then apply them.
+        """
+        while True:
+            events = watcher.inotify.read_events(0.2)
+            if not events:
+                break
+            watcher.handle(events)
+        return watcher.refresh()
+
+    def _assert_fresh(self, media_index):
+        fresh = chadow.MediaWalker(self.media_path, sequential=True).walk()
+        self.assertEqual(fresh, media_index)
+        self.assertEqual(
+            sorted(fresh.iter_file_stats()), sorted(media_index.iter_file_stats())
+        )
+
+    def _write(self, name, content):
+        with open(os.path.join(self.media_path, name), "w") as media_file:
+            media_file.write(content)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux-only")
+    def test_changes(self):
+        watcher = self._watcher()
+        if watcher.inotify is None:
+            self.skipTest("inotify is not available")
+
+        self._write("c.jpg", "c")
+        self._write(os.path.join("2019", "b.jpg"), "bbbbbb")
+        os.remove(os.path.join(self.media_path, "a.jpg"))
+        os.makedirs(os.path.join(self.media_path, "2020", "spring"))
+        self._write(os.path.join("2020", "spring", "d.jpg"), "d")
+        self._assert_fresh(self._settle(watcher))
+
+        # A directory moved within the medium is watched under its new name.
+        os.rename(os.path.join(self.media_path, "2019"), os.path.join(self.media_path, "old"))
+        self._assert_fresh(self._settle(watcher))
+        self._write(os.path.join("old", "e.jpg"), "e")
+        os.rename(
+            os.path.join(self.media_path, "2020", "spring"),
+            os.path.join(self.media_path, "old", "spring")
+        )
+        self._write(os.path.join("old", "spring", "f.jpg"), "f")
+        self._assert_fresh(self._settle(watcher))
+
+        shutil.rmtree(os.path.join(self.media_path, "old"))
+        self._assert_fresh(self._settle(watcher))
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux-only")
+    def test_step_debounces(self):
+        watcher = self._watcher()
+        if watcher.inotify is None:
+            self.skipTest("inotify is not available")
+        watcher.debounce = 60
+
+        self._write("c.jpg", "c")
+        self.assertFalse(watcher.step(0.2))
+        self.assertEqual([], self.written)
+
+        watcher.max_delay = 0
+        self.assertTrue(watcher.step(0.2))
+        self.assertEqual(1, len(self.written))
+        self._assert_fresh(self.written[0])
+
+    def test_poll(self):
+        watcher = self._watcher(use_inotify=False, poll_interval=0)
+        self.assertIsNone(watcher.inotify)
+        self.assertFalse(watcher.step())
+        self.assertEqual([], self.written)
+
+        self._write(os.path.join("2019", "b.jpg"), "bbbbbb")
+        self.assertTrue(watcher.step())
+        self.assertEqual(1, len(self.written))
+        self._assert_fresh(self.written[0])
+
+    def test_watch(self):
+        with unittest.mock.patch("chadow_core.MediaWatcher.run", side_effect=KeyboardInterrupt):
+            self._invoke(chadow.watch, ["testlib", "sector1", self.media_path])
+        with open(self.index_filename) as index_file:
+            media_index = chadow.DirectoryIndex.construct_from_dict(json.load(index_file))
+        self.assertEqual(
+            {((), "a.jpg"), (("2019",), "b.jpg")}, set(media_index.iter_files())
+        )
+
+    def test_watch_unregistered(self):
+        result = self.runner.invoke(chadow.watch, ["testlib", "sector2", self.media_path])
+        self.assertEqual(ExitCodes.STATE_CONFLICT.value, result.exit_code)
+
+class HistoryTests(LibraryOnDiskTests):
+
+    def setUp(self):
+        super().setUp()
+        self.history = chadow.IndexHistory(
+            os.path.join(self.sector_path_dir, chadow.HISTORY_DIR_NAME)
+        )
+        self.args = ["testlib", "sector1", self.media_path]
+
+    def test_history(self):
+        self._invoke(chadow.index, self.args)
+        with open(os.path.join(self.media_path, "c.jpg"), "w") as media_file:
+            media_file.write("c")
+        with open(os.path.join(self.media_path, "2019", "b.jpg"), "w") as media_file:
+            media_file.write("bbbbbb")
+        os.remove(os.path.join(self.media_path, "a.jpg"))
+        self._invoke(chadow.index, self.args + ["--stream"])
+        self._invoke(chadow.index, self.args + ["--binary"])
+
+        self.assertEqual(
+            [(1, 2, 2, 0, 0), (2, 2, 1, 1, 1), (3, 2, 0, 0, 0)],
+            [
+                (h["snapshot"], h["files"], h["added"], h["removed"], h["changed"])
+                for h in self.history.snapshots()
+            ]
+        )
+        self.assertEqual(3, len(self._invoke(chadow.history, self.args).splitlines()))
+        self.assertEqual(
+            [os.path.join("2019", "b.jpg"), "a.jpg"],
+            self._invoke(chadow.history, self.args + ["1"]).splitlines()
+        )
+        self.assertEqual(
+            ["~ " + os.path.join("2019", "b.jpg"), "- a.jpg", "+ c.jpg"],
+            self._invoke(chadow.diff_snapshots, self.args + ["1"]).splitlines()
+        )
+        self.assertEqual(
+            ["~ " + os.path.join("2019", "b.jpg"), "+ a.jpg", "- c.jpg"],
+            self._invoke(chadow.diff_snapshots, self.args + ["-1", "1"]).splitlines()
+        )
+        self.assertEqual(
+            "", self._invoke(chadow.diff_snapshots, self.args + ["2", "3"])
+        )
+
+        result = self.runner.invoke(chadow.diff_snapshots, self.args + ["4"])
+        self.assertEqual(ExitCodes.INVALID_ARG.value, result.exit_code)
+
+    def test_compaction(self):
+        snapshots = []
+        # Enough files that the deltas stay small next to a full snapshot.
+        files = {("2019",): {"b%d.jpg" % i: (2, 0, i, "f") for i in range(100)}}
+        with unittest.mock.patch("chadow_core.HISTORY_BASE_INTERVAL", 3), \
+                unittest.mock.patch("chadow_core.HISTORY_KEEP_BASES", 2):
+            for run in range(10):
+                # A few new files every run, and one changed.
+                files.setdefault((), {})["a%d.jpg" % run] = (run, 0, run, "f")
+                files[("2019",)]["b0.jpg"] = (2, run, 0, "f")
+                if run % 4 == 3:
+                    del files[()]["a%d.jpg" % (run - 2)]
+                snapshots.append({
+                    parts + (name,): file_stat
+                    for parts, names in files.items() for name, file_stat in names.items()
+                })
+                self.history.record(
+                    (parts, name, file_stat)
+                    for parts, names in files.items() for name, file_stat in names.items()
+                )
+
+        self.assertEqual(
+            [1, 7, 10], [h["snapshot"] for h in self.history.snapshots() if h["base"]]
+        )
+        for number, snapshot in enumerate(snapshots, 1):
+            self.assertEqual(snapshot, self.history.snapshot(number))
+        for old, new in ((1, 10), (5, 6), (9, 2)):
+            expected = sorted(
+                [("+", path) for path in snapshots[new - 1].keys() - snapshots[old - 1].keys()] +
+                [("-", path) for path in snapshots[old - 1].keys() - snapshots[new - 1].keys()] +
+                [
+                    ("~", path) for path in snapshots[old - 1].keys() & snapshots[new - 1].keys()
+                    if snapshots[old - 1][path] != snapshots[new - 1][path]
+                ],
+                key=lambda change: change[1]
+            )
+            self.assertEqual(expected, self.history.changes(old, new))
+
+    def test_record_in_runs(self):
+        snapshots = [
+            {("d%d" % (i % 3), "f%d" % i): (i, run, i, "f") for i in range(run * 5, run * 5 + 20)}
+            for run in range(3)
+        ]
+        with unittest.mock.patch("chadow_core.HISTORY_SORT_RUN", 3):
+            for files in snapshots:
+                self.history.record(
+                    (path[:-1], path[-1], file_stat) for path, file_stat in files.items()
+                )
+        for number, files in enumerate(snapshots, 1):
+            entries = list(self.history.iter_snapshot(number))
+            self.assertEqual(sorted(files.items()), entries)
+        self.assertEqual(
+            [(20, 5, 5, 15)],
+            [
+                (h["files"], h["added"], h["removed"], h["changed"])
+                for h in self.history.snapshots()[1:2]
+            ]
+        )
+        # Nothing but the snapshots is left behind.
+        self.assertTrue(all(
+            chadow.IndexHistory.FILENAME.match(name) for name in os.listdir(self.history.directory)
+        ))
+
+    def test_snapshot_merge_order(self):
+        # The entries of each delta sort by its number, whatever order the
+        # streams are merged in.
+        unchanged = [((), "b%d.jpg" % i, (1, 0, i, "f")) for i in range(20)]
+        for size in (1, 2, 3):
+            self.history.record([((), "a.jpg", (size, 0, 1, "f"))] + unchanged)
+        self.assertEqual([1], [h["snapshot"] for h in self.history.snapshots() if h["base"]])
+        merge = chadow.heapq.merge
+        with unittest.mock.patch(
+            "chadow_core.heapq.merge", lambda *streams, key: merge(*streams[::-1], key=key)
+        ):
+            self.assertEqual(
+                (("a.jpg",), (3, 0, 1, "f")), next(self.history.iter_snapshot(3))
+            )
+
+    def test_no_history(self):
+        self._invoke(chadow.index, self.args + ["--no-history"])
+        self._invoke(chadow.index, self.args + ["--stream", "--no-history"])
+        self.assertEqual([], self.history.snapshots())
+
+    def test_changes_readded(self):
+        for names in (["a.jpg", "b.jpg"], ["b.jpg"], ["a.jpg", "b.jpg", "c.jpg"], ["a.jpg"]):
+            self.history.record([((), name, (1, 0, 1, "f")) for name in names])
+        self.assertEqual(
+            [("-", ("a.jpg",)), ("+", ("a.jpg",)), ("+", ("c.jpg",))], self.history.changes(1, 3)
+        )
+        self.assertEqual(
+            [("-", ("a.jpg",)), ("+", ("a.jpg",)), ("-", ("c.jpg",))], self.history.changes(3, 1)
+        )
+        # Gone and back within the range, and gone again.
+        self.assertEqual(
+            [("-", ("a.jpg",)), ("+", ("a.jpg",)), ("-", ("b.jpg",))], self.history.changes(1, 4)
+        )
+        self.assertEqual([("+", ("a.jpg",)), ("-", ("b.jpg",))], self.history.changes(2, 4))
+
+    def test_resolve(self):
+        for taken in ("2026-08-01T12:00", "2026-09-15T08:00", "2026-09-15T20:00"):
+            self.history.record(
+                [((), "a.jpg", None)], datetime.datetime.fromisoformat(taken).timestamp()
+            )
+        self.assertEqual(3, self.history.resolve("-1"))
+        self.assertEqual(2, self.history.resolve("2"))
+        self.assertEqual(1, self.history.resolve("2026-09-01"))
+        self.assertEqual(3, self.history.resolve("2026-09-15"))
+        self.assertEqual(2, self.history.resolve("2026-09-15T12:00"))
+        for spec in ("0", "-4", "2026-07-31"):
+            with self.assertRaises(ValueError):
+                self.history.resolve(spec)
+
+class DupesTests(LibraryOnDiskTests):
+
+    def setUp(self):
+        super().setUp()
+        self.other_media_path = os.path.join(self.app_root, "media", "ehd2")
+        os.makedirs(self.other_media_path)
+        self.other_sector_path_dir = os.path.join(
+            self.app_root, "testlib", "sector1",
+            self.other_media_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)
+        )
+        os.makedirs(self.other_sector_path_dir)
+        config_filename = os.path.join(self.app_root, chadow.CONFIG_NAME)
+        with open(config_filename) as config_file:
+            config = json.load(config_file)
+        config["libraryMapping"]["testlib"]["sectors"]["sector1"].append(self.other_media_path)
+        with open(config_filename, "w") as config_file:
+            json.dump(config, config_file)
+
+    def _write(self, path, content):
+        with open(path, "wb") as media_file:
+            media_file.write(content)
+        return path
+
+    def test_find_duplicates(self):
+        block = 4
+        same = [
+            self._write(os.path.join(self.app_root, "same%d" % i), b"0123456789ab")
+            for i in range(3)
+        ]
+        # Same size and ends, different middle.
+        middle = self._write(os.path.join(self.app_root, "middle"), b"0123xxxx89ab")
+        # Same size, different ends.
+        ends = self._write(os.path.join(self.app_root, "ends"), b"x123456789ab")
+        small = [
+            self._write(os.path.join(self.app_root, "small%d" % i), b"0123") for i in range(2)
+        ]
+        unique = self._write(os.path.join(self.app_root, "unique"), b"0")
+        hashed = []
+
+        def _hash_full(path):
+            hashed.append(path)
+            return chadow.hash_file(path)
+
+        groups = chadow.find_duplicates(
+            [(path, os.path.getsize(path)) for path in same + [middle, ends] + small + [unique]] +
+            [(os.path.join(self.app_root, "gone"), 12)],
+            hash_full=_hash_full, block_size=block
+        )
+        self.assertEqual([(12, same), (4, small)], groups)
+        # Only the files that could not be told apart by their ends are read whole.
+        self.assertEqual(sorted(same + [middle]), sorted(hashed))
+
+    def test_hash_file_ends(self):
+        path = self._write(os.path.join(self.app_root, "file"), b"abcdefgh")
+        self.assertEqual(chadow.hash_file(path), chadow.hash_file_ends(path, 8, block_size=4))
+        self.assertEqual(
+            chadow.hash_file_ends(path, 8, block_size=2),
+            chadow.hash_file_ends(
+                self._write(os.path.join(self.app_root, "other"), b"abXXXXgh"), 8, block_size=2
+            )
+        )
+
+    def test_dupes(self):
+        copy_path = self._write(os.path.join(self.other_media_path, "a copy.jpg"), b"aaaa")
+        # Large enough to be hashed whole.
+        large = b"v" * (2 * chadow.DUPES_BLOCK_SIZE + 1)
+        large_paths = [
+            self._write(os.path.join(media_path, "video.mp4"), large)
+            for media_path in (self.media_path, self.other_media_path)
+        ]
+        os.link(copy_path, os.path.join(self.other_media_path, "a link.jpg"))
+        self._write(os.path.join(self.other_media_path, "empty"), b"")
+        self._write(os.path.join(self.media_path, "empty"), b"")
+        for media_path in (self.media_path, self.other_media_path):
+            self._invoke(chadow.index, ["testlib", "sector1", media_path])
+
+        with open(os.path.join(self.other_sector_path_dir, chadow.HASH_CACHE_NAME), "w") as cache_file:
+            json.dump({
+                "version": chadow.get_version(), "algorithm": chadow.CONTENT_HASH_ALGORITHM,
+                "entries": {"1:2:3:4": "cached"}
+            }, cache_file)
+
+        output = self._invoke(chadow.dupes, ["testlib"])
+        self.assertEqual(
+            [
+                "2 copies of %d bytes:" % len(large),
+                "    %s" % large_paths[0],
+                "    %s" % large_paths[1],
+                "2 copies of 4 bytes:",
+                "    %s" % os.path.join(self.media_path, "a.jpg"),
+                "    %s" % copy_path
+            ],
+            output.splitlines()
+        )
+        with open(os.path.join(self.other_sector_path_dir, chadow.HASH_CACHE_NAME)) as cache_file:
+            entries = json.load(cache_file)["entries"]
+        # What the content comparator cached is kept.
+        self.assertEqual("cached", entries["1:2:3:4"])
+        self.assertIn(chadow.hash_file(large_paths[1]), entries.values())
+
+        self.assertEqual("", self._invoke(chadow.dupes, ["testlib", "sector2"]))
+
+    def test_dupes_nested_media(self):
+        nested_path = os.path.join(self.media_path, "2019")
+        nested_sector_path_dir = os.path.join(
+            self.app_root, "testlib", "sector2",
+            nested_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)
+        )
+        os.makedirs(nested_sector_path_dir)
+        config_filename = os.path.join(self.app_root, chadow.CONFIG_NAME)
+        with open(config_filename) as config_file:
+            config = json.load(config_file)
+        config["libraryMapping"]["testlib"]["sectors"]["sector2"].append(nested_path)
+        with open(config_filename, "w") as config_file:
+            json.dump(config, config_file)
+
+        large = b"v" * (2 * chadow.DUPES_BLOCK_SIZE + 1)
+        large_paths = [
+            self._write(os.path.join(nested_path, "video.mp4"), large),
+            self._write(os.path.join(self.other_media_path, "video.mp4"), large)
+        ]
+        for sector, media_path in (
+            ("sector1", self.media_path), ("sector1", self.other_media_path),
+            ("sector2", nested_path)
+        ):
+            self._invoke(chadow.index, ["testlib", sector, media_path])
+
+        output = self._invoke(chadow.dupes, ["testlib"])
+        # Listed once, although both media that hold it were looked at.
+        self.assertEqual(
+            ["2 copies of %d bytes:" % len(large)] + ["    %s" % path for path in large_paths],
+            output.splitlines()
+        )
+        # Hashed into the cache of the medium it was first found on.
+        with open(os.path.join(self.sector_path_dir, chadow.HASH_CACHE_NAME)) as cache_file:
+            self.assertIn(chadow.hash_file(large_paths[0]), json.load(cache_file)["entries"].values())
+        with open(os.path.join(nested_sector_path_dir, chadow.HASH_CACHE_NAME)) as cache_file:
+            self.assertEqual({}, json.load(cache_file)["entries"])
+
+    def test_dupes_not_indexed(self):
+        result = self.runner.invoke(chadow.dupes, ["testlib"])
+        self.assertEqual(ExitCodes.STATE_CONFLICT.value, result.exit_code)
+
+class SyncTests(LibraryOnDiskTests):
+
+    def setUp(self):
+        super().setUp()
+        self.other_media_path = os.path.join(self.app_root, "media", "ehd2")
+        os.makedirs(self.other_media_path)
+        with open(os.path.join(self.other_media_path, "a.jpg"), "w") as media_file:
+            media_file.write("aaaa")
+        self.other_sector_path_dir = os.path.join(
+            self.app_root, "testlib", "sector2",
+            self.other_media_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)
+        )
+        os.makedirs(self.other_sector_path_dir)
+        config_filename = os.path.join(self.app_root, chadow.CONFIG_NAME)
+        with open(config_filename) as config_file:
+            config = json.load(config_file)
+        config["libraryMapping"]["testlib"]["sectors"]["sector2"].append(self.other_media_path)
+        with open(config_filename, "w") as config_file:
+            json.dump(config, config_file)
+
+        self._invoke(chadow.index, ["testlib", "sector1", self.media_path])
+        self._invoke(chadow.index, ["testlib", "sector2", self.other_media_path, "--binary"])
+        self.args = ["testlib", "--from", "sector1", "--to", "sector2"]
+        self.copied_path = os.path.join(self.other_media_path, "2019", "b.jpg")
+
+    def test_sync(self):
+        self._invoke(chadow.sync, self.args)
+
+        source_stat = os.stat(os.path.join(self.media_path, "2019", "b.jpg"))
+        with open(self.copied_path) as copied_file:
+            self.assertEqual("bb", copied_file.read())
+        self.assertEqual(source_stat.st_mtime_ns, os.stat(self.copied_path).st_mtime_ns)
+        self.assertEqual(["2019", "a.jpg"], sorted(os.listdir(self.other_media_path)))
+
+        # The index is updated in its own format, without indexing again.
+        with chadow.MappedIndex(
+            os.path.join(self.other_sector_path_dir, chadow.BINARY_INDEX_NAME)
+        ) as mapped_index:
+            media_index = mapped_index.to_directory_index()
+        fresh = chadow.MediaWalker(self.other_media_path).walk()
+        self.assertEqual(fresh, media_index)
+        self.assertEqual(sorted(fresh.iter_file_stats()), sorted(media_index.iter_file_stats()))
+        self.assertIsNone(media_index.fingerprint)
+        history = chadow.IndexHistory(
+            os.path.join(self.other_sector_path_dir, chadow.HISTORY_DIR_NAME)
+        )
+        self.assertEqual([(("2019", "b.jpg"), "+")], [
+            (path, op) for op, path in history.changes(1, 2)
+        ])
+
+        output = self._invoke(chadow.sync, self.args)
+        self.assertIn("copied 0 file(s)", output)
+
+    def test_sync_dry_run(self):
+        output = self._invoke(chadow.sync, self.args + ["--dry-run"])
+        self.assertEqual(
+            [
+                "%s -> %s (2 bytes)" % (os.path.join(self.media_path, "2019", "b.jpg"), self.copied_path),
+                "0 file(s) to move; 1 file(s), 2 bytes to copy; 0 already copied."
+            ],
+            output.splitlines()
+        )
+        self.assertFalse(os.path.exists(os.path.dirname(self.copied_path)))
+
+    def test_sync_in_the_way(self):
+        os.makedirs(os.path.dirname(self.copied_path))
+        with open(self.copied_path, "w") as media_file:
+            media_file.write("not b")
+        output = self._invoke(chadow.sync, self.args)
+        self.assertIn("1 in the way", output)
+        with open(self.copied_path) as media_file:
+            self.assertEqual("not b", media_file.read())
+
+    def test_sync_unmounted(self):
+        shutil.rmtree(self.other_media_path)
+        result = self.runner.invoke(chadow.sync, self.args)
+        self.assertEqual(ExitCodes.STATE_CONFLICT.value, result.exit_code)
+
+    def test_copy_file_resumes(self):
+        source = os.path.join(self.app_root, "source")
+        with open(source, "wb") as source_file:
+            source_file.write(b"0123456789")
+        source_stat = os.stat(source)
+        destination = os.path.join(self.app_root, "copies", "destination")
+        os.makedirs(os.path.dirname(destination))
+        partial = "%s.chadow-%d-%d.partial" % (destination, 10, source_stat.st_mtime_ns)
+        with open(partial, "wb") as partial_file:
+            partial_file.write(b"0123")
+
+        self.assertEqual(6, chadow.copy_file(source, destination))
+        with open(destination, "rb") as destination_file:
+            self.assertEqual(b"0123456789", destination_file.read())
+        self.assertFalse(os.path.exists(partial))
+        self.assertEqual(source_stat.st_mtime_ns, os.stat(destination).st_mtime_ns)
+
+    def test_copy_file_fallback(self):
+        source = os.path.join(self.app_root, "source")
+        with open(source, "wb") as source_file:
+            source_file.write(b"0123456789")
+        destination = os.path.join(self.app_root, "destination")
+        unsupported = [OSError(errno.EXDEV, "cross-device"), OSError(errno.EINVAL, "invalid")]
+        with unittest.mock.patch("chadow_core.os.copy_file_range", side_effect=unsupported[0], create=True), \
+                unittest.mock.patch("chadow_core.os.sendfile", side_effect=unsupported[1], create=True):
+            self.assertEqual(10, chadow.copy_file(source, destination, chunk_size=3))
+        with open(destination, "rb") as destination_file:
+            self.assertEqual(b"0123456789", destination_file.read())
+
+    def _rename_on_destination(self):
+        # A copy of 2019/b.jpg, renamed.
+        source = os.path.join(self.media_path, "2019", "b.jpg")
+        self.renamed_path = os.path.join(self.other_media_path, "2019", "b renamed.jpg")
+        os.makedirs(os.path.dirname(self.renamed_path))
+        shutil.copy2(source, self.renamed_path)
+        self._invoke(chadow.index, ["testlib", "sector2", self.other_media_path, "--binary"])
+
+    def test_compare_moves(self):
+        self._rename_on_destination()
+        lines = [
+            json.loads(line)
+            for line in self._invoke(
+                chadow.compare, ["testlib", "--sequential", "--moves"]
+            ).splitlines()
+        ]
+        self.assertEqual(
+            [
+                {
+                    "sector": "sector1", "found_in": "sector2", "item": "b renamed.jpg",
+                    "path": self.renamed_path,
+                    "moved_from": os.path.join(self.media_path, "2019", "b.jpg")
+                },
+                {
+                    "sector": "sector2", "found_in": "sector1", "item": "b.jpg",
+                    "path": os.path.join(self.media_path, "2019", "b.jpg"),
+                    "moved_from": self.renamed_path
+                }
+            ],
+            sorted(lines[1:], key=lambda line: line["sector"])
+        )
+
+        lines = self._invoke(chadow.compare, ["testlib", "--sequential"]).splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertFalse(any("moved_from" in json.loads(line) for line in lines))
+
+    def test_sync_moves(self):
+        self._rename_on_destination()
+        output = self._invoke(chadow.sync, self.args + ["--moves", "--dry-run"])
+        self.assertEqual(
+            ["%s -> %s (moved)" % (self.renamed_path, self.copied_path)],
+            output.splitlines()[:-1]
+        )
+
+        output = self._invoke(chadow.sync, self.args + ["--moves"])
+        self.assertIn("moved 1 file(s); copied 0 file(s)", output)
+        self.assertFalse(os.path.exists(self.renamed_path))
+        with open(self.copied_path) as media_file:
+            self.assertEqual("bb", media_file.read())
+
+        with chadow.MappedIndex(
+            os.path.join(self.other_sector_path_dir, chadow.BINARY_INDEX_NAME)
+        ) as mapped_index:
+            media_index = mapped_index.to_directory_index()
+        fresh = chadow.MediaWalker(self.other_media_path).walk()
+        self.assertEqual(fresh, media_index)
+        self.assertEqual(sorted(fresh.iter_file_stats()), sorted(media_index.iter_file_stats()))
+
+    def _rename_on_nested_medium(self) -> str:
+        # sub is a medium of sector2 of its own, inside ehd2, and holds the
+        # renamed copy. ehd2 was indexed before the copy was made.
+        nested_media_path = os.path.join(self.other_media_path, "sub")
+        self.renamed_path = os.path.join(nested_media_path, "b renamed.jpg")
+        os.makedirs(nested_media_path)
+        os.makedirs(os.path.join(
+            self.app_root, "testlib", "sector2",
+            nested_media_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)
+        ))
+        config_filename = os.path.join(self.app_root, chadow.CONFIG_NAME)
+        with open(config_filename) as config_file:
+            config = json.load(config_file)
+        config["libraryMapping"]["testlib"]["sectors"]["sector2"].append(nested_media_path)
+        with open(config_filename, "w") as config_file:
+            json.dump(config, config_file)
+        self._invoke(chadow.index, ["testlib", "sector2", self.other_media_path, "--binary"])
+        shutil.copy2(os.path.join(self.media_path, "2019", "b.jpg"), self.renamed_path)
+        self._invoke(chadow.index, ["testlib", "sector2", nested_media_path])
+        return nested_media_path
+
+    def test_compare_moves_nested_media(self):
+        self._rename_on_nested_medium()
+        lines = [
+            json.loads(line)
+            for line in self._invoke(
+                chadow.compare, ["testlib", "--sequential", "--moves"]
+            ).splitlines()
+        ]
+        self.assertEqual(
+            [os.path.join(self.media_path, "2019", "b.jpg"), self.renamed_path],
+            [line.get("moved_from") for line in sorted(lines[1:], key=lambda line: line["sector"])]
+        )
+
+    def test_sync_moves_nested_media(self):
+        nested_media_path = self._rename_on_nested_medium()
+        output = self._invoke(chadow.sync, self.args + ["--moves"])
+        self.assertIn("moved 1 file(s); copied 0 file(s)", output)
+        with open(os.path.join(nested_media_path, "2019", "b.jpg")) as media_file:
+            self.assertEqual("bb", media_file.read())
+        self.assertFalse(os.path.exists(self.copied_path))
+
+    def test_sync_no_moves(self):
+        self._rename_on_destination()
+        output = self._invoke(chadow.sync, self.args)
+        self.assertIn("moved 0 file(s); copied 1 file(s)", output)
+        self.assertTrue(os.path.exists(self.renamed_path))
+
+    def _lookalike_on_destination(self) -> str:
+        # Same size and modification time as 2019/b.jpg, other contents.
+        source = os.path.join(self.media_path, "2019", "b.jpg")
+        lookalike = os.path.join(self.other_media_path, "2019", "other.jpg")
+        os.makedirs(os.path.dirname(lookalike))
+        with open(lookalike, "w") as media_file:
+            media_file.write("xx")
+        source_stat = os.stat(source)
+        os.utime(lookalike, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        self._invoke(chadow.index, ["testlib", "sector2", self.other_media_path, "--binary"])
+        return lookalike
+
+    def test_compare_lookalike_not_moved(self):
+        self._lookalike_on_destination()
+        output = self._invoke(chadow.compare, ["testlib", "--sequential", "--moves"])
+        self.assertEqual(3, len(output.splitlines()))
+        self.assertNotIn("moved_from", output)
+
+    def test_sync_lookalike_not_moved(self):
+        lookalike = self._lookalike_on_destination()
+        output = self._invoke(chadow.sync, self.args + ["--moves", "--dry-run"])
+        self.assertNotIn("(moved)", output)
+        output = self._invoke(chadow.sync, self.args + ["--moves"])
+        self.assertIn("moved 0 file(s); copied 1 file(s)", output)
+        with open(lookalike) as media_file:
+            self.assertEqual("xx", media_file.read())
+        with open(self.copied_path) as media_file:
+            self.assertEqual("bb", media_file.read())
+
+    def test_match_moves(self):
+        entries = [
+            ("s1", ("s2", "x")), ("s2", ("s1", "y")),
+            # Two files on one side share a signature: no telling which moved.
+            ("s1", ("s2", "p")), ("s1", ("s2", "q")), ("s2", ("s1", "r")),
+            # Same size and mtime, different contents.
+            ("s1", ("s2", "m")), ("s2", ("s1", "n"))
+        ]
+        signatures = {
+            ("s2", "x"): ((1, 1), None), ("s1", "y"): ((1, 1), "digest"),
+            ("s2", "p"): ((2, 2), None), ("s2", "q"): ((2, 2), None), ("s1", "r"): ((2, 2), None),
+            ("s2", "m"): ((3, 3), "one"), ("s1", "n"): ((3, 3), "other")
+        }
+        wanted = []
+
+        def _signatures(keys):
+            wanted.append(keys)
+            return {key: signatures[key] for key in keys}
+
+        remaining, moves = chadow.match_moves(entries, _signatures)
+        self.assertEqual([set(signatures)], wanted)
+        self.assertEqual([("s1", "s2", "x", "y"), ("s2", "s1", "y", "x")], moves)
+        self.assertEqual(entries[2:], remaining)
+
+        # Asked about x and y, whose contents are not both known.
+        asked = []
+
+        def _same_file(first, second):
+            asked.append((first, second))
+            return False
+
+        remaining, moves = chadow.match_moves(entries, _signatures, _same_file)
+        self.assertEqual([(("s2", "x"), ("s1", "y"))], asked)
+        self.assertEqual([], moves)
+        self.assertEqual(entries, remaining)
+
+class ExcludeTests(LibraryOnDiskTests):
+
+    def setUp(self):
+        super().setUp()
+        for name in (
+            chadow.CHADOW_METADATA, os.path.join("2019", "b.jpg.xmp"),
+            os.path.join(".Trash-1000", "files", "c.jpg"),
+            os.path.join("node_modules", "x", "index.js"),
+            os.path.join("2019", "node_modules", "y.js"),
+            os.path.join("thumbs", "keep.jpg"), os.path.join("thumbs", "d.jpg")
+        ):
+            os.makedirs(os.path.dirname(os.path.join(self.media_path, name)), exist_ok=True)
+            with open(os.path.join(self.media_path, name), "w") as media_file:
+                media_file.write("x")
+        self.index_filename = os.path.join(self.sector_path_dir, chadow.INDEX_NAME)
+
+    def _paths(self, dir_index):
+        return sorted("/".join(parts + (name,)) for parts, name, _ in dir_index.iter_file_stats())
+
+    def test_rules(self):
+        rules = chadow.ExcludeRules([
+            "# thumbnails", "", "*.xmp", "/.Trash-*/", "node_modules/", "thumbs/*",
+            "!thumbs/keep.jpg", "2019/[!b]*.jpg", "\\#literal", "docs/**/draft.txt"
+        ])
+        expected = {
+            (".chadow-metadata", False): True,
+            ("sub/.chadow-metadata", False): False,
+            ("b.jpg.xmp", False): True,
+            ("2019/b.jpg.xmp", False): True,
+            ("2019/b.jpg", False): False,
+            ("2019/c.jpg", False): True,
+            ("2020/c.jpg", False): False,
+            (".Trash-1000", True): True,
+            (".Trash-1000", False): False,
+            ("2019/.Trash-1000", True): False,
+            ("node_modules", True): True,
+            ("2019/node_modules", True): True,
+            ("node_modules", False): False,
+            ("thumbs/d.jpg", False): True,
+            ("thumbs/keep.jpg", False): False,
+            ("#literal", False): True,
+            ("docs/draft.txt", False): True,
+            ("docs/a/b/draft.txt", False): True,
+            ("docs/a/b/final.txt", False): False
+        }
+        self.assertEqual(
+            expected, {key: rules.excludes(*key) for key in expected}
+        )
+        self.assertFalse(chadow.ExcludeRules(["!/.chadow-metadata"]).excludes(".chadow-metadata", False))
+
+    def test_walk_prunes(self):
+        rules = chadow.ExcludeRules(["node_modules/", "/.Trash-*/"])
+        with unittest.mock.patch(
+            "chadow_core._scan_directory", wraps=chadow._scan_directory
+        ) as mock_scan:
+            root = chadow.MediaWalker(self.media_path, sequential=True, rules=rules).walk()
+
+        scanned = {call.args[0] for call in mock_scan.call_args_list}
+        self.assertNotIn(os.path.join(self.media_path, "node_modules"), scanned)
+        self.assertNotIn(os.path.join(self.media_path, "2019", "node_modules"), scanned)
+        self.assertNotIn(os.path.join(self.media_path, ".Trash-1000"), scanned)
+        self.assertEqual(
+            ["2019/b.jpg", "2019/b.jpg.xmp", "a.jpg", "thumbs/d.jpg", "thumbs/keep.jpg"],
+            self._paths(root)
+        )
+
+    def test_default_rules_fast_path(self):
+        rules = chadow.ExcludeRules(["# nothing but a comment", ""])
+        self.assertIsNone(rules.for_directory("2019"))
+        self.assertTrue(rules.for_directory("")(chadow.CHADOW_METADATA, False))
+        self.assertFalse(rules.for_directory("")("a.jpg", False))
+        self.assertIsNotNone(chadow.ExcludeRules(["*.xmp"]).for_directory("2019"))
+
+        with unittest.mock.patch(
+            "chadow_core._scan_directory", wraps=chadow._scan_directory
+        ) as mock_scan:
+            root = chadow.MediaWalker(self.media_path, sequential=True, rules=rules).walk()
+        # Only the root is scanned with a filter.
+        self.assertEqual(
+            [self.media_path],
+            [call.args[0] for call in mock_scan.call_args_list if len(call.args) > 1]
+        )
+        self.assertNotIn(chadow.CHADOW_METADATA, self._paths(root))
+        self.assertIn("2019/b.jpg.xmp", self._paths(root))
+
+    def test_incremental_applies_new_rules(self):
+        # Make every directory look unchanged since the previous walk.
+        with unittest.mock.patch.object(
+            chadow.MediaWalker, "_fingerprint", lambda walker, path: (1, 1)
+        ):
+            previous = chadow.MediaWalker(self.media_path, sequential=True).walk()
+            root = chadow.MediaWalker(
+                self.media_path, sequential=True, previous=previous,
+                rules=chadow.ExcludeRules(["*.xmp", "thumbs/"])
+            ).walk()
+        self.assertEqual(
+            [
+                ".Trash-1000/files/c.jpg", "2019/b.jpg", "2019/node_modules/y.js", "a.jpg",
+                "node_modules/x/index.js"
+            ],
+            self._paths(root)
+        )
+
+    def test_index(self):
+        self._invoke(chadow.exclude, ["testlib", "node_modules/", "/.Trash-*/", "*.xmp"])
+        self._invoke(chadow.exclude, ["testlib", "*.xmp", "--remove"])
+        self.assertEqual(
+            ["/.chadow-metadata", "node_modules/", "/.Trash-*/"],
+            self._invoke(chadow.lsexclude, ["testlib"]).splitlines()
+        )
+
+        self._invoke(chadow.index, ["testlib", "sector1", self.media_path])
+        with open(self.index_filename) as index_file:
+            dir_index = chadow.DirectoryIndex.construct_from_dict(json.load(index_file))
+        self.assertEqual(
+            ["2019/b.jpg", "2019/b.jpg.xmp", "a.jpg", "thumbs/d.jpg", "thumbs/keep.jpg"],
+            self._paths(dir_index)
+        )
+
+    def test_createlib(self):
+        self._invoke(chadow.createlib, ["otherlib", "--exclude", "*.tmp", "--exclude", "lost+found/"])
+        self.assertEqual(
+            ["/.chadow-metadata", "*.tmp", "lost+found/"],
+            self._invoke(chadow.lsexclude, ["otherlib"]).splitlines()
+        )
+
+    def test_exclude_errors(self):
+        result = self.runner.invoke(chadow.exclude, ["testlib", "x", "--remove"])
+        self.assertEqual(chadow.ExitCodes.STATE_CONFLICT.value, result.exit_code)
+        result = self.runner.invoke(chadow.exclude, ["nolib", "x"])
+        self.assertEqual(chadow.ExitCodes.STATE_CONFLICT.value, result.exit_code)
+        result = self.runner.invoke(chadow.exclude, ["testlib", "[z-a]"])
+        self.assertEqual(chadow.ExitCodes.INVALID_ARG.value, result.exit_code)
+
+class StartupTests(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        probe = (
+            "import sys, chadow; "
+            "print(sorted(m for m in ('_sqlite3', '_hashlib', '_ctypes', 'concurrent.futures._base') "
+            "if m in sys.modules)); "
+            "print(chadow.VERSION == chadow.get_version()); "
+            "print(chadow.sqlite3.sqlite_version == __import__('sqlite3').sqlite_version); "
+            "from chadow import DirectoryIndex, MediaWalker, make_filename_diffbins; "
+            "print(DirectoryIndex is sys.modules['chadow_core'].DirectoryIndex)"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", probe], cwd=tempfile.gettempdir(), check=True,
+            stdout=subprocess.PIPE, universal_newlines=True,
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(chadow.__file__)))
+        ).stdout
+        self.assertEqual("[]\nTrue\nTrue\nTrue\n", output)
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app_root)
+        patcher = unittest.mock.patch("chadow_core.APP_ROOT", self.app_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.runner = CliRunner()
+        self.config_filename = os.path.join(self.app_root, chadow.CONFIG_NAME)
+        with open(self.config_filename, "w") as config_file:
+            json.dump(DEFAULT_CONFIG, config_file)
+        self.media_path = os.path.join(self.app_root, "media", "ehd1")
+        os.makedirs(self.media_path)
+
+    def _read_config(self):
+        with open(self.config_filename) as config_file:
+            return json.load(config_file)
+
+    def _batch(self, script, expected_return=0):
+        result = self.runner.invoke(chadow.batch, [], input=script)
+        if result.exception is not None and not isinstance(result.exception, SystemExit):
+            traceback.print_exception(*result.exc_info)
+        self.assertEqual(expected_return, result.exit_code)
+        return result.output
+
+    def test_batch(self):
+        with unittest.mock.patch("chadow_core.json.load", wraps=json.load) as mock_json_load, \
+                unittest.mock.patch("chadow_core.os.replace", wraps=os.replace) as mock_os_replace:
+            output = self._batch("\n".join((
+                "# Provisioning",
+                "createlib testlib --comparator size-mtime",
+                "regsector testlib sector1",
+                "regsector testlib sector2  # the backup",
+                "",
+                "regmedia testlib sector1 '%s'" % self.media_path,
+                "lssector testlib"
+            )))
+
+        self.assertEqual("sector1\nsector2\n", output)
+        self.assertEqual(1, mock_json_load.call_count)
+        self.assertEqual(1, mock_os_replace.call_count)
+        library = self._read_config()["libraryMapping"]["testlib"]
+        self.assertEqual("size-mtime", library["comparator"])
+        self.assertEqual({"sector1": [self.media_path], "sector2": []}, library["sectors"])
+
+    def test_batch_failure(self):
+        self._batch("\n".join((
+            "createlib testlib",
+            "commit",
+            "regsector testlib sector1",
+            "regsector testlib sector1",
+            "regsector testlib sector2"
+        )), ExitCodes.STATE_CONFLICT.value)
+
+        self.assertEqual({}, self._read_config()["libraryMapping"]["testlib"]["sectors"])
+
+    def test_batch_failure_undoes_files(self):
+        script = "\n".join((
+            "createlib testlib",
+            "regsector testlib sector1",
+            "regmedia testlib sector1 '%s'" % self.media_path,
+            "index testlib sector1 '%s' --sequential" % self.media_path,
+            "regsector testlib sector1"
+        ))
+        self._batch(script, ExitCodes.STATE_CONFLICT.value)
+
+        self.assertEqual({}, self._read_config()["libraryMapping"])
+        self.assertFalse(os.path.exists(os.path.join(self.app_root, "testlib")))
+        self.assertEqual([], os.listdir(self.media_path))
+
+        # Nothing is left in the way of running it again, fixed.
+        self._batch(script.rpartition("\n")[0])
+        self.assertEqual(
+            {"sector1": [self.media_path]},
+            self._read_config()["libraryMapping"]["testlib"]["sectors"]
+        )
+
+        self._batch(
+            "createlib otherlib\ncommit\ndeletelib otherlib\ncreatelib testlib\n",
+            ExitCodes.STATE_CONFLICT.value
+        )
+        self.assertIn("otherlib", self._read_config()["libraryMapping"])
+        self.assertTrue(os.path.isdir(os.path.join(self.app_root, "otherlib")))
+
+    def test_batch_usage_error(self):
+        self._batch("createlib testlib\nregsector testlib\n", 2)
+        self.assertEqual({}, self._read_config()["libraryMapping"])
+        self._batch("batch\n", ExitCodes.INVALID_ARG.value)
+
+    def test_batch_catalog(self):
+        self.runner.invoke(chadow.initcatalog, [])
+        self._batch("createlib testlib\nregsector testlib sector1\n")
+        self.assertEqual("testlib\n", self.runner.invoke(chadow.lslib, []).output)
+        self.assertEqual(
+            "sector1\n", self.runner.invoke(chadow.lssector, ["testlib"]).output
+        )
+
+        self._batch(
+            "regsector testlib sector2\nregsector testlib sector1\n",
+            ExitCodes.STATE_CONFLICT.value
+        )
+        self.assertEqual(
+            "sector1\n", self.runner.invoke(chadow.lssector, ["testlib"]).output
+        )
+
 class ChadowTests(unittest.TestCase):
 
     def setUp(self):
         self.runner = CliRunner()
         self.full_config_path = os.path.join(chadow.APP_ROOT, chadow.CONFIG_NAME)
+        # Never touch a real APP_ROOT from the tests.
+        for fs_call in ("remove", "replace"):
+            patcher = unittest.mock.patch("chadow_core.os.%s" % fs_call)
+            setattr(self, "mock_os_%s" % fs_call, patcher.start())
+            self.addCleanup(patcher.stop)
 
     def _verify_call(self, click_fn, args, expected_return=0):
         result = self.runner.invoke(click_fn, args)
@@ -49,69 +1930,97 @@ class ChadowTests(unittest.TestCase):
 
         return result.output
 
+    def _mock_open_files(self, open_map):
+        """
+        Mock open so that reading any of the paths in `open_map` gives its
+        contents. Everything else does not exist, unless opened for writing.
+        """
+        def _open(path, mode="r"):
+            if path in open_map:
+                return unittest.mock.mock_open(read_data=open_map[path]).return_value
+            elif "r" in mode and "+" not in mode:
+                raise FileNotFoundError(path)
+            return unittest.mock.mock_open().return_value
+
+        _mock_open = unittest.mock.mock_open()
+        _mock_open.side_effect = _open
+        return _mock_open
+
 class CreateLibTests(ChadowTests):
 
-    @unittest.mock.patch("chadow.json.dump")
+    @unittest.mock.patch("chadow_core.json.dump")
     def test_createlib(self, mock_json_dump):
         mo = unittest.mock.mock_open(read_data=DEFAULT_CONFIG_MOCK_VALUE)
-        with unittest.mock.patch("chadow.open", mo) as mopen, unittest.mock.patch("chadow.os.mkdir") as mmkdir:
+        with unittest.mock.patch("chadow_core.open", mo) as mopen, unittest.mock.patch("chadow_core.os.mkdir") as mmkdir:
             self._verify_call(chadow.createlib, ["testlib"])
             mopen.assert_any_call(self.full_config_path, "r")
-            mopen.assert_any_call(self.full_config_path, "w")
+            mopen.assert_any_call(self.full_config_path + ".partial", "w")
+            self.mock_os_replace.assert_called_once_with(
+                self.full_config_path + ".partial", self.full_config_path
+            )
             mmkdir.assert_any_call(os.path.join(chadow.APP_ROOT, "testlib"))
             updated_config = copy.deepcopy(DEFAULT_CONFIG)
             updated_config["libraryMapping"]["testlib"] = chadow.make_default_lib("filename")
             mock_json_dump.assert_called_with(updated_config, unittest.mock.ANY)
 
+    @unittest.mock.patch("chadow_core.json.dump")
+    def test_createlib_comparator(self, mock_json_dump):
+        mo = unittest.mock.mock_open(read_data=DEFAULT_CONFIG_MOCK_VALUE)
+        with unittest.mock.patch("chadow_core.open", mo), unittest.mock.patch("chadow_core.os.mkdir"):
+            self._verify_call(chadow.createlib, ["testlib", "--comparator", "content"])
+            updated_config = copy.deepcopy(DEFAULT_CONFIG)
+            updated_config["libraryMapping"]["testlib"] = chadow.make_default_lib("content")
+            mock_json_dump.assert_called_with(updated_config, unittest.mock.ANY)
+
     def test_createlib_corrupted_config(self):
         mo = unittest.mock.mock_open(read_data="{")
-        with unittest.mock.patch("chadow.open", mo) as mopen:
+        with unittest.mock.patch("chadow_core.open", mo) as mopen:
             self._verify_call(chadow.createlib, ["testlib"], ExitCodes.INVALID_CONFIG.value)
             mopen.assert_any_call(self.full_config_path, "r")
 
-    @unittest.mock.patch("chadow.os.mkdir")
-    @unittest.mock.patch("chadow.open", new_callable=unittest.mock.mock_open, read_data=DEFAULT_CONFIG_MOCK_VALUE)
+    @unittest.mock.patch("chadow_core.os.mkdir")
+    @unittest.mock.patch("chadow_core.open", new_callable=unittest.mock.mock_open, read_data=DEFAULT_CONFIG_MOCK_VALUE)
     def test_createlib_corrupted_config_force_recreate(self, open_mock, mkdir_mock):
         self._verify_call(chadow.createlib, ["testlib", "--force"])
         open_mock.assert_any_call(self.full_config_path, "r")
-        open_mock.assert_any_call(self.full_config_path, "w")
+        open_mock.assert_any_call(self.full_config_path + ".partial", "w")
         mkdir_mock.assert_any_call(os.path.join(chadow.APP_ROOT, "testlib"))
 
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_createlib_dupename(self, mkdir_mock):
         config = copy.deepcopy(DEFAULT_CONFIG)
         config["libraryMapping"]["testlib"] = chadow.make_default_lib("filename")
         mo = unittest.mock.mock_open(read_data=json.dumps(config))
-        with unittest.mock.patch("chadow.open", mo) as mopen:
+        with unittest.mock.patch("chadow_core.open", mo) as mopen:
             self._verify_call(chadow.createlib, ["testlib"], ExitCodes.STATE_CONFLICT.value)
             mopen.assert_any_call(self.full_config_path, "r")
             mkdir_mock.assert_not_called()
 
 class DeleteLibTests(ChadowTests):
 
-    @unittest.mock.patch("chadow.os.rmdir")
-    @unittest.mock.patch("chadow.json.dump")
+    @unittest.mock.patch("chadow_core.os.rmdir")
+    @unittest.mock.patch("chadow_core.json.dump")
     def test_deletelib(self, mock_json_dump, mock_rmdir):
         config = copy.deepcopy(DEFAULT_CONFIG)
         config["libraryMapping"]["testlib"] = chadow.make_default_lib("filename")
         mo = unittest.mock.mock_open(read_data=json.dumps(config))
-        with unittest.mock.patch("chadow.open", mo) as mopen:
+        with unittest.mock.patch("chadow_core.open", mo) as mopen:
             self._verify_call(chadow.deletelib, ["testlib"])
             mock_json_dump.assert_called_with(DEFAULT_CONFIG, unittest.mock.ANY)
-            mopen.assert_any_call(self.full_config_path, "rw")
+            mopen.assert_any_call(self.full_config_path, "r")
             mock_rmdir.assert_called_once_with(os.path.join(chadow.APP_ROOT, "testlib"))
 
-    @unittest.mock.patch("chadow.os.rmdir")
-    @unittest.mock.patch("chadow.json.dump")
-    @unittest.mock.patch("chadow.open", new_callable=unittest.mock.mock_open, read_data=DEFAULT_CONFIG_MOCK_VALUE)
+    @unittest.mock.patch("chadow_core.os.rmdir")
+    @unittest.mock.patch("chadow_core.json.dump")
+    @unittest.mock.patch("chadow_core.open", new_callable=unittest.mock.mock_open, read_data=DEFAULT_CONFIG_MOCK_VALUE)
     def test_deletelib_nonexistent_lib(self, open_mock, mock_json_dump, mock_rmdir):
         self._verify_call(chadow.deletelib, ["testlib"], ExitCodes.STATE_CONFLICT.value)
         mock_json_dump.assert_not_called()
-        open_mock.assert_any_call(self.full_config_path, "rw")
+        open_mock.assert_any_call(self.full_config_path, "r")
         mock_rmdir.assert_called_once_with(os.path.join(chadow.APP_ROOT, "testlib"))
 
-    @unittest.mock.patch("chadow.os.rmdir")
-    @unittest.mock.patch("chadow.json.dump")
+    @unittest.mock.patch("chadow_core.os.rmdir")
+    @unittest.mock.patch("chadow_core.json.dump")
     def test_deletelib_nonexistent_directory(self, mock_json_dump, mock_rmdir):
         # This is technically not necessary but we still want to ensure that
         # rmdir is called.
@@ -119,10 +2028,10 @@ class DeleteLibTests(ChadowTests):
         config = copy.deepcopy(DEFAULT_CONFIG)
         config["libraryMapping"]["testlib"] = chadow.make_default_lib("filename")
         mo = unittest.mock.mock_open(read_data=json.dumps(config))
-        with unittest.mock.patch("chadow.open", mo) as mopen:
+        with unittest.mock.patch("chadow_core.open", mo) as mopen:
             self._verify_call(chadow.deletelib, ["testlib"])
             mock_json_dump.assert_called_with(DEFAULT_CONFIG, unittest.mock.ANY)
-            mopen.assert_any_call(self.full_config_path, "rw")
+            mopen.assert_any_call(self.full_config_path, "r")
             mock_rmdir.assert_called_once_with(os.path.join(chadow.APP_ROOT, "testlib"))
 
 class RegSectorTests(ChadowTests):
@@ -132,20 +2041,20 @@ class RegSectorTests(ChadowTests):
         self.config = copy.deepcopy(DEFAULT_CONFIG)
         self.config["libraryMapping"]["testlib"] = chadow.make_default_lib("filename")
 
-    @unittest.mock.patch("chadow.json.dump")
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.json.dump")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_regsector(self, mock_mkdir, mock_json_dump):
         _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(chadow.regsector, ["testlib", "sector1"])
             mock_mkdir.assert_called_once_with(chadow.make_sector_dirname("testlib", "sector1"))
             self.config["libraryMapping"]["testlib"]["sectors"]["sector1"] = []
             mock_json_dump.assert_any_call(self.config, unittest.mock.ANY)
 
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_regsector_illegal_char(self, mock_mkdir):
         _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(
                 chadow.regsector,
                 [
@@ -156,11 +2065,11 @@ class RegSectorTests(ChadowTests):
             )
             mock_mkdir.assert_not_called()
 
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_regsector_dupename(self, mock_mkdir):
         self.config["libraryMapping"]["testlib"]["sectors"]["sector1"] = []
         _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(
                 chadow.regsector,
                 [
@@ -171,11 +2080,11 @@ class RegSectorTests(ChadowTests):
             )
             mock_mkdir.assert_not_called()
 
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_regsector_existing_state_conflict(self, mock_mkdir):
         self.config["libraryMapping"]["testlib"]["sectors"] = []
         _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(
                 chadow.regsector,
                 [
@@ -196,44 +2105,45 @@ class RegMediaTests(ChadowTests):
         self.config["libraryMapping"]["testlib"]["sectors"]["sector1"] = []
         self.__open_mock_map = {
             self.full_config_path: json.dumps(self.config),
+            self.full_config_path + ".partial": "",
             self.metadata_path: DEFAULT_CONFIG["installationId"]
         }
         self.open_mock_side_effect = lambda path, mode="": unittest.mock.mock_open(read_data=self.__open_mock_map[path]).return_value
 
-    @unittest.mock.patch("chadow.json.dump")
-    @unittest.mock.patch("chadow.os.path.isdir")
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.json.dump")
+    @unittest.mock.patch("chadow_core.os.path.isdir")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_regmedia(self, mock_mkdir, mock_isdir, mock_json_dump):
         mock_isdir.side_effect = lambda _dir: _dir != self.metadata_path
         _mock_open = unittest.mock.mock_open()
         _mock_open.side_effect = self.open_mock_side_effect
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(chadow.regmedia, ["testlib", "sector1", "/media/testpath"])
             self.config["libraryMapping"]["testlib"]["sectors"]["sector1"].append("/media/testpath")
             mock_json_dump.assert_any_call(self.config, unittest.mock.ANY)
             mock_isdir.assert_called_with(chadow.make_sector_dirname("testlib", "sector1"))
             mock_open.assert_any_call("/media/testpath/.chadow-metadata", "w+")
 
-    @unittest.mock.patch("chadow.os.path.isfile")
-    @unittest.mock.patch("chadow.json.dump")
-    @unittest.mock.patch("chadow.os.path.isdir")
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.os.path.isfile")
+    @unittest.mock.patch("chadow_core.json.dump")
+    @unittest.mock.patch("chadow_core.os.path.isdir")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_regmedia_metadata_exists(self, mock_mkdir, mock_isdir, mock_json_dump, mock_isfile):
         mock_isfile.return_value = True
         mock_isdir.side_effect = lambda _dir: _dir != self.metadata_path
         _mock_open = unittest.mock.mock_open()
         _mock_open.side_effect = self.open_mock_side_effect
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(
                 chadow.regmedia,
                 ["testlib", "sector1", "/media/testpath"],
                 ExitCodes.STATE_CONFLICT.value
             )
 
-    @unittest.mock.patch("chadow.os.path.isfile")
-    @unittest.mock.patch("chadow.json.dump")
-    @unittest.mock.patch("chadow.os.path.isdir")
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.os.path.isfile")
+    @unittest.mock.patch("chadow_core.json.dump")
+    @unittest.mock.patch("chadow_core.os.path.isdir")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_regmedia_metadata_exists_installationId_dne(self, mock_mkdir, mock_isdir, mock_json_dump, mock_isfile):
         mock_isfile.return_value = True
         mock_isdir.side_effect = lambda _dir: _dir != self.metadata_path
@@ -241,34 +2151,35 @@ class RegMediaTests(ChadowTests):
         _mock_open.side_effect = lambda path, mode="": unittest.mock.mock_open(
             read_data={
                 self.full_config_path: json.dumps(self.config),
+                self.full_config_path + ".partial": "",
                 self.metadata_path: "a-different-installationId"
             }[path]
         ).return_value
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(
                 chadow.regmedia,
                 ["testlib", "sector1", "/media/testpath"]
             )
 
-    @unittest.mock.patch("chadow.json.dump")
-    @unittest.mock.patch("chadow.os.path.isdir")
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.json.dump")
+    @unittest.mock.patch("chadow_core.os.path.isdir")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_regmedia_directory_dne(self, mock_mkdir, mock_isdir, mock_json_dump):
         mock_isdir.return_value = False
         _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(
                 chadow.regmedia,
                 ["testlib", "sector1", "/media/testpath"],
                 ExitCodes.STATE_CONFLICT.value
             )
 
-    @unittest.mock.patch("chadow.json.dump")
-    @unittest.mock.patch("chadow.os.path.isdir")
-    @unittest.mock.patch("chadow.os.mkdir")
+    @unittest.mock.patch("chadow_core.json.dump")
+    @unittest.mock.patch("chadow_core.os.path.isdir")
+    @unittest.mock.patch("chadow_core.os.mkdir")
     def test_regmedia_reserved_char(self, mock_mkdir, mock_isdir, mock_json_dump):
         _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             path = chadow.PATH_SEPARATOR_REPLACEMENT.join(("/media/test", "path"))
             self._verify_call(
                 chadow.regmedia,
@@ -284,9 +2195,21 @@ class IndexTests(ChadowTests):
 
     def setUp(self):
         super().setUp()
+        # History is kept in directories of its own, which would be created.
+        patcher = unittest.mock.patch.dict(
+            chadow.__dict__, {"__record_history": unittest.mock.MagicMock()}
+        )
+        self.mock_record_history = patcher.start()["__record_history"]
+        self.addCleanup(patcher.stop)
         self.config = copy.deepcopy(DEFAULT_CONFIG)
         self.config["libraryMapping"]["testlib"] = chadow.make_default_lib("filename")
-        self.sector_path = os.path.join("media", "ehd", "photos")
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.sector_path = os.path.join(self.media_root, "media", "ehd", "photos")
+        self.sector_path_dir = os.path.join(
+            chadow.APP_ROOT, "testlib", "sector1",
+            self.sector_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)
+        )
         self.config["libraryMapping"]["testlib"]["sectors"]["sector1"] = [self.sector_path]
         self.mock_directory_structure = iter([
             (
@@ -329,6 +2252,15 @@ class IndexTests(ChadowTests):
             )
         ])
 
+    def _make_directory_structure(self):
+        for root, dirs, files in self.mock_directory_structure:
+            os.makedirs(root, exist_ok=True)
+            for _dir in dirs:
+                os.makedirs(os.path.join(root, _dir), exist_ok=True)
+            for _file in files:
+                with open(os.path.join(root, _file), "w"):
+                    pass
+
     def __construct_expected_index(self):
         index = chadow.DirectoryIndex(self.sector_path, is_top_level=True)
         for _file in ["photo1.jpg", "photo2.JPG"]:
@@ -355,11 +2287,10 @@ class IndexTests(ChadowTests):
 
         return index
 
-    @unittest.mock.patch("chadow.os.walk")
-    def test_index(self, mock_os_walk):
+    def test_index(self):
+        self._make_directory_structure()
         _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
-        mock_os_walk.return_value = self.mock_directory_structure
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             output = self._verify_call(
                 chadow.index,
                 ["testlib", "sector1", self.sector_path, "--verbose"]
@@ -370,30 +2301,388 @@ class IndexTests(ChadowTests):
             print(created_index.to_json())
             print(self.__construct_expected_index().to_json())
             self.assertEqual(self.__construct_expected_index(), created_index)
-            mock_os_walk.assert_called()
-    
-    @unittest.mock.patch("chadow.os.walk")
-    def test_unregistered_media(self, mock_os_walk):
+
+    def test_index_sequential(self):
+        self._make_directory_structure()
+        _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
+            output = self._verify_call(
+                chadow.index,
+                ["testlib", "sector1", self.sector_path, "--verbose", "--sequential"]
+            )
+            created_index = chadow.DirectoryIndex.construct_from_dict(
+                json.loads(output)
+            )
+            self.assertEqual(self.__construct_expected_index(), created_index)
+
+    def test_walker_matches_os_walk(self):
+        self._make_directory_structure()
+        os.symlink(
+            os.path.join(self.sector_path, "winter"),
+            os.path.join(self.sector_path, "summer", "winter-link")
+        )
+        os.symlink(
+            os.path.join(self.sector_path, "photo1.jpg"),
+            os.path.join(self.sector_path, "winter", "photo-link.jpg")
+        )
+        # This is how index used to walk media.
+        expected = DirectoryIndex(self.sector_path, is_top_level=True)
+        parents = {}
+        for root, dirs, files in os.walk(self.sector_path):
+            dir_index = (
+                expected
+                if root == self.sector_path else
+                DirectoryIndex(root.split(os.sep)[-1], is_top_level=False)
+            )
+            for _file in files:
+                dir_index.add_to_index(_file)
+            for _dir in dirs:
+                parents[os.path.join(root, _dir)] = dir_index
+            if parents.get(root):
+                parents[root].add_to_index(dir_index)
+        expected = DirectoryIndex.construct_from_dict(json.loads(expected.to_json()))
+
+        for workers, sequential in ((4, False), (1, False), (4, True)):
+            walked = chadow.MediaWalker(self.sector_path, workers, sequential).walk()
+            self.assertEqual(
+                expected,
+                DirectoryIndex.construct_from_dict(json.loads(walked.to_json()))
+            )
+
+    def test_index_stream(self):
+        self._make_directory_structure()
+        _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
+        streamed_filename = os.path.join(self.sector_path_dir, chadow.STREAMED_INDEX_NAME)
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
+            output = self._verify_call(
+                chadow.index,
+                ["testlib", "sector1", self.sector_path, "--verbose", "--stream"]
+            )
+            created_index = chadow.DirectoryIndex.construct_from_records(
+                output.splitlines()
+            )
+            self.assertEqual(self.__construct_expected_index(), created_index)
+            mock_open.assert_any_call(streamed_filename + ".partial", "w+")
+            self.mock_os_replace.assert_called_once_with(
+                streamed_filename + ".partial", streamed_filename
+            )
+            self.mock_os_remove.assert_any_call(
+                os.path.join(self.sector_path_dir, chadow.INDEX_NAME)
+            )
+            self.mock_os_remove.assert_any_call(
+                os.path.join(self.sector_path_dir, chadow.BINARY_INDEX_NAME)
+            )
+
+    def test_index_binary(self):
+        self._make_directory_structure()
+        _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
+        binary_filename = os.path.join(self.sector_path_dir, chadow.BINARY_INDEX_NAME)
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open, \
+                unittest.mock.patch("chadow_core.write_binary_index") as mock_write:
+            self._verify_call(
+                chadow.index, ["testlib", "sector1", self.sector_path, "--binary"]
+            )
+            mock_open.assert_any_call(binary_filename + ".partial", "wb")
+            self.assertEqual(
+                self.__construct_expected_index(), mock_write.call_args[0][0]
+            )
+            self.mock_os_replace.assert_called_once_with(
+                binary_filename + ".partial", binary_filename
+            )
+            self.mock_os_remove.assert_any_call(
+                os.path.join(self.sector_path_dir, chadow.INDEX_NAME)
+            )
+
+    def test_index_stream_and_binary(self):
+        _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
+        with unittest.mock.patch("chadow_core.open", _mock_open):
+            self._verify_call(
+                chadow.index,
+                ["testlib", "sector1", self.sector_path, "--binary", "--stream"],
+                ExitCodes.INVALID_ARG.value
+            )
+
+    def test_index_missing_args(self):
+        _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
+        with unittest.mock.patch("chadow_core.open", _mock_open):
+            for args in (
+                ["testlib", "sector1"],
+                ["testlib", "sector1", self.sector_path, "--all"]
+            ):
+                self._verify_call(chadow.index, args, ExitCodes.INVALID_ARG.value)
+
+    def _add_second_medium(self):
+        second_path = os.path.join(self.media_root, "media", "nas")
+        os.makedirs(os.path.join(second_path, "scans"))
+        for _file in ("scan1.png", os.path.join("scans", "scan2.png")):
+            with open(os.path.join(second_path, _file), "w"):
+                pass
+        self.config["libraryMapping"]["testlib"]["sectors"]["sector2"] = [second_path]
+        return second_path
+
+    def test_index_all(self):
+        self._make_directory_structure()
+        second_path = self._add_second_medium()
+        _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
+            output = self._verify_call(chadow.index, ["testlib", "--all"])
+            mock_open.assert_any_call(
+                os.path.join(self.sector_path_dir, chadow.INDEX_NAME), "w+"
+            )
+            mock_open.assert_any_call(
+                os.path.join(
+                    chadow.APP_ROOT, "testlib", "sector2",
+                    second_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT),
+                    chadow.INDEX_NAME
+                ),
+                "w+"
+            )
+
+        lines = output.splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[0].startswith(
+            "sector1 %s: 9 files in 4 directories in " % self.sector_path
+        ))
+        self.assertTrue(lines[1].startswith(
+            "sector2 %s: 2 files in 2 directories in " % second_path
+        ))
+        self.assertTrue(lines[2].startswith("total: 11 files in 6 directories on 2 media in "))
+
+    def test_index_all_sector(self):
+        self._make_directory_structure()
+        second_path = self._add_second_medium()
+        _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
+        with unittest.mock.patch("chadow_core.open", _mock_open):
+            output = self._verify_call(chadow.index, ["testlib", "sector2", "--all"])
+
+        lines = output.splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].startswith("sector2 %s: 2 files" % second_path))
+        self.assertTrue(lines[1].startswith("total: 2 files in 2 directories on 1 media"))
+
+    def test_index_all_processes(self):
+        self._make_directory_structure()
+        self._add_second_medium()
+        _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
+        # A process per disk, as if each medium were on a disk of its own.
+        with unittest.mock.patch("chadow_core.open", _mock_open), \
+                unittest.mock.patch("chadow_core.block_device", side_effect=lambda path: path):
+            output = self._verify_call(chadow.index, ["testlib", "--all"])
+
+        self.assertTrue(
+            output.splitlines()[-1].startswith("total: 11 files in 6 directories on 2 media")
+        )
+
+    def test_block_device(self):
+        other_dir = tempfile.mkdtemp(dir=self.media_root)
+        self.assertEqual(chadow.block_device(self.media_root), chadow.block_device(other_dir))
+        missing = os.path.join(self.media_root, "unmounted")
+        self.assertEqual(missing, chadow.block_device(missing))
+
+    def _age_directories(self):
+        """
+        Backdate every directory so that it is outside the fingerprinting
+        racy window.
+        """
+        old = 1500000000
+        for root, dirs, files in os.walk(self.sector_path):
+            os.utime(root, (old, old))
+
+    def test_walker_incremental(self):
+        self._make_directory_structure()
+        self._age_directories()
+        previous = DirectoryIndex.construct_from_dict(json.loads(
+            chadow.MediaWalker(self.sector_path).walk().to_json()
+        ))
+        self.assertIsNotNone(previous.fingerprint)
+
+        vacation_path = os.path.join(self.sector_path, "summer", "vacation")
+        with open(os.path.join(vacation_path, "sunset.jpg"), "w"):
+            pass
+
+        for workers, sequential in ((4, False), (1, True)):
+            with unittest.mock.patch(
+                "chadow_core._scan_directory", wraps=chadow._scan_directory
+            ) as mock_scan:
+                walked = chadow.MediaWalker(
+                    self.sector_path, workers, sequential, previous=previous
+                ).walk()
+                mock_scan.assert_called_once_with(vacation_path)
+
+            self.assertEqual(chadow.MediaWalker(self.sector_path).walk(), walked)
+
+    def test_index_incremental(self):
+        self._make_directory_structure()
+        self._age_directories()
+        previous = chadow.MediaWalker(self.sector_path).walk().to_json()
+        index_filename = os.path.join(self.sector_path_dir, chadow.INDEX_NAME)
+        _mock_open = self._mock_open_files({
+            self.full_config_path: json.dumps(self.config),
+            index_filename: previous
+        })
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open, \
+                unittest.mock.patch("chadow_core._scan_directory") as mock_scan:
+            output = self._verify_call(
+                chadow.index,
+                ["testlib", "sector1", self.sector_path, "--verbose", "--incremental"]
+            )
+            mock_open.assert_any_call(index_filename, "r")
+            mock_scan.assert_not_called()
+            self.assertEqual(
+                self.__construct_expected_index(),
+                chadow.DirectoryIndex.construct_from_dict(json.loads(output))
+            )
+
+    def test_walker_file_stats(self):
+        self._make_directory_structure()
+        self._age_directories()
+        photo = os.path.join(self.sector_path, "summer", "vacation", "party.jpg")
+        with open(photo, "w") as photo_file:
+            photo_file.write("party")
+
+        walked = chadow.MediaWalker(self.sector_path).walk()
+        stats = {
+            os.path.join(*parts, name): file_stat
+            for parts, name, file_stat in walked.iter_file_stats()
+        }
+        photo_stat = os.lstat(photo)
+        self.assertEqual(
+            (5, photo_stat.st_mtime_ns, photo_stat.st_ino, "f"),
+            stats[os.path.join("summer", "vacation", "party.jpg")]
+        )
+
+        # The directory is unchanged but the file is not.
+        with open(photo, "a") as photo_file:
+            photo_file.write(" on")
+        rewalked = chadow.MediaWalker(self.sector_path, previous=walked).walk()
+        _, _, rewalked_stat = [
+            entry for entry in rewalked.iter_file_stats() if entry[1] == "party.jpg"
+        ][0]
+        self.assertEqual(8, rewalked_stat[0])
+
+    @unittest.mock.patch("chadow_core.os.scandir")
+    def test_unregistered_media(self, mock_os_scandir):
         self.config["libraryMapping"]["testlib"]["sectors"]["sector1"] = []
         _mock_open = unittest.mock.mock_open(read_data=json.dumps(self.config))
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(
                 chadow.index,
                 ["testlib", "sector1", self.sector_path],
                 ExitCodes.STATE_CONFLICT.value
             )
-            mock_os_walk.assert_not_called()
+            mock_os_scandir.assert_not_called()
     
-    @unittest.mock.patch("chadow.os.walk")
-    def test_nonexistent_lib(self, mock_os_walk):
+    @unittest.mock.patch("chadow_core.os.scandir")
+    def test_nonexistent_lib(self, mock_os_scandir):
         _mock_open = unittest.mock.mock_open(read_data=DEFAULT_CONFIG_MOCK_VALUE)
-        with unittest.mock.patch("chadow.open", _mock_open) as mock_open:
+        with unittest.mock.patch("chadow_core.open", _mock_open) as mock_open:
             self._verify_call(
                 chadow.index,
                 ["testlib", "sector1", self.sector_path],
                 ExitCodes.INVALID_CONFIG.value
             )
-            mock_os_walk.assert_not_called()
+            mock_os_scandir.assert_not_called()
+
+class CompareTests(ChadowTests):
+
+    def setUp(self):
+        super().setUp()
+        self.config = copy.deepcopy(DEFAULT_CONFIG)
+        self.config["libraryMapping"]["testlib"] = chadow.make_default_lib("filename")
+        self.config["libraryMapping"]["testlib"]["sectors"] = {
+            "sector1": ["/media/ehd1", "/media/ehd2"],
+            "sector2": ["/media/nas"]
+        }
+        self.media_indexes = {
+            ("sector1", "/media/ehd1"): {
+                "version": "0.1.0",
+                "index": ["a.jpg", {"subdir_path": "2019", "index": ["b.jpg"]}]
+            },
+            ("sector1", "/media/ehd2"): {
+                "version": "0.1.0",
+                "index": ["c.jpg"]
+            },
+            ("sector2", "/media/nas"): {
+                "version": "0.1.0",
+                "index": [{"subdir_path": "photos", "index": ["a.jpg", "c.jpg", "d.jpg"]}]
+            }
+        }
+
+    def _write_library(self):
+        """
+        Indexes are read in place through mmap, so the library is written to a
+        temporary APP_ROOT rather than mocked.
+        """
+        app_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app_root)
+        with open(os.path.join(app_root, chadow.CONFIG_NAME), "w") as config_file:
+            json.dump(self.config, config_file)
+        for (sector_name, media_path), media_index in self.media_indexes.items():
+            sector_path_dir = os.path.join(
+                app_root, "testlib", sector_name,
+                media_path.replace(os.sep, chadow.PATH_SEPARATOR_REPLACEMENT)
+            )
+            os.makedirs(sector_path_dir)
+            with open(os.path.join(sector_path_dir, chadow.INDEX_NAME), "w") as index_file:
+                json.dump(media_index, index_file)
+        return unittest.mock.patch("chadow_core.APP_ROOT", app_root)
+
+    def _parse_report(self, lines):
+        records = [json.loads(line) for line in lines if line.startswith("{")]
+        return records[0], sorted(
+            (record["sector"], record["found_in"], record["item"])
+            for record in records[1:]
+        )
+
+    def test_compare(self):
+        with self._write_library():
+            output = self._verify_call(chadow.compare, ["testlib", "--sequential"])
+
+        header, entries = self._parse_report(output.splitlines())
+        self.assertEqual(
+            {"largest_sector": ["sector1", 3], "smallest_sector": ["sector1", 3]},
+            header
+        )
+        self.assertEqual(
+            [("sector1", "sector2", "d.jpg"), ("sector2", "sector1", "b.jpg")],
+            entries
+        )
+        paths = {
+            record["item"]: record["path"]
+            for record in map(json.loads, output.splitlines()[1:])
+        }
+        self.assertEqual(os.path.join("/media/nas", "photos", "d.jpg"), paths["d.jpg"])
+        self.assertEqual(os.path.join("/media/ehd1", "2019", "b.jpg"), paths["b.jpg"])
+
+    def test_compare_to_file(self):
+        report_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, report_dir)
+        report_filename = os.path.join(report_dir, "report.jsonl")
+        with self._write_library():
+            output = self._verify_call(
+                chadow.compare, ["testlib", "--sequential", "--output", report_filename]
+            )
+
+        self.assertEqual("", output)
+        with open(report_filename) as report_file:
+            _, entries = self._parse_report(report_file.read().splitlines())
+        self.assertEqual(2, len(entries))
+
+    def test_compare_unindexed_media(self):
+        del self.media_indexes[("sector1", "/media/ehd2")]
+        with self._write_library():
+            self._verify_call(
+                chadow.compare, ["testlib", "--sequential"],
+                ExitCodes.STATE_CONFLICT.value
+            )
+
+    def test_compare_unknown_comparator(self):
+        self.config["libraryMapping"]["testlib"]["comparator"] = "telepathy"
+        with self._write_library():
+            self._verify_call(
+                chadow.compare, ["testlib", "--sequential"],
+                ExitCodes.INVALID_CONFIG.value
+            )
 
 if __name__ == "__main__":
     unittest.main()